@@ -0,0 +1,99 @@
+import csv
+import json
+import logging
+import os
+import re
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class AnnotationWriter(object):
+    # Appends annotation rows to <filename>.tsv and <filename>.jsonl as they arrive. The TSV header is taken
+    # from the first row and written once; output is flushed every flush_rows rows so memory use does not
+    # depend on the number of annotations.
+
+    def __init__(self, output_dir, filename='annotations', flush_rows=config.EXPORT_FLUSH_ROWS, append=False):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+        self.tsv_path = os.path.join(output_dir, filename + '.tsv')
+        self.jsonl_path = os.path.join(output_dir, filename + '.jsonl')
+        self.flush_rows = flush_rows
+        self.rows = 0
+        self.columns = None
+        self._header = not (append and os.path.exists(self.tsv_path) and os.path.getsize(self.tsv_path))
+        mode = 'a' if append else 'w'
+        self._tsv_file = open(self.tsv_path, mode, newline='', encoding='utf-8')
+        self._jsonl_file = open(self.jsonl_path, mode, encoding='utf-8')
+        self._tsv = csv.writer(self._tsv_file, delimiter='\t')
+
+    def write(self, row):
+        if self.columns is None:
+            self.columns = list(row.keys())
+            if self._header:
+                self._tsv.writerow(self.columns)
+        self._tsv.writerow([row.get(column) for column in self.columns])
+        self._jsonl_file.write(json.dumps(row) + '\n')
+        self.rows += 1
+        if self.rows % self.flush_rows == 0:
+            self.flush()
+
+    def flush(self):
+        self._tsv_file.flush()
+        self._jsonl_file.flush()
+
+    def close(self):
+        self._tsv_file.close()
+        self._jsonl_file.close()
+        logger.info("Wrote %d annotations to %s and %s", self.rows, self.tsv_path, self.jsonl_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PartitionedAnnotationWriter(object):
+    # One AnnotationWriter per dataset in <output_dir>/<filename>/dataset=<name>/ so that loaders can read
+    # the datasets in parallel. Datasets are expected one after the other: only one writer is open at a time.
+
+    def __init__(self, output_dir, filename='annotations', flush_rows=config.EXPORT_FLUSH_ROWS):
+        self.root = os.path.join(output_dir, filename)
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.rows = 0
+        self._dataset = None
+        self._writer = None
+        self._seen = set()
+
+    def write(self, row):
+        dataset = row['datasetName']
+        if dataset != self._dataset:
+            self._close_writer()
+            path = os.path.join(self.root, 'dataset=' + partition_name(dataset))
+            self._writer = AnnotationWriter(path, self.filename, self.flush_rows, append=dataset in self._seen)
+            self._dataset = dataset
+            self._seen.add(dataset)
+        self._writer.write(row)
+        self.rows += 1
+
+    def _close_writer(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    def close(self):
+        self._close_writer()
+        logger.info("Wrote %d annotations to %s", self.rows, self.root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def partition_name(dataset_name):
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', dataset_name)
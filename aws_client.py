@@ -1,15 +1,26 @@
+import base64
+import hashlib
+import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import config
 import configparser
-import boto3
+from clients import get_s3_client
+from checksum import StreamDigest, PartDigest, ChecksumError, etag_part_count, etag_part_sizes, \
+    combine_part_digests, verify_etag, write_sidecar, CHECKSUM_SUFFIX, MB
+from metrics import timed, timed_iter
+from file_utils import save_stream, preallocate_part_file, write_at, commit_part_file, discard_part_file, \
+    part_file_name, part_file_size
 
 msg_format = '%(asctime)s %(levelname)s %(message)s'
-date_format= '%Y-%d-%m %H:%M:%S'
+date_format= '%Y-%m-%d %H:%M:%S'
 logging.basicConfig(format=msg_format, datefmt=date_format, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+MAX_UPLOAD_PARTS = 10000
+
 
 class AwsCredentials(object):
 
@@ -43,24 +54,364 @@ class AwsCredentials(object):
         return self.bucket
 
 
-aws_cred = AwsCredentials()
-session = boto3.Session(aws_cred.get_access_key, aws_cred.get_secret_access_key)
-s3 = session.resource('s3')
-bucket = s3.Bucket(aws_cred.get_bucket)
+def list_objects(bucket_name, prefix):
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in timed_iter(paginator.paginate(Bucket=bucket_name, Prefix=prefix), 's3.list_objects', size=None):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def head_object(bucket_name, key):
+    with timed('s3.head_object'):
+        head = get_s3_client().head_object(Bucket=bucket_name, Key=key)
+    return head['ContentLength'], head['ETag']
 
 
-def aws_download_file(bucket_name, aws_path, aws_file_name, data_type='binary'):
-    aws_bucket = s3.Bucket(bucket_name)
+def download_object(bucket_name, aws_path, aws_file_name, out_path, size=None, etag=None,
+                    part_size=config.MULTIPART_PART_SIZE, max_concurrency=config.MULTIPART_CONCURRENCY,
+                    threshold=config.MULTIPART_THRESHOLD, chunk_size=config.DOWNLOAD_CHUNK_SIZE, callback=None,
+                    manifest=None, checksums=config.CHECKSUM_ENABLED, store=None):
+    # Stream the object in fixed size chunks straight to disk instead of holding it in memory.
+    # Objects above the threshold are split into byte ranges fetched concurrently.
+    # callback, if given, is called with the size of every chunk received.
+    # With a TransferManifest, unchanged files are skipped and interrupted downloads are resumed.
+    # With checksums, MD5/SHA-256 digests are computed while downloading, checked against the ETag
+    # and written to <file>.checksums.json; a mismatch raises ChecksumError.
+    # With an object_store.ObjectStore, objects already in the store are linked instead of downloaded
+    # and downloaded objects are added to it.
     source = os.path.join(aws_path, aws_file_name)
-    obj = aws_bucket.Object(source)
+    if size is None or etag is None:
+        size, etag = head_object(bucket_name, source)
+    ranged = max_concurrency > 1 and size > max(threshold, part_size)
+    done_parts = None
+    if manifest:
+        if manifest.is_complete(out_path, aws_file_name, size, etag):
+            logger.info("Skipping %s %s, unchanged since last download", bucket_name, source)
+            return os.path.join(out_path, aws_file_name)
+    if store and store.link_into(etag, size, out_path, aws_file_name):
+        if manifest:
+            manifest.start(out_path, aws_file_name, bucket_name, source, size, etag)
+            manifest.complete(out_path, aws_file_name)
+        return os.path.join(out_path, aws_file_name)
+    if manifest:
+        done_parts = manifest.start(out_path, aws_file_name, bucket_name, source, size, etag,
+                                    part_size=part_size if ranged else None)
     logger.info("Downloading %s %s", bucket_name, source)
-    body = None
+    if ranged:
+        target, file_checksums = aws_download_ranged(bucket_name, source, size, out_path, aws_file_name, etag=etag,
+                                                     part_size=part_size, max_concurrency=max_concurrency,
+                                                     chunk_size=chunk_size, callback=callback, manifest=manifest,
+                                                     done_parts=done_parts, checksums=checksums)
+    else:
+        offset = 0
+        if done_parts is not None:
+            offset = min(part_file_size(out_path, aws_file_name) or 0, size)
+        params = dict(Bucket=bucket_name, Key=source, IfMatch=etag)
+        if offset:
+            logger.info("Resuming %s %s from byte %d", bucket_name, source, offset)
+            params['Range'] = 'bytes=%d-' % offset
+        chunks = iter([])
+        if offset < size:
+            chunks = _get_chunks(params, chunk_size, 's3.get_object')
+        digest = None
+        if checksums:
+            digest = StreamDigest(etag, size)
+            if offset:
+                digest.update_from_file(part_file_name(out_path, aws_file_name), 0, offset)
+            chunks = digest.wrap(chunks)
+        target = save_stream(_report_chunks(chunks, callback), out_path, aws_file_name,
+                             append=offset > 0, keep_partial=manifest is not None)
+        file_checksums = digest.result() if digest else None
+    if file_checksums is not None:
+        _check_download(bucket_name, source, size, etag, out_path, aws_file_name, file_checksums, manifest)
+    if manifest:
+        manifest.complete(out_path, aws_file_name)
+    if store:
+        store.add(target, etag, size)
+    return target
+
+
+def _check_download(bucket_name, source, size, etag, out_path, file_name, file_checksums, manifest=None):
+    verified = verify_etag(file_checksums, etag)
+    if verified is False:
+        os.remove(os.path.join(out_path, file_name))
+        if manifest:
+            manifest.reset(out_path, file_name)
+        raise ChecksumError("Checksum of %s %s does not match its ETag %s" % (bucket_name, source, etag))
+    file_checksums.update(bucket=bucket_name, key=source, size=size, etag=etag, verified=verified)
+    write_sidecar(out_path, file_name, file_checksums)
+    if verified:
+        logger.info("Checksum of %s %s matches its ETag", bucket_name, source)
+    else:
+        logger.info("Checksum of %s %s could not be checked against ETag %s", bucket_name, source, etag)
+
+
+def _get_chunks(params, chunk_size, operation):
+    # the request is timed as operation, the chunks of the body as s3.read
+    with timed(operation):
+        body = get_s3_client().get_object(**params)['Body']
+    return timed_iter(body.iter_chunks(chunk_size), 's3.read')
+
+
+def _report_chunks(chunks, callback):
+    for chunk in chunks:
+        if callback:
+            callback(len(chunk))
+        yield chunk
+
+
+def part_ranges(size, part_size):
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+
+def _download_range(bucket_name, key, start, end, part_file, etag=None, chunk_size=config.DOWNLOAD_CHUNK_SIZE,
+                    callback=None, digest=None):
+    params = dict(Bucket=bucket_name, Key=key, Range='bytes=%d-%d' % (start, end))
+    if etag:
+        # fail the part instead of mixing two versions of the object in one file
+        params['IfMatch'] = etag
+    chunks = _get_chunks(params, chunk_size, 's3.get_range')
+    if digest:
+        chunks = digest.wrap(chunks)
+    return write_at(part_file, start, _report_chunks(chunks, callback))
+
+
+def download_byte_ranges(bucket_name, key, ranges, part_file, etag=None,
+                         max_concurrency=config.MULTIPART_CONCURRENCY, chunk_size=config.DOWNLOAD_CHUNK_SIZE,
+                         callback=None):
+    # Fetch (start, end) byte ranges of an object into part_file at the same offsets
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(_download_range, bucket_name, key, start, end, part_file, etag, chunk_size,
+                                   callback) for start, end in ranges]
+        try:
+            return sum(future.result() for future in futures)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def aws_download_ranged(bucket_name, key, size, out_path, file_name, etag=None,
+                        part_size=config.MULTIPART_PART_SIZE, max_concurrency=config.MULTIPART_CONCURRENCY,
+                        chunk_size=config.DOWNLOAD_CHUNK_SIZE, callback=None, manifest=None, done_parts=None,
+                        checksums=config.CHECKSUM_ENABLED):
+    # Returns the downloaded file and, with checksums, the per part digests combined
+    # (see checksum.combine_part_digests). When the ETag is a plain MD5, or part_size is not the upload part
+    # size, the digests of the whole file are needed: parts are then also hashed in order as soon as they
+    # are complete, while still in the page cache.
+    all_ranges = part_ranges(size, part_size)
+    part_digests = {}
+    if done_parts and part_file_size(out_path, file_name) == size:
+        logger.info("Resuming %s %s, %d of %d parts already downloaded", bucket_name, key,
+                    len(done_parts), len(all_ranges))
+        part_file = part_file_name(out_path, file_name)
+        part_digests.update(done_parts)
+        ranges = [(start, end) for start, end in all_ranges if start not in done_parts]
+        written = size - sum(end - start + 1 for start, end in ranges)
+    else:
+        if manifest and done_parts is not None:
+            # the parts recorded are not in a .part file of the right size, they are downloaded again
+            manifest.reset(out_path, file_name)
+        part_file = preallocate_part_file(out_path, file_name, size)
+        ranges = all_ranges
+        written = 0
+    logger.info("Downloading %s %s in %d parts of %d bytes (%d concurrent)",
+                bucket_name, key, len(ranges), part_size, max_concurrency)
+    # The part MD5s only combine into a multipart ETag when the ranges are the upload parts; otherwise the
+    # ETag is checked against the digests of the whole file
+    full_digest = None
+    if checksums and part_size not in etag_part_sizes(size, etag_part_count(etag)):
+        full_digest = StreamDigest(etag, size)
+    completed = set(part_digests)
+    next_part = 0
+
+    def download_part(start, end):
+        digest = PartDigest() if checksums else None
+        part_written = _download_range(bucket_name, key, start, end, part_file, etag, chunk_size, callback,
+                                       digest)
+        if digest:
+            part_digests[start] = digest.hexdigests()
+        if manifest:
+            manifest.part_done(out_path, file_name, start, part_digests.get(start, (None, None)))
+        return part_written
+
+    def hash_in_order():
+        nonlocal next_part
+        while next_part < len(all_ranges) and all_ranges[next_part][0] in completed:
+            start, end = all_ranges[next_part]
+            full_digest.update_from_file(part_file, start, end - start + 1, chunk_size)
+            next_part += 1
+
     try:
-        if data_type == 'utf-8':
-            body = obj.get()['Body'].read().decode('utf-8')
-        else:
-            body = obj.get()['Body'].read()
-    except Exception:
-        logger.warning("Failed to download %s", source)
-
-    return body
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = dict((executor.submit(download_part, start, end), start) for start, end in ranges)
+            try:
+                if full_digest:
+                    hash_in_order()
+                for future in as_completed(futures):
+                    written += future.result()
+                    completed.add(futures[future])
+                    if full_digest:
+                        hash_in_order()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        if written != size:
+            raise IOError("Downloaded %d bytes of %d for %s" % (written, size, key))
+    except BaseException:
+        if not manifest:
+            discard_part_file(out_path, file_name)
+        raise
+    file_checksums = None
+    if checksums:
+        ordered = [part_digests.get(start) for start, end in all_ranges]
+        file_checksums = {}
+        if all(digests and digests[0] for digests in ordered):
+            file_checksums = combine_part_digests(ordered, part_size)
+        if full_digest:
+            file_checksums.update(full_digest.result())
+    return commit_part_file(out_path, file_name), file_checksums
+
+
+def is_not_found(exc):
+    response = getattr(exc, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    code = response.get('Error', {}).get('Code')
+    return code in ('404', 'NoSuchKey', 'NotFound') or response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404
+
+
+def _local_checksums(path, size, etag, chunk_size=config.DOWNLOAD_CHUNK_SIZE):
+    # the <file>.checksums.json written when the file was downloaded, if newer than the file, otherwise computed
+    sidecar = path + CHECKSUM_SUFFIX
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+        with open(sidecar) as data_file:
+            checksums = json.load(data_file)
+        if verify_etag(checksums, etag):
+            return checksums
+    digest = StreamDigest(etag, size)
+    digest.update_from_file(path, 0, size, chunk_size)
+    return digest.result()
+
+
+def is_uploaded(path, bucket_name, key, chunk_size=config.DOWNLOAD_CHUNK_SIZE):
+    # True when key holds an object of the same size and content (by ETag) as the local file
+    try:
+        size, etag = head_object(bucket_name, key)
+    except Exception as exc:
+        if is_not_found(exc):
+            return False
+        raise
+    if size != os.path.getsize(path):
+        return False
+    return verify_etag(_local_checksums(path, size, etag, chunk_size), etag) is True
+
+
+def _read_part(path, start, end):
+    with open(path, 'rb') as data_file:
+        data_file.seek(start)
+        return data_file.read(end - start + 1)
+
+
+def _content_md5(data):
+    # S3 rejects the request if the body it received does not have this MD5
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+def _uploaded_parts(bucket_name, key, path, ranges):
+    # Upload id of the latest unfinished multipart upload of key and {part number: ETag} of its parts
+    # that match the local file split in ranges; (None, {}) when there is no such upload
+    client = get_s3_client()
+    uploads = []
+    with timed('s3.list_multipart_uploads'):
+        for page in client.get_paginator('list_multipart_uploads').paginate(Bucket=bucket_name, Prefix=key):
+            uploads.extend(upload for upload in page.get('Uploads', []) if upload['Key'] == key)
+    if not uploads:
+        return None, {}
+    upload_id = max(uploads, key=lambda upload: upload['Initiated'])['UploadId']
+    parts = {}
+    with timed('s3.list_parts'):
+        pages = list(client.get_paginator('list_parts').paginate(Bucket=bucket_name, Key=key, UploadId=upload_id))
+    for page in pages:
+        for part in page.get('Parts', []):
+            number = part['PartNumber']
+            if number > len(ranges):
+                continue
+            start, end = ranges[number - 1]
+            if part['Size'] != end - start + 1:
+                continue
+            digest = StreamDigest()
+            digest.update_from_file(path, start, end - start + 1)
+            if part['ETag'].strip('"') == digest.result()['md5']:
+                parts[number] = part['ETag']
+    return upload_id, parts
+
+
+def _upload_part(bucket_name, key, upload_id, number, path, start, end, callback=None):
+    data = _read_part(path, start, end)
+    with timed('s3.upload_part', len(data)):
+        response = get_s3_client().upload_part(Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=number,
+                                               Body=data, ContentMD5=_content_md5(data))
+    if callback:
+        callback(len(data))
+    return response['ETag'], len(data)
+
+
+def aws_upload_multipart(path, bucket_name, key, size, part_size=config.MULTIPART_PART_SIZE,
+                         max_concurrency=config.MULTIPART_CONCURRENCY, callback=None):
+    # Returns the bytes sent. Parts already uploaded by an interrupted upload of the same file are kept;
+    # on failure the multipart upload is left in S3 to be resumed by the next attempt.
+    if size > part_size * MAX_UPLOAD_PARTS:
+        part_size = -(-size // (MAX_UPLOAD_PARTS * MB)) * MB
+    ranges = part_ranges(size, part_size)
+    upload_id, parts = _uploaded_parts(bucket_name, key, path, ranges)
+    client = get_s3_client()
+    if upload_id:
+        logger.info("Resuming upload of %s to %s %s, %d of %d parts already uploaded", path, bucket_name, key,
+                    len(parts), len(ranges))
+    else:
+        with timed('s3.create_multipart_upload'):
+            upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key)['UploadId']
+    logger.info("Uploading %s to %s %s in %d parts of %d bytes (%d concurrent)",
+                path, bucket_name, key, len(ranges) - len(parts), part_size, max_concurrency)
+    sent = 0
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = dict((executor.submit(_upload_part, bucket_name, key, upload_id, number, path, start, end,
+                                        callback), number)
+                       for number, (start, end) in enumerate(ranges, 1) if number not in parts)
+        try:
+            for future in as_completed(futures):
+                parts[futures[future]], part_sent = future.result()
+                sent += part_sent
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    with timed('s3.complete_multipart_upload'):
+        client.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id, MultipartUpload=dict(
+            Parts=[dict(PartNumber=number, ETag=parts[number]) for number in sorted(parts)]))
+    return sent
+
+
+def upload_object(path, bucket_name, key, part_size=config.MULTIPART_PART_SIZE,
+                  max_concurrency=config.MULTIPART_CONCURRENCY, threshold=config.MULTIPART_THRESHOLD,
+                  callback=None, skip_existing=True):
+    # Upload the local file path as key. Files above the threshold are sent as a multipart upload with
+    # max_concurrency parts at once, resumed from the parts already in S3 after an interruption.
+    # With skip_existing nothing is sent when key already holds the same size and content (by ETag).
+    # callback, if given, is called with the size of every part sent. Returns the bytes sent, None if skipped.
+    if skip_existing and is_uploaded(path, bucket_name, key):
+        logger.info("Skipping %s, already in %s %s", path, bucket_name, key)
+        return None
+    size = os.path.getsize(path)
+    if size > max(threshold, part_size):
+        return aws_upload_multipart(path, bucket_name, key, size, part_size=part_size,
+                                    max_concurrency=max_concurrency, callback=callback)
+    logger.info("Uploading %s to %s %s", path, bucket_name, key)
+    data = _read_part(path, 0, size - 1)
+    with timed('s3.put_object', len(data)):
+        get_s3_client().put_object(Bucket=bucket_name, Key=key, Body=data, ContentMD5=_content_md5(data))
+    if callback:
+        callback(len(data))
+    return len(data)
@@ -0,0 +1,120 @@
+import getopt
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from datasets import get_dataset_info
+from isa_tab_writer import write_study_tables
+from standins import install
+
+# ISA-Tab benchmark: s_study.txt/a_assay.txt written by isa_tab_writer (streaming, concurrent dataset
+# lookups) against the previous path (one dataset lookup after the other and the isatools object model
+# dumped by isatools) for synthetic studies of 100, 1000 and 10000 samples. METASPACE is replaced by the
+# stand-in of standins.py answering after --latency milliseconds; the metadata cache is off.
+# Needs isatools for the previous path, which is skipped otherwise.
+
+
+def synthetic_samples(count):
+    for i in range(count):
+        name = 'dataset_%06d' % i
+        yield {'metaspace_options': {'Dataset_Name': name},
+               'Submitted_By': {'Institution': 'EMBL-EBI'},
+               'Sample_Information': {'Organism': 'Mus musculus', 'Organism_Part': 'Brain',
+                                      'Condition': 'Wildtype', 'Sample_Growth_Conditions': 'N/A'},
+               'Sample_Preparation': {'Sample_Stabilisation': 'Fresh frozen', 'Tissue_Modification': 'N/A',
+                                      'MALDI_Matrix': 'DHB', 'MALDI_Matrix_Application': 'Sprayer',
+                                      'Solvent': 'ACN'},
+               'MS_Analysis': {'Polarity': 'Positive', 'Ionisation_Source': 'MALDI', 'Analyzer': 'Orbitrap'},
+               's3dir': {'imzML': 'bucket/%s/%s.imzML' % (name, name), 'ibd': 'bucket/%s/%s.ibd' % (name, name)}}
+
+
+def previous_tables(samples, output_dir):
+    from isatools.isatab import dump
+    from isatools.model import Investigation, Study, Assay, Source, Sample, Characteristic, \
+        OntologyAnnotation, Protocol, Process
+
+    investigation = Investigation(filename='i_investigation.txt')
+    study = Study(filename='s_study.txt')
+    assay = Assay(filename='a_assay.txt')
+    collection = Protocol(name='Sample collection', protocol_type=OntologyAnnotation(term='sample collection'))
+    study.protocols.append(collection)
+    for sample in samples:
+        name = sample['metaspace_options']['Dataset_Name']
+        get_dataset_info(name=name)
+        info = sample['Sample_Information']
+        source = Source(name=name, characteristics=[
+            Characteristic(category=OntologyAnnotation(term='Organism'), value=info['Organism']),
+            Characteristic(category=OntologyAnnotation(term='Organism part'), value=info['Organism_Part'])])
+        study_sample = Sample(name=name, derives_from=[source])
+        study.sources.append(source)
+        study.samples.append(study_sample)
+        study.process_sequence.append(Process(executes_protocol=collection, inputs=[source],
+                                              outputs=[study_sample]))
+        assay.samples.append(study_sample)
+    study.assays.append(assay)
+    investigation.studies.append(study)
+    dump(investigation, output_dir, i_file_name='i_Investigation.txt', skip_dump_tables=False)
+
+
+def streaming_tables(samples, output_dir):
+    write_study_tables(samples, output_dir)
+
+
+def measure(fn, count):
+    output_dir = tempfile.mkdtemp(prefix='mmit-isa-')
+    try:
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn(synthetic_samples(count), output_dir)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return dict(seconds=round(seconds, 3), samples_per_second=round(count / seconds, 1),
+                peak_mb=round(peak / 1024.0 / 1024.0, 2))
+
+
+def main(argv):
+    sizes = [100, 1000, 10000]
+    latency = 0.002
+    output = None
+    opts, args = getopt.getopt(argv, 'n:l:o:', ['sizes=', 'latency=', 'output='])
+    for opt, arg in opts:
+        if opt in ('-n', '--sizes'):
+            sizes = [int(size) for size in arg.split(',')]
+        if opt in ('-l', '--latency'):
+            latency = float(arg) / 1000
+        if opt in ('-o', '--output'):
+            output = arg
+
+    install(sm_latency=latency)
+    try:
+        import isatools
+        paths = [('previous', previous_tables), ('streaming', streaming_tables)]
+    except ImportError:
+        print('isatools is not installed, only the streaming writer is measured')
+        paths = [('streaming', streaming_tables)]
+
+    results = []
+    print('%-10s %8s %10s %12s %10s' % ('path', 'samples', 'seconds', 'samples/s', 'peak MB'))
+    for count in sizes:
+        for name, fn in paths:
+            result = dict(path=name, samples=count, workers=config.ISA_TAB_MAX_WORKERS, **measure(fn, count))
+            results.append(result)
+            print('%-10s %8d %10.3f %12.1f %10.2f' % (name, count, result['seconds'], result['samples_per_second'],
+                                                      result['peak_mb']))
+    if output:
+        with open(output, 'w') as data_file:
+            json.dump(dict(latency_ms=latency * 1000, results=results), data_file, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
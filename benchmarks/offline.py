@@ -0,0 +1,214 @@
+import getopt
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from standins import SyntheticStudy, install, MB
+
+# Offline benchmarks of the mmit commands against in-process S3 and METASPACE stand-ins (standins.py)
+# serving synthetic datasets. Each scenario runs in its own process so its peak RSS is its own; the
+# results (throughput, request latency percentiles per service, peak RSS) are printed and saved as JSON.
+# With --compare, a previous results file is read and the run fails when a scenario got slower by more
+# than --tolerance.
+#
+#   python benchmarks/offline.py --datasets 16 --ibd-size 64 -o results.json
+#   python benchmarks/offline.py -o new.json --compare results.json
+
+SCENARIOS = ['listing', 'aws_download_files', 'get_all_files', 'annotations', 'new_study', 'upload']
+# sizes in MB, latencies in ms, bandwidth per request in MB/s (0 for unlimited)
+SETTINGS = dict(datasets=8, imzml_size=1.0, ibd_size=32.0, images=1, image_size=2.0, annotations=100,
+                image_side=32, s3_latency=5.0, sm_latency=5.0, s3_bandwidth=0.0)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (MB if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def run_listing(study, output_dir):
+    from s3_index import build_index, FILE_KINDS
+
+    index = build_index(study.ds_ids)
+    return sum(len(index.files(ds_id, list(FILE_KINDS))) for ds_id in study.ds_ids), 0
+
+
+def run_aws_download_files(study, output_dir):
+    import mmit
+
+    mmit.aws_download_files(list(study.samples()), output_dir, 'ibd')
+    return len(study.datasets), study.total_bytes('.ibd')
+
+
+def run_get_all_files(study, output_dir):
+    import mmit
+
+    mmit.get_all_files(study.ds_ids, ['.imzML', '.ibd', '.jpg', '.jpeg', '.png'], output_dir)
+    return len(study.objects), study.total_bytes()
+
+
+def run_annotations(study, output_dir):
+    import mmit
+
+    mmit.aws_get_annotations(list(study.samples()), output_dir)
+    return len(study.datasets) * study.annotations, 0
+
+
+def run_new_study(study, output_dir):
+    from isa_api_client import IsaApiClient
+
+    IsaApiClient().new_study('Benchmark', 'Synthetic study', study.samples(), output_dir, persist=True)
+    return len(study.datasets), 0
+
+
+def setup_upload(study, output_dir):
+    # the files of the study on disk, as after -a
+    from standins import SyntheticObject
+
+    for key, size, seed in study.objects:
+        path = os.path.join(output_dir, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as data_file:
+            for chunk in SyntheticObject(size, seed).chunks(0, size - 1, 8 * MB):
+                data_file.write(chunk)
+
+
+def run_upload(study, output_dir):
+    import mmit
+
+    mmit.upload_files(output_dir, 'benchmark-upload', 'study')
+    return len(study.objects), study.total_bytes()
+
+
+def run_scenario(scenario, settings):
+    # runs in the child process; returns the scenario's results
+    logging.disable(logging.WARNING)
+    work_dir = tempfile.mkdtemp(prefix='mmit-benchmark-')
+    config.CACHE_DIR = os.path.join(work_dir, 'cache')
+    study = SyntheticStudy(datasets=settings['datasets'], imzml_size=int(settings['imzml_size'] * MB),
+                           ibd_size=int(settings['ibd_size'] * MB), images=settings['images'],
+                           image_size=int(settings['image_size'] * MB), annotations=settings['annotations'],
+                           image_shape=(settings['image_side'], settings['image_side']))
+    s3, sm = install(study, settings['s3_latency'] / 1000.0, settings['sm_latency'] / 1000.0,
+                     settings['s3_bandwidth'] * MB or None)
+    output_dir = os.path.join(work_dir, 'output')
+    if 'setup_' + scenario in globals():
+        globals()['setup_' + scenario](study, output_dir)
+    baseline = peak_rss_mb()
+    try:
+        start = time.perf_counter()
+        items, size = globals()['run_' + scenario](study, output_dir)
+        seconds = time.perf_counter() - start
+    except ImportError as exc:
+        return dict(scenario=scenario, skipped=str(exc))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return dict(scenario=scenario, seconds=round(seconds, 3), items=items,
+                items_per_second=round(items / seconds, 2), bytes=size, mb_per_second=round(size / MB / seconds, 2),
+                bytes_served=s3.bytes_served, bytes_received=s3.bytes_received,
+                s3=s3.latencies.percentiles(), metaspace=sm.latencies.percentiles(),
+                baseline_rss_mb=baseline, peak_rss_mb=peak_rss_mb())
+
+
+def run_child(scenario, settings):
+    with tempfile.NamedTemporaryFile('r', suffix='.json') as result_file:
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--run', scenario,
+                        '--settings', json.dumps(settings), '--result', result_file.name],
+                       stdout=subprocess.DEVNULL, check=True)
+        return json.load(result_file)
+
+
+def print_result(result):
+    if 'skipped' in result:
+        print('%-20s skipped: %s' % (result['scenario'], result['skipped']))
+        return
+    s3, metaspace = result['s3'], result['metaspace']
+    print('%-20s %8.3fs %10.1f items/s %8.1f MB/s  s3 p50/p99 %7.1f/%7.1f ms  sm p50/p99 %7.1f/%7.1f ms  '
+          'peak RSS %7.1f MB' % (result['scenario'], result['seconds'], result['items_per_second'],
+                                 result['mb_per_second'], s3.get('p50_ms', 0), s3.get('p99_ms', 0),
+                                 metaspace.get('p50_ms', 0), metaspace.get('p99_ms', 0), result['peak_rss_mb']))
+
+
+def compare(results, settings, previous_file, tolerance):
+    # True when no scenario is slower than in previous_file by more than tolerance
+    with open(previous_file) as data_file:
+        saved = json.load(data_file)
+    previous = dict((result['scenario'], result) for result in saved['results'])
+    ok = True
+    print()
+    print('Compared with %s:' % previous_file)
+    if saved.get('settings') != settings:
+        print('Warning: the settings differ from those of %s' % previous_file)
+    for result in results:
+        before = previous.get(result['scenario'])
+        if 'seconds' not in result or not before or 'seconds' not in before:
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        slower = change > tolerance
+        ok = ok and not slower
+        print('%-20s %8.3fs -> %8.3fs %+7.1f%%  peak RSS %7.1f -> %7.1f MB %s'
+              % (result['scenario'], before['seconds'], result['seconds'], change * 100, before['peak_rss_mb'],
+                 result['peak_rss_mb'], 'SLOWER' if slower else 'ok'))
+    return ok
+
+
+def main(argv):
+    settings = dict(SETTINGS)
+    scenarios = SCENARIOS
+    output = None
+    previous = None
+    tolerance = 0.1
+    run = result_file = None
+    long_options = [name.replace('_', '-') + '=' for name in SETTINGS] + \
+                   ['scenarios=', 'output=', 'compare=', 'tolerance=', 'run=', 'settings=', 'result=']
+    opts, args = getopt.getopt(argv, 'o:', long_options)
+    for opt, arg in opts:
+        name = opt.lstrip('-').replace('-', '_')
+        if name in SETTINGS:
+            settings[name] = type(SETTINGS[name])(arg)
+        if opt == '--scenarios':
+            scenarios = arg.split(',')
+        if opt in ('-o', '--output'):
+            output = arg
+        if opt == '--compare':
+            previous = arg
+        if opt == '--tolerance':
+            tolerance = float(arg)
+        if opt == '--run':
+            run = arg
+        if opt == '--settings':
+            settings = json.loads(arg)
+        if opt == '--result':
+            result_file = arg
+
+    if run:
+        with open(result_file, 'w') as data_file:
+            json.dump(run_scenario(run, settings), data_file)
+        return
+
+    print('Settings:', ', '.join('%s=%s' % item for item in sorted(settings.items())))
+    results = []
+    for scenario in scenarios:
+        result = run_child(scenario, settings)
+        print_result(result)
+        results.append(result)
+    if output:
+        with open(output, 'w') as data_file:
+            json.dump(dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                           platform=platform.platform(), settings=settings, results=results), data_file, indent=2)
+    if previous and not compare(results, settings, previous, tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,392 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+import clients
+
+# In-process stand-ins for S3 (boto3 low level client), METASPACE (SMInstance) and the molecular database,
+# serving synthetic datasets. Object contents are generated on demand from a repeating random block, so
+# serving gigabytes costs no memory; every request waits for the configured latency and is timed.
+# Uploaded objects are checked against their Content-MD5 and only their size and ETag are kept.
+
+BLOCK_SIZE = 1024 * 1024
+_BLOCK = random.Random(0).getrandbits(BLOCK_SIZE * 8).to_bytes(BLOCK_SIZE, 'little')
+MB = 1024 * 1024
+
+
+class Latencies(object):
+    # Durations of the requests made to a stand-in, in seconds
+
+    def __init__(self):
+        self.samples = []
+
+    def record(self, start):
+        self.samples.append(time.perf_counter() - start)
+
+    def percentiles(self, points=(50, 90, 99)):
+        samples = sorted(self.samples)
+        if not samples:
+            return dict(requests=0)
+        summary = dict(requests=len(samples), max_ms=round(samples[-1] * 1000, 3))
+        for point in points:
+            summary['p%d_ms' % point] = round(samples[min(len(samples) - 1, len(samples) * point // 100)] * 1000, 3)
+        return summary
+
+
+class SyntheticObject(object):
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.shift = seed * 7919 % BLOCK_SIZE
+        md5 = hashlib.md5()
+        for chunk in self.chunks(0, size - 1, 8 * MB):
+            md5.update(chunk)
+        self.etag = '"%s"' % md5.hexdigest()
+
+    def chunks(self, start, end, chunk_size):
+        position = start
+        while position <= end:
+            length = min(chunk_size, end - position + 1)
+            chunk = bytearray()
+            offset = (position + self.shift) % BLOCK_SIZE
+            while len(chunk) < length:
+                take = min(length - len(chunk), BLOCK_SIZE - offset)
+                chunk += _BLOCK[offset:offset + take]
+                offset = 0
+            position += length
+            yield bytes(chunk)
+
+
+class UploadedObject(object):
+
+    def __init__(self, size, etag):
+        self.size = size
+        self.etag = etag
+
+
+class FakeBody(object):
+
+    def __init__(self, obj, start, end, latencies, started, bandwidth=None):
+        self.obj = obj
+        self.start = start
+        self.end = end
+        self.latencies = latencies
+        self.started = started
+        self.bandwidth = bandwidth
+
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        for chunk in self.obj.chunks(self.start, self.end, chunk_size):
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+            yield chunk
+        self.latencies.record(self.started)
+
+    def read(self):
+        return b''.join(self.iter_chunks())
+
+
+class FakeS3Error(Exception):
+    # with the parsed response botocore's ClientError carries
+
+    def __init__(self, code, message):
+        Exception.__init__(self, '%s: %s' % (code, message))
+        self.response = {'Error': {'Code': code}}
+
+
+class FakePaginator(object):
+
+    def __init__(self, s3, name):
+        self.s3 = s3
+        self.name = name
+
+    def paginate(self, **kwargs):
+        return getattr(self, '_' + self.name)(**kwargs)
+
+    def _list_objects_v2(self, Bucket, Prefix=''):
+        keys = sorted(key for bucket, key in self.s3.objects if bucket == Bucket and key.startswith(Prefix))
+        for first in range(0, max(len(keys), 1), self.s3.page_size):
+            started = time.perf_counter()
+            time.sleep(self.s3.latency)
+            page = [dict(Key=key, Size=self.s3.objects[(Bucket, key)].size,
+                         ETag=self.s3.objects[(Bucket, key)].etag) for key in keys[first:first + self.s3.page_size]]
+            self.s3.latencies.record(started)
+            yield {'Contents': page} if page else {}
+
+    def _list_multipart_uploads(self, Bucket, Prefix=''):
+        started = time.perf_counter()
+        time.sleep(self.s3.latency)
+        uploads = [dict(Key=upload['Key'], UploadId=upload_id, Initiated=upload['Initiated'])
+                   for upload_id, upload in sorted(self.s3.uploads.items())
+                   if upload['Bucket'] == Bucket and upload['Key'].startswith(Prefix)]
+        self.s3.latencies.record(started)
+        yield {'Uploads': uploads} if uploads else {}
+
+    def _list_parts(self, Bucket, Key, UploadId):
+        started = time.perf_counter()
+        time.sleep(self.s3.latency)
+        parts = [dict(PartNumber=number, Size=size, ETag='"%s"' % digest.hex())
+                 for number, (size, digest) in sorted(self.s3.uploads[UploadId]['parts'].items())]
+        self.s3.latencies.record(started)
+        yield {'Parts': parts} if parts else {}
+
+
+class FakeS3(object):
+
+    def __init__(self, latency=0.0, bandwidth=None, page_size=1000):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.page_size = page_size
+        self.objects = {}
+        self.uploads = {}
+        self.latencies = Latencies()
+        self.bytes_served = 0
+        self.bytes_received = 0
+        self._upload_ids = 0
+        self._lock = threading.Lock()
+
+    def put(self, bucket, key, size, seed):
+        self.objects[(bucket, key)] = SyntheticObject(size, seed)
+
+    def _object(self, bucket, key, if_match=None):
+        obj = self.objects.get((bucket, key))
+        if obj is None:
+            raise FakeS3Error('NoSuchKey', '%s/%s' % (bucket, key))
+        if if_match and if_match != obj.etag:
+            raise FakeS3Error('PreconditionFailed', '%s/%s' % (bucket, key))
+        return obj
+
+    def get_paginator(self, name):
+        return FakePaginator(self, name)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        obj = self._object(Bucket, Key)
+        self.latencies.record(started)
+        return dict(ContentLength=obj.size, ETag=obj.etag)
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        obj = self._object(Bucket, Key, IfMatch)
+        start, end = 0, obj.size - 1
+        if Range:
+            first, last = Range[len('bytes='):].split('-')
+            start, end = int(first), min(int(last), obj.size - 1) if last else obj.size - 1
+        with self._lock:
+            self.bytes_served += end - start + 1
+        return dict(Body=FakeBody(obj, start, end, self.latencies, started, self.bandwidth),
+                    ContentLength=end - start + 1, ETag=obj.etag)
+
+    def _receive(self, body, content_md5=None):
+        # MD5 digest of a request body, after the time the stand-in takes to receive it
+        time.sleep(self.latency + (len(body) / self.bandwidth if self.bandwidth else 0))
+        digest = hashlib.md5(body).digest()
+        if content_md5 and base64.b64encode(digest).decode('ascii') != content_md5:
+            raise FakeS3Error('BadDigest', 'Content-MD5 does not match the body')
+        with self._lock:
+            self.bytes_received += len(body)
+        return digest
+
+    def put_object(self, Bucket, Key, Body, ContentMD5=None, **kwargs):
+        started = time.perf_counter()
+        etag = '"%s"' % self._receive(Body, ContentMD5).hex()
+        self.objects[(Bucket, Key)] = UploadedObject(len(Body), etag)
+        self.latencies.record(started)
+        return dict(ETag=etag)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        with self._lock:
+            self._upload_ids += 1
+            upload_id = 'upload-%06d' % self._upload_ids
+            self.uploads[upload_id] = dict(Bucket=Bucket, Key=Key, Initiated=time.time(), parts={})
+        self.latencies.record(started)
+        return dict(UploadId=upload_id)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5=None, **kwargs):
+        started = time.perf_counter()
+        digest = self._receive(Body, ContentMD5)
+        self.uploads[UploadId]['parts'][PartNumber] = (len(Body), digest)
+        self.latencies.record(started)
+        return dict(ETag='"%s"' % digest.hex())
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        upload = self.uploads.pop(UploadId)
+        parts = [upload['parts'][part['PartNumber']] for part in MultipartUpload['Parts']]
+        etag = '"%s-%d"' % (hashlib.md5(b''.join(digest for size, digest in parts)).hexdigest(), len(parts))
+        self.objects[(Bucket, Key)] = UploadedObject(sum(size for size, digest in parts), etag)
+        self.latencies.record(started)
+        return dict(ETag=etag)
+
+
+class FakeMetadata(object):
+
+    def __init__(self, metadata):
+        self.json = json.dumps(metadata)
+
+
+class FakeDataset(object):
+
+    def __init__(self, sm, ds_id, name, metadata, annotations=0, image_shape=(32, 32)):
+        self.sm = sm
+        self.id = ds_id
+        self.name = name
+        self.metadata = FakeMetadata(metadata)
+        self.s3dir = 's3a://%s/%s' % (SyntheticStudy.BUCKET, ds_id)
+        self.adducts = ['+H', '+Na', '+K']
+        self._baseurl = 'https://metaspace2020.eu'
+        self.annotation_count = annotations
+        self.image_shape = image_shape
+
+    def annotations(self, fdr=0.1, database=None):
+        self.sm.call()
+        return [('C%dH%dO%d' % (6 + i % 40, 12 + i % 17, 1 + i % 9), self.adducts[i % 3])
+                for i in range(self.annotation_count)]
+
+    def isotope_images(self, sf, adduct):
+        import numpy as np
+
+        self.sm.call()
+        rng = np.random.RandomState(abs(hash((self.id, sf, adduct))) % (2 ** 32))
+        image = rng.exponential(1.0, self.image_shape)
+        image[image < 0.5] = 0
+        return [image]
+
+
+class FakeGraphQLClient(object):
+
+    def __init__(self, sm):
+        self.sm = sm
+
+    def getRawOpticalImage(self, ds_id):
+        self.sm.call()
+        return {'rawOpticalImage': {'url': '/fs/optical_images/%s' % ds_id}}
+
+
+class FakeMolDB(object):
+
+    def __init__(self, sm):
+        self.sm = sm
+
+    def names(self, formula):
+        self.sm.call()
+        return ['molecule of %s' % formula]
+
+    def ids(self, formula):
+        self.sm.call()
+        return ['HMDB%07d' % (abs(hash(formula)) % 10000000)]
+
+
+class FakeMolDBClient(object):
+
+    def __init__(self, sm):
+        self.sm = sm
+
+    def getDatabase(self, database):
+        return FakeMolDB(self.sm)
+
+
+class FakeSMInstance(object):
+    # Datasets of study by id and name; unknown names are answered with an empty dataset
+
+    def __init__(self, study=None, latency=0.0):
+        self.study = study
+        self.latency = latency
+        self.latencies = Latencies()
+        self._gqclient = FakeGraphQLClient(self)
+        self._moldb_client = FakeMolDBClient(self)
+
+    def call(self):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        self.latencies.record(started)
+
+    def dataset(self, id=None, name=None):
+        self.call()
+        if self.study:
+            dataset = self.study.dataset(id, name)
+            if dataset:
+                return FakeDataset(self, metadata=dataset['metadata'], annotations=self.study.annotations,
+                                   image_shape=self.study.image_shape, ds_id=dataset['id'], name=dataset['name'])
+        return FakeDataset(self, 'ds-' + (name or id), name or id, {})
+
+
+class SyntheticStudy(object):
+    # datasets METASPACE datasets, each with one imzML, one ibd and images optical images in S3,
+    # annotations annotations with image_shape ion images
+
+    BUCKET = 'benchmark-bucket'
+
+    def __init__(self, datasets=8, imzml_size=MB, ibd_size=32 * MB, images=1, image_size=2 * MB,
+                 annotations=100, image_shape=(32, 32)):
+        self.annotations = annotations
+        self.image_shape = image_shape
+        self.datasets = []
+        self.objects = []
+        for i in range(datasets):
+            ds_id = '2020-01-01_00h00m%06ds' % i
+            name = 'benchmark_dataset_%06d' % i
+            metadata = {'Submitted_By': {'Institution': 'EMBL-EBI',
+                                         'Principal_Investigator': {'First_Name': 'Pat', 'Surname': 'Smith',
+                                                                    'Email': 'pat@example.org'},
+                                         'Submitter': {'First_Name': 'Sam', 'Surname': 'Jones',
+                                                       'Email': 'sam@example.org'}},
+                        'Sample_Information': {'Organism': 'Mus musculus', 'Organism_Part': 'Brain',
+                                               'Condition': 'Wildtype', 'Sample_Growth_Conditions': 'N/A'},
+                        'Sample_Preparation': {'Sample_Stabilisation': 'Fresh frozen', 'Tissue_Modification': 'N/A',
+                                               'MALDI_Matrix': 'DHB', 'MALDI_Matrix_Application': 'Sprayer',
+                                               'Solvent': 'ACN'},
+                        'MS_Analysis': {'Polarity': 'Positive', 'Ionisation_Source': 'MALDI',
+                                        'Analyzer': 'Orbitrap'},
+                        'metaspace_options': {'Dataset_Name': name}}
+            files = [(name + '.imzML', imzml_size), (name + '.ibd', ibd_size)]
+            files.extend(('optical_%d.jpg' % image, image_size) for image in range(images))
+            for file_name, size in files:
+                self.objects.append((ds_id + '/' + file_name, size, len(self.objects) + 1))
+            self.datasets.append(dict(id=ds_id, name=name, metadata=metadata))
+        self._by_id = dict((dataset['id'], dataset) for dataset in self.datasets)
+        self._by_name = dict((dataset['name'], dataset) for dataset in self.datasets)
+
+    def dataset(self, ds_id=None, name=None):
+        return self._by_id.get(ds_id) if ds_id else self._by_name.get(name)
+
+    @property
+    def ds_ids(self):
+        return [dataset['id'] for dataset in self.datasets]
+
+    def samples(self):
+        # the -i input JSON, as written by get_study_json
+        for dataset in self.datasets:
+            sample = dict(dataset['metadata'])
+            sample['ds_id'] = dataset['id']
+            prefix = '%s/%s/%s' % (self.BUCKET, dataset['id'], dataset['name'])
+            sample['s3dir'] = {'imzML': prefix + '.imzML', 'ibd': prefix + '.ibd'}
+            yield sample
+
+    def total_bytes(self, suffix=''):
+        return sum(size for key, size, seed in self.objects if key.endswith(suffix))
+
+
+def install(study=None, s3_latency=0.0, sm_latency=0.0, s3_bandwidth=None):
+    # Replace the S3 and METASPACE clients of the client registry with stand-ins serving study
+    s3 = FakeS3(s3_latency, s3_bandwidth)
+    for key, size, seed in (study.objects if study else []):
+        s3.put(SyntheticStudy.BUCKET, key, size, seed)
+    sm = FakeSMInstance(study, sm_latency)
+    cache.configure(enabled=False)
+    clients.reset()
+    clients._clients['s3'] = s3
+    clients._clients['sm'] = sm
+    return s3, sm
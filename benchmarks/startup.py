@@ -0,0 +1,87 @@
+import getopt
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+# Startup benchmark for the light weight commands of mmit.py: reports the slowest imports
+# (python -X importtime), checks that no heavy dependency is imported and that help/version/test-mode
+# runs stay under config.STARTUP_MAX_SECONDS. Exits with 1 when any check fails.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MMIT = os.path.join(ROOT, 'mmit.py')
+HEAVY_MODULES = ['boto3', 'botocore', 'requests', 'isatools', 'sm_annotation_utils', 'numpy', 'PIL']
+
+
+def import_times(args, top=15):
+    result = subprocess.run([sys.executable, '-X', 'importtime', MMIT] + args,
+                            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+
+def heavy_imports():
+    code = 'import sys, mmit; print(" ".join(m for m in %r if m in sys.modules))' % HEAVY_MODULES
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    return result.stdout.split()
+
+
+def wall_clock(args, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, MMIT] + args, cwd=ROOT, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return min(timings), sorted(timings)[len(timings) // 2]
+
+
+def main(argv):
+    repeat = 5
+    max_seconds = config.STARTUP_MAX_SECONDS
+    opts, args = getopt.getopt(argv, 'r:m:', ['repeat=', 'max-seconds='])
+    for opt, arg in opts:
+        if opt in ('-r', '--repeat'):
+            repeat = int(arg)
+        if opt in ('-m', '--max-seconds'):
+            max_seconds = float(arg)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as input_file:
+        json.dump([{'Submitted_By': {}, 'metaspace_options': {'Dataset_Name': 'benchmark'}}], input_file)
+    commands = [['-h'], ['-v'], ['-t', '-i', input_file.name]]
+
+    print('Slowest imports for -v (cumulative us, self us, module):')
+    for cumulative_us, self_us, name in import_times(['-v']):
+        print('%10d %10d %s' % (cumulative_us, self_us, name))
+    print()
+
+    failed = False
+    heavy = heavy_imports()
+    if heavy:
+        failed = True
+    print('Heavy modules imported by mmit:', ' '.join(heavy) or 'none')
+
+    for args in commands:
+        best, median = wall_clock(args, repeat)
+        over = median > max_seconds
+        failed = failed or over
+        print('%-40s best %.3fs median %.3fs %s' % (' '.join(args), best, median, 'SLOW' if over else 'ok'))
+    os.remove(input_file.name)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache(object):
+    # SQLite backed cache of JSON values (METASPACE dataset metadata, S3 listings) stored by namespace and key.
+    # Entries expire after ttl seconds; the least recently used ones are evicted above max_bytes.
+    # With refresh every lookup is a miss but the fetched values are stored again.
+
+    def __init__(self, path=config.CACHE_FILE, ttl=config.CACHE_TTL, max_bytes=config.CACHE_MAX_BYTES,
+                 refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value TEXT, size INTEGER, '
+                         'created REAL, accessed REAL, PRIMARY KEY (namespace, key))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self._db.commit()
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def get(self, namespace, key):
+        if self.refresh:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, created FROM cache WHERE namespace = ? AND key = ?',
+                                   (namespace, str(key))).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                return None
+            self._db.execute('UPDATE cache SET accessed = ? WHERE namespace = ? AND key = ?',
+                             (now, namespace, str(key)))
+            self._db.commit()
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value):
+        data = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT size FROM cache WHERE namespace = ? AND key = ?',
+                                   (namespace, str(key))).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+                             (namespace, str(key), data, len(data), now, now))
+            self._size += len(data) - (row[0] if row else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        # drop least recently used entries until the cache is back under 90% of max_bytes
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for namespace, key, size in self._db.execute(
+                'SELECT namespace, key, size FROM cache ORDER BY accessed').fetchall():
+            if self._size <= target:
+                break
+            self._db.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (namespace, key))
+            self._size -= size
+            evicted += 1
+        logger.info("Evicted %d cache entries from %s", evicted, self.path)
+
+    def get_or_fetch(self, namespace, key, fetch, refresh=False):
+        # with refresh the value is fetched, and stored, even if it is in the cache
+        value = None if refresh else self.get(namespace, key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+        with self._lock:
+            self.misses += 1
+        value = fetch()
+        self.set(namespace, key, value)
+        return value
+
+    def log_stats(self):
+        if self.hits or self.misses:
+            logger.info("Metadata cache %s: %d hits, %d misses", self.path, self.hits, self.misses)
+
+
+class NoCache(object):
+    # Stand in used with --no-cache: every lookup goes to the services
+
+    hits = 0
+    misses = 0
+
+    def get_or_fetch(self, namespace, key, fetch, refresh=False):
+        return fetch()
+
+    def log_stats(self):
+        pass
+
+
+_cache = None
+_enabled = True
+_refresh = False
+_lock = threading.Lock()
+
+
+def configure(enabled=True, refresh=False):
+    global _enabled, _refresh, _cache
+    _enabled, _refresh, _cache = enabled, refresh, None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                cache = MetadataCache(refresh=_refresh) if _enabled else NoCache()
+                atexit.register(cache.log_stats)
+                _cache = cache
+    return _cache
+
+
+def is_enabled():
+    return _enabled
+
+
+def is_refresh():
+    return _refresh
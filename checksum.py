@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import math
+import os
+
+import config
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+CHECKSUM_SUFFIX = '.checksums.json'
+
+
+class ChecksumError(IOError):
+    pass
+
+
+def etag_part_count(etag):
+    # number of parts of a multipart upload ETag ("<md5 of part md5s>-<parts>"), None for a plain MD5 ETag
+    value = (etag or '').strip('"')
+    if '-' not in value:
+        return None
+    return int(value.rsplit('-', 1)[1])
+
+
+def etag_part_sizes(size, parts):
+    # upload part sizes giving that number of parts for an object of that size, most likely first
+    if not parts or not size:
+        return []
+    candidates = []
+    guess = int(math.ceil(size / float(parts) / MB)) * MB
+    for part_size in [guess] + [part_size_mb * MB for part_size_mb in config.CHECKSUM_PART_SIZES_MB]:
+        if part_size not in candidates and int(math.ceil(size / float(part_size))) == parts:
+            candidates.append(part_size)
+    return candidates[:config.CHECKSUM_MAX_CANDIDATES]
+
+
+def multipart_etag(part_md5s):
+    return '%s-%d' % (hashlib.md5(b''.join(part_md5s)).hexdigest(), len(part_md5s))
+
+
+class _PartMd5(object):
+    # MD5 of each part_size block of a stream, for multipart ETags
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.digests = []
+        self._md5 = hashlib.md5()
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            take = min(len(view), self.part_size - self._filled)
+            self._md5.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.part_size:
+                self.digests.append(self._md5.digest())
+                self._md5 = hashlib.md5()
+                self._filled = 0
+
+    def etag(self):
+        return multipart_etag(self.digests + ([self._md5.digest()] if self._filled else []))
+
+
+class StreamDigest(object):
+    # MD5 and SHA-256 of a stream of bytes fed in order, plus the multipart ETags it would have
+    # for the upload part sizes guessed from etag
+
+    def __init__(self, etag=None, size=None):
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self._parts = [_PartMd5(part_size) for part_size in etag_part_sizes(size, etag_part_count(etag))]
+
+    def update(self, chunk):
+        self.md5.update(chunk)
+        self.sha256.update(chunk)
+        for part in self._parts:
+            part.update(chunk)
+
+    def wrap(self, chunks):
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    def update_from_file(self, path, offset, length, chunk_size=config.DOWNLOAD_CHUNK_SIZE):
+        with open(path, 'rb') as data_file:
+            data_file.seek(offset)
+            while length > 0:
+                chunk = data_file.read(min(chunk_size, length))
+                if not chunk:
+                    raise IOError("Unexpected end of %s" % path)
+                self.update(chunk)
+                length -= len(chunk)
+
+    def result(self):
+        checksums = dict(md5=self.md5.hexdigest(), sha256=self.sha256.hexdigest())
+        if self._parts:
+            checksums['etags'] = dict((part.part_size, part.etag()) for part in self._parts)
+        return checksums
+
+
+class PartDigest(object):
+    # MD5 and SHA-256 of one byte range of a ranged download
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+
+    def wrap(self, chunks):
+        for chunk in chunks:
+            self.md5.update(chunk)
+            self.sha256.update(chunk)
+            yield chunk
+
+    def hexdigests(self):
+        return self.md5.hexdigest(), self.sha256.hexdigest()
+
+
+def combine_part_digests(part_digests, part_size):
+    # part_digests: (md5, sha256) hex digests of the parts in offset order. The MD5s combine into the
+    # multipart ETag S3 gives an object uploaded with the same part size; the SHA-256s into a composite
+    # SHA-256 (SHA-256 of the part SHA-256s).
+    return dict(part_size=part_size, parts=len(part_digests),
+                multipart_etag=multipart_etag([bytes.fromhex(md5) for md5, sha256 in part_digests]),
+                sha256_composite=hashlib.sha256(b''.join(bytes.fromhex(sha256)
+                                                         for md5, sha256 in part_digests)).hexdigest())
+
+
+def verify_etag(checksums, etag):
+    # True if the checksums match the ETag, False if they do not, None if the ETag cannot be checked
+    value = (etag or '').strip('"')
+    if not value:
+        return None
+    if etag_part_count(etag) is None:
+        return checksums['md5'] == value if 'md5' in checksums else None
+    candidates = list(checksums.get('etags', {}).values())
+    if 'multipart_etag' in checksums:
+        candidates.append(checksums['multipart_etag'])
+    if value in candidates:
+        return True
+    # the upload part size is only guessed, a mismatch does not prove the file is corrupt
+    return None
+
+
+def write_sidecar(path, filename, checksums):
+    sidecar = os.path.join(path, filename + CHECKSUM_SUFFIX)
+    with open(sidecar, 'w') as data_file:
+        json.dump(checksums, data_file, indent=2, sort_keys=True)
+    return sidecar
@@ -0,0 +1,78 @@
+import logging
+import threading
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Process wide registry of the service clients, created on first use and shared by every command and
+# worker thread. boto3 low level clients are thread safe, resources and sessions are not.
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                logger.info("Creating %s client", name)
+                client = factory()
+                _clients[name] = client
+    return client
+
+
+def _create_s3_client():
+    import boto3
+    from botocore.config import Config
+    from aws_client import AwsCredentials
+
+    aws_cred = AwsCredentials()
+    session = boto3.Session(aws_cred.get_access_key, aws_cred.get_secret_access_key)
+    return session.client('s3', config=Config(max_pool_connections=config.S3_MAX_POOL_CONNECTIONS,
+                                              retries={'max_attempts': config.S3_MAX_ATTEMPTS,
+                                                       'mode': 'standard'}))
+
+
+def _create_sm():
+    from sm_annotation_utils.sm_annotation_utils import SMInstance
+
+    return SMInstance()  # connect to the main metaspace service
+
+
+def _create_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    retries = Retry(total=config.HTTP_MAX_ATTEMPTS, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=config.HTTP_POOL_SIZE, pool_maxsize=config.HTTP_POOL_SIZE,
+                          max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_s3_client():
+    return _get('s3', _create_s3_client)
+
+
+def get_sm():
+    return _get('sm', _create_sm)
+
+
+def get_http_session():
+    return _get('http', _create_http_session)
+
+
+def get_moldb(database=config.DATABASE):
+    # connect to the molecular database service
+    return _get('moldb:' + database, lambda: get_sm()._moldb_client.getDatabase(database))
+
+
+def reset():
+    with _lock:
+        _clients.clear()
@@ -1,3 +1,5 @@
+import os
+
 # General app settings
 APP_NAME = "MMIT"
 APP_DESCRIPTION = "METASPACE-MetaboLights Interface Tools"
@@ -9,6 +11,105 @@ APP_VERSION = "0.5.0"
 
 # AWS Cloud
 AWS_CREDENTIALS = 'aws_credentials.cfg'
+# Connections kept open by the shared S3 client and attempts made by botocore for each request
+S3_MAX_POOL_CONNECTIONS = 64
+S3_MAX_ATTEMPTS = 3
+# Size of the chunks read from S3/HTTP response bodies and written to disk
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Compute MD5/SHA-256 while downloading, check them against the S3 ETag and write <file>.checksums.json.
+# Multipart ETags are checked by guessing the upload part size, trying the sizes below (MB) after the
+# size implied by the number of parts.
+CHECKSUM_ENABLED = True
+CHECKSUM_PART_SIZES_MB = (8, 5, 16, 15, 64, 100, 128)
+CHECKSUM_MAX_CANDIDATES = 3
+# Objects bigger than MULTIPART_THRESHOLD are fetched as concurrent byte ranges of MULTIPART_PART_SIZE, and
+# files bigger than that uploaded as multipart uploads of parts of that size
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MULTIPART_CONCURRENCY = 8
+# Files left out by --upload (fnmatch patterns of file and folder names): the manifests, claims, checksums and
+# partial files mmit keeps in its output folders
+UPLOAD_EXCLUDE = ('.mmit_*', '*.part', '*.link', '*.checksums.json')
+# Transfer scheduler: files/datasets processed at once, in total and per bucket, and total bandwidth cap
+# in bytes per second (None for no cap). Requests throttled by S3 are retried with exponential backoff.
+SCHEDULER_MAX_WORKERS = 8
+SCHEDULER_BUCKET_WORKERS = 4
+SCHEDULER_MAX_BANDWIDTH = None
+SCHEDULER_MAX_ATTEMPTS = 6
+SCHEDULER_BACKOFF_BASE = 0.5
+SCHEDULER_BACKOFF_MAX = 30
+# Datasets looked up and S3 prefixes listed at once when building the listing index
+LISTING_MAX_WORKERS = 16
+# Study pipeline (-s ... --pipeline): workers of each stage, size of the queues between stages and seconds
+# between progress reports
+PIPELINE_STAGE_WORKERS = {'metadata': 8, 'listing': 8, 'download': 4}
+PIPELINE_QUEUE_SIZE = 32
+PIPELINE_REPORT_INTERVAL = 30
+# Claims on work items (--shard ... --claim) not refreshed for this many seconds can be taken over, and how long
+# a node waits at the end of its run for the items still claimed by other nodes before leaving them unfinished
+SHARD_CLAIM_STALE_SECONDS = 600
+SHARD_CLAIM_MAX_WAIT = 3600
+
+# Local cache of METASPACE dataset metadata and S3 listings: location, time to live in seconds and size limit
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mmit')
+CACHE_FILE = os.path.join(CACHE_DIR, 'metadata.sqlite')
+CACHE_TTL = 24 * 3600
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Shared store of downloaded objects keyed by ETag and size (--store), its size limit before the least recently
+# used objects are removed, and how stored files are placed in the output folder, in order of preference
+STORE_DIR = None
+STORE_MAX_BYTES = 500 * 1024 * 1024 * 1024
+STORE_LINK_MODES = ('hardlink', 'reflink', 'copy')
+
+# Optical images: HTTP connection pool, request timeout in seconds, retries, concurrent downloads, the
+# folder of local copies revalidated with If-None-Match/If-Modified-Since (linked into the output folders
+# like stored objects) and its size limit before the least recently used copies are removed
+HTTP_POOL_SIZE = 16
+HTTP_TIMEOUT = 60
+HTTP_MAX_ATTEMPTS = 3
+IMAGE_MAX_WORKERS = 8
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, 'http')
+HTTP_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Deep Zoom tile pyramids and thumbnails of the optical images (--tiles), built in IMAGE_TILE_WORKERS processes
+IMAGE_TILE_SIZE = 256
+IMAGE_TILE_QUALITY = 85
+IMAGE_THUMBNAIL_SIZE = 512
+IMAGE_TILE_WORKERS = os.cpu_count() or 1
+
+# Datasets of the ISA-Tab samples resolved at once while streaming s_study.txt and a_assay.txt
+ISA_TAB_MAX_WORKERS = 8
 
 DATABASE = "HMDB-v4"
 FDR = 0.1
+# Molecule names/ids per formula kept for DATABASE (saved in CACHE_DIR for CACHE_TTL) and concurrent lookups
+MOLDB_CACHE_MAX_ENTRIES = 100000
+MOLDB_MAX_WORKERS = 8
+# Bytes of the float64 stack of ion images processed together when computing annotation image statistics; peak memory
+# is about 1.2x this (the stack, its boolean mask of an eighth of it, one image's working copy) plus the
+# ION_IMAGE_MAX_WORKERS images being fetched
+ION_IMAGE_BATCH_BYTES = 256 * 1024 * 1024
+ION_IMAGE_MAX_WORKERS = 8
+ION_IMAGE_PERCENTILES = (50, 90, 99)
+# Annotation export rows buffered between flushes to disk
+EXPORT_FLUSH_ROWS = 1000
+# Characters read at a time when streaming the samples of the -i study JSON file
+JSON_READ_CHUNK_SIZE = 1024 * 1024
+
+# imzML reader: elements of the .ibd file gathered at once when building ion images and TIC maps
+IMZML_READ_BATCH_ELEMENTS = 8 * 1024 * 1024
+
+# Pixel extraction (--extract): byte ranges closer than EXTRACT_MERGE_GAP bytes are fetched with one
+# request of at most EXTRACT_MAX_RANGE bytes, EXTRACT_MAX_WORKERS requests at once
+EXTRACT_MERGE_GAP = 256 * 1024
+EXTRACT_MAX_RANGE = 16 * 1024 * 1024
+EXTRACT_MAX_WORKERS = 16
+EXTRACT_WORK_DIR = '.mmit_extract'
+
+# Prometheus textfile written at exit (--metrics-file), None for none; functions listed by --profile
+METRICS_FILE = None
+PROFILE_TOP = 40
+
+# Maximum wall-clock time in seconds allowed for help/version/test-mode runs (benchmarks/startup.py)
+STARTUP_MAX_SECONDS = 0.5
@@ -0,0 +1,46 @@
+import logging
+
+from aws_client import list_objects
+from cache import get_cache
+from clients import get_sm
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# METASPACE dataset information and S3 listings, served from the local metadata cache when possible
+
+
+def get_dataset_info(ds_id=None, name=None):
+    def fetch():
+        with timed('metaspace.dataset'):
+            ds = get_sm().dataset(id=ds_id, name=name)
+        return dict(id=ds.id, name=ds.name, metadata=ds.metadata.json, s3dir=ds.s3dir,
+                    adducts=ds.adducts, baseurl=ds._baseurl)
+
+    key = 'id:' + ds_id if ds_id else 'name:' + name
+    return get_cache().get_or_fetch('dataset', key, fetch)
+
+
+def get_optical_image_path(ds_info):
+    def fetch():
+        with timed('metaspace.optical_image'):
+            opt_im = get_sm()._gqclient.getRawOpticalImage(ds_info['id'])['rawOpticalImage']
+        return dict(url=opt_im['url'] if opt_im else None)
+
+    return get_cache().get_or_fetch('optical-image', ds_info['id'], fetch)['url']
+
+
+def get_s3_location(ds_info):
+    aws_path = ds_info['s3dir'][6:]  # strip s3a://
+    bucket_name, ds_name = aws_path.split('/', 1)
+    return aws_path, bucket_name, ds_name
+
+
+def list_dataset_objects(bucket_name, prefix, refresh=False):
+    # Transfers list with refresh: the Size and ETag of the objects are used for IfMatch and to skip
+    # unchanged files, so they must not come from a listing cached before the objects changed
+    def fetch():
+        return [dict(Key=obj['Key'], Size=obj['Size'], ETag=obj['ETag'])
+                for obj in list_objects(bucket_name, prefix)]
+
+    return get_cache().get_or_fetch('s3-listing', bucket_name + '/' + prefix, fetch, refresh)
@@ -0,0 +1,78 @@
+import logging
+import os
+import time
+
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+PART_SUFFIX = '.part'
+
+
+def part_file_name(path, filename):
+    return os.path.join(path, filename + PART_SUFFIX)
+
+
+def _write(data_file, chunk):
+    # only the time spent writing is recorded, not the time waiting for the chunks
+    start = time.perf_counter()
+    data_file.write(chunk)
+    observe('disk.write', time.perf_counter() - start, len(chunk))
+
+
+def save_stream(chunks, path, filename, append=False, keep_partial=False):
+    # Write an iterable of byte chunks to <filename>.part and move it into place once complete,
+    # so a half written download never shows up under its final name.
+    # With append the chunks continue an existing .part file; keep_partial leaves it on failure for a resume.
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    part_file = part_file_name(path, filename)
+    logger.info("Saving file %s %s (stream)", path, filename)
+    try:
+        with open(part_file, 'ab' if append else 'wb') as data_file:
+            for chunk in chunks:
+                if chunk:
+                    _write(data_file, chunk)
+    except BaseException:
+        if not keep_partial:
+            discard_part_file(path, filename)
+        raise
+    return commit_part_file(path, filename)
+
+
+def preallocate_part_file(path, filename, size):
+    # Create <filename>.part with its final size so parts can be written at their offsets
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    part_file = part_file_name(path, filename)
+    with open(part_file, 'wb') as data_file:
+        data_file.truncate(size)
+    return part_file
+
+
+def write_at(part_file, offset, chunks):
+    written = 0
+    with open(part_file, 'r+b') as data_file:
+        data_file.seek(offset)
+        for chunk in chunks:
+            if chunk:
+                _write(data_file, chunk)
+                written += len(chunk)
+    return written
+
+
+def commit_part_file(path, filename):
+    target = os.path.join(path, filename)
+    os.replace(part_file_name(path, filename), target)
+    return target
+
+
+def part_file_size(path, filename):
+    part_file = part_file_name(path, filename)
+    return os.path.getsize(part_file) if os.path.exists(part_file) else None
+
+
+def discard_part_file(path, filename):
+    part_file = part_file_name(path, filename)
+    if os.path.exists(part_file):
+        os.remove(part_file)
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import config
+from clients import get_http_session
+from file_utils import save_stream
+from metrics import timed
+from object_store import place
+
+logger = logging.getLogger(__name__)
+
+
+class HttpCache(object):
+    # Local copies of files downloaded over HTTP, stored by URL under path with their ETag and
+    # Last-Modified headers. A cached URL is requested again with If-None-Match/If-Modified-Since and
+    # only downloaded when the server answers with something else than 304 Not Modified.
+    # Local copies are hard linked (or reflinked, or copied, in the order of modes) to their targets and
+    # the least recently used ones are removed above max_bytes; linked targets stay where they are.
+    # With enabled False every file is downloaded straight to its target; with refresh the validators
+    # are not sent but the new copies are stored.
+
+    def __init__(self, path=config.HTTP_CACHE_DIR, enabled=True, refresh=False,
+                 chunk_size=config.DOWNLOAD_CHUNK_SIZE, timeout=config.HTTP_TIMEOUT,
+                 max_bytes=config.HTTP_CACHE_MAX_BYTES, modes=config.STORE_LINK_MODES):
+        self.path = path
+        self.enabled = enabled
+        self.refresh = refresh
+        self.max_bytes = max_bytes
+        self.modes = modes
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _entry(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return key, os.path.join(self.path, key + '.json')
+
+    def _read_entry(self, url):
+        key, entry_file = self._entry(url)
+        if self.refresh or not os.path.exists(entry_file) or not os.path.exists(os.path.join(self.path, key)):
+            return None
+        with open(entry_file) as data_file:
+            entry = json.load(data_file)
+        return entry if entry.get('url') == url else None
+
+    def _write_entry(self, url, response, size):
+        key, entry_file = self._entry(url)
+        entry = dict(url=url, etag=response.headers.get('ETag'),
+                     last_modified=response.headers.get('Last-Modified'), size=size)
+        with open(entry_file + '.part', 'w') as data_file:
+            json.dump(entry, data_file)
+        os.replace(entry_file + '.part', entry_file)
+
+    def _entries(self):
+        # (last use, key, size) of every local copy, last used when its entry was written or revalidated
+        entries = []
+        for name in os.listdir(self.path) if os.path.isdir(self.path) else []:
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                entries.append((os.path.getmtime(os.path.join(self.path, name)), key,
+                                os.path.getsize(os.path.join(self.path, key))))
+            except OSError:
+                pass  # removed by another process, or its copy is missing
+        return entries
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry_size for used, key, entry_size in self._entries())
+            else:
+                self._size += size
+            over = self._size > self.max_bytes
+        if over:
+            self.collect_garbage()
+
+    def collect_garbage(self):
+        # remove the least recently used copies until the cache is back under 90% of max_bytes
+        entries = sorted(self._entries())
+        size = sum(entry_size for used, key, entry_size in entries)
+        target = self.max_bytes * 0.9
+        removed = freed = 0
+        for used, key, entry_size in entries:
+            if size <= target:
+                break
+            for name in (key + '.json', key):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass  # removed by another process
+            size -= entry_size
+            freed += entry_size
+            removed += 1
+        with self._lock:
+            self._size = size
+        if removed:
+            logger.info("Removed %d file(s), %d bytes from the HTTP cache %s", removed, freed, self.path)
+        return removed
+
+    def _count(self, hit, size):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += size
+            else:
+                self.misses += 1
+                self.bytes_downloaded += size
+
+    def fetch(self, url, out_path, filename):
+        # Save url as out_path/filename, from the local copy when it is still current
+        entry = self._read_entry(url) if self.enabled else None
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        with timed('http.get'):
+            response = get_http_session().get(url, headers=headers, stream=True, timeout=self.timeout)
+        with response:
+            if entry and response.status_code == 304:
+                logger.info("Not modified %s", url)
+                self._count(True, entry['size'])
+                os.utime(self._entry(url)[1])
+                return self._link_to(url, out_path, filename)
+            response.raise_for_status()
+            size = [0]
+
+            def chunks():
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    size[0] += len(chunk)
+                    yield chunk
+
+            if not self.enabled:
+                target = save_stream(chunks(), out_path, filename)
+                self._count(False, size[0])
+                return target
+            key = self._entry(url)[0]
+            save_stream(chunks(), self.path, key)
+            self._write_entry(url, response, size[0])
+            self._count(False, size[0])
+        target = self._link_to(url, out_path, filename)
+        self._added(size[0])
+        return target
+
+    def _link_to(self, url, out_path, filename):
+        # a target already linked to the local copy, or copied after it was stored, is left untouched,
+        # so its mtime still tells when it last changed
+        target = os.path.join(out_path, filename)
+        cached = os.path.join(self.path, self._entry(url)[0])
+        if os.path.exists(target):
+            target_stat, cached_stat = os.stat(target), os.stat(cached)
+            if os.path.samestat(target_stat, cached_stat) or \
+                    (target_stat.st_size == cached_stat.st_size and target_stat.st_mtime >= cached_stat.st_mtime):
+                logger.info("Unchanged %s", target)
+                return target
+        place(cached, target, self.modes)
+        return target
+
+    def log_stats(self):
+        if self.hits or self.misses:
+            logger.info("HTTP cache %s: %d hits, %d misses, %d bytes downloaded, %d bytes saved",
+                        self.path, self.hits, self.misses, self.bytes_downloaded, self.bytes_saved)
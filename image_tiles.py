@@ -0,0 +1,127 @@
+import json
+import logging
+import math
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+
+logger = logging.getLogger(__name__)
+
+DZI_TEMPLATE = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+               '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="jpg" Overlap="0" TileSize="%d">' \
+               '<Size Width="%d" Height="%d"/></Image>\n'
+SOURCE_FILE = 'source.json'
+# levels down to this scale are decoded from the file, smaller ones are resized from the last of them
+MAX_DRAFT_SCALE = 8
+
+
+def pyramid_paths(image_path):
+    # (<image>.dzi, <image>_files, <image>_thumb.jpg) next to the image
+    base = os.path.splitext(image_path)[0]
+    return base + '.dzi', base + '_files', base + '_thumb.jpg'
+
+
+def _source(image_path, tile_size, quality, thumbnail_size):
+    stat = os.stat(image_path)
+    return dict(size=stat.st_size, mtime=stat.st_mtime, tile_size=tile_size, quality=quality,
+                thumbnail_size=thumbnail_size)
+
+
+def is_current(image_path, source):
+    dzi_file, tiles_dir, thumbnail_file = pyramid_paths(image_path)
+    if not (os.path.exists(dzi_file) and os.path.exists(thumbnail_file)):
+        return False
+    try:
+        with open(os.path.join(tiles_dir, SOURCE_FILE)) as data_file:
+            return json.load(data_file) == source
+    except (IOError, ValueError):
+        return False
+
+
+def _decode(image_path, size):
+    # Decode the image at about size, letting the JPEG decoder scale down by up to 8 (draft)
+    # instead of decoding all the pixels, then resize the rest of the way (reduce first)
+    from PIL import Image
+
+    image = Image.open(image_path)
+    image.draft('RGB', size)
+    image = image.convert('RGB')
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    return image
+
+
+def _save_tiles(image, level_dir, tile_size, quality):
+    os.makedirs(level_dir)
+    width, height = image.size
+    for column, left in enumerate(range(0, width, tile_size)):
+        for row, top in enumerate(range(0, height, tile_size)):
+            tile = image.crop((left, top, min(left + tile_size, width), min(top + tile_size, height)))
+            tile.save(os.path.join(level_dir, '%d_%d.jpg' % (column, row)), 'JPEG', quality=quality)
+
+
+def build_pyramid(image_path, tile_size=config.IMAGE_TILE_SIZE, quality=config.IMAGE_TILE_QUALITY,
+                  thumbnail_size=config.IMAGE_THUMBNAIL_SIZE):
+    # Write a Deep Zoom pyramid (<image>.dzi and <image>_files/<level>/<column>_<row>.jpg) and a
+    # thumbnail of image_path. Each level is decoded at its own size, from the smallest up; only the
+    # last, full resolution level needs all the pixels of the image.
+    # Returns False when the pyramid of the same file and settings already exists.
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = None  # optical images are legitimately huge
+    source = _source(image_path, tile_size, quality, thumbnail_size)
+    if is_current(image_path, source):
+        return False
+    dzi_file, tiles_dir, thumbnail_file = pyramid_paths(image_path)
+    with Image.open(image_path) as image:
+        width, height = image.size
+        image.draft('RGB', (thumbnail_size, thumbnail_size))
+        image.thumbnail((thumbnail_size, thumbnail_size), Image.LANCZOS)
+        image.convert('RGB').save(thumbnail_file + '.part', 'JPEG', quality=quality)
+    os.replace(thumbnail_file + '.part', thumbnail_file)
+
+    max_level = int(math.ceil(math.log(max(width, height, 1), 2)))
+    work_dir = tiles_dir + '.part'
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    draft_image = None
+    for level in range(max_level + 1):
+        scale = 2 ** (max_level - level)
+        size = (max(int(math.ceil(width / scale)), 1), max(int(math.ceil(height / scale)), 1))
+        if scale > MAX_DRAFT_SCALE:
+            if draft_image is None:
+                draft_image = _decode(image_path, (int(math.ceil(width / MAX_DRAFT_SCALE)),
+                                                   int(math.ceil(height / MAX_DRAFT_SCALE))))
+            level_image = draft_image.resize(size, Image.LANCZOS)
+        else:
+            level_image = _decode(image_path, size)
+        _save_tiles(level_image, os.path.join(work_dir, str(level)), tile_size, quality)
+        del level_image
+    with open(os.path.join(work_dir, SOURCE_FILE), 'w') as data_file:
+        json.dump(source, data_file)
+    shutil.rmtree(tiles_dir, ignore_errors=True)
+    os.replace(work_dir, tiles_dir)
+    with open(dzi_file, 'w') as data_file:
+        data_file.write(DZI_TEMPLATE % (tile_size, width, height))
+    return True
+
+
+def build_pyramids(image_paths, max_workers=config.IMAGE_TILE_WORKERS, **kwargs):
+    # Build the pyramids of new or changed images in a process pool; returns the number built
+    image_paths = [path for path in image_paths if path]
+    built = failed = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict((executor.submit(build_pyramid, path, **kwargs), path) for path in image_paths)
+        for future, path in futures.items():
+            try:
+                if future.result():
+                    built += 1
+                    logger.info("Built tile pyramid of %s", path)
+            except Exception:
+                failed += 1
+                logger.exception("Failed to build the tile pyramid of %s", path)
+    logger.info("Tile pyramids: %d built, %d unchanged, %d failed", built, len(image_paths) - built - failed,
+                failed)
+    return built
@@ -0,0 +1,199 @@
+import hashlib
+import logging
+import os
+import uuid
+from xml.etree.ElementTree import iterparse, tostring
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+import config
+from aws_client import head_object, download_object, download_byte_ranges
+from file_utils import save_stream, preallocate_part_file, discard_part_file
+from imzml_reader import ImzMLReader, local_name, cv_params, binary_array_params, array_kind, \
+    MZ_ARRAY, EXTERNAL_OFFSET, EXTERNAL_ARRAY_LENGTH, EXTERNAL_ENCODED_LENGTH
+from manifest import TransferManifest
+
+logger = logging.getLogger(__name__)
+
+UUID_PARAM = 'IMS:1000080'
+MD5_PARAM = 'IMS:1000090'
+SHA1_PARAM = 'IMS:1000091'
+UUID_SIZE = 16
+
+
+def parse_roi(value):
+    # "x0:x1,y0:y1" (inclusive, 1-based pixel coordinates) or "x,y" for a single pixel
+    bounds = []
+    for axis in value.split(','):
+        low, _, high = axis.partition(':')
+        bounds.append((int(low), int(high or low)))
+    if len(bounds) != 2:
+        raise ValueError("Expected x0:x1,y0:y1 but got %s" % value)
+    return bounds[0] + bounds[1]
+
+
+def select_pixels(index, roi):
+    x0, x1, y0, y1 = roi
+    return np.flatnonzero((index.x >= x0) & (index.x <= x1) & (index.y >= y0) & (index.y <= y1))
+
+
+def pixel_ranges(index, pixels):
+    # (start, end) inclusive byte ranges of the m/z and intensity arrays of the pixels
+    ranges = []
+    for offsets, lengths, dtype in ((index.mz_offsets, index.mz_lengths, index.mz_dtype),
+                                    (index.int_offsets, index.int_lengths, index.int_dtype)):
+        sizes = lengths[pixels] * dtype.itemsize
+        starts = offsets[pixels][sizes > 0]
+        ranges.extend(zip(starts.tolist(), (starts + sizes[sizes > 0] - 1).tolist()))
+    return ranges
+
+
+def coalesce_ranges(ranges, max_gap=config.EXTRACT_MERGE_GAP, max_size=config.EXTRACT_MAX_RANGE):
+    # Merge overlapping ranges and ranges less than max_gap bytes apart, up to max_size bytes per request
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1 + max_gap and max(end, merged[-1][1]) - merged[-1][0] < max_size:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def write_subset(reader, pixels, out_path, file_name):
+    # Write the spectra of the pixels to <file_name>.ibd and a copy of the imzML describing only them
+    # to <file_name>.imzML. Returns the path of the new imzML.
+    index = reader.index
+    file_uuid = uuid.uuid4()
+    md5, sha1 = hashlib.md5(), hashlib.sha1()
+    offsets = {}
+
+    def ibd_chunks():
+        for chunk in spectra_chunks():
+            md5.update(chunk)
+            sha1.update(chunk)
+            yield chunk
+
+    def spectra_chunks():
+        yield file_uuid.bytes
+        position = UUID_SIZE
+        shared_mz = None
+        for i in pixels:
+            mz, intensities = reader.spectrum(i)
+            if index.mode == 'continuous' and shared_mz is not None:
+                mz_offset = shared_mz
+            else:
+                mz_offset = shared_mz = position
+                yield mz.tobytes()
+                position += mz.nbytes
+            offsets[i] = (mz_offset, position)
+            yield intensities.tobytes()
+            position += intensities.nbytes
+
+    save_stream(ibd_chunks(), out_path, file_name + '.ibd')
+    fingerprints = {UUID_PARAM: '{%s}' % str(file_uuid).upper(), MD5_PARAM: md5.hexdigest().upper(),
+                    SHA1_PARAM: sha1.hexdigest().upper()}
+    return save_stream((text.encode('utf-8') for text in _subset_imzml(reader.imzml_path, index, offsets,
+                                                                        len(pixels), fingerprints)),
+                       out_path, file_name + '.imzML')
+
+
+def _start_tag(element, namespaces=()):
+    prefixes = dict((uri, prefix) for prefix, uri in namespaces)
+    attributes = ['xmlns%s=%s' % (':' + prefix if prefix else '', quoteattr(uri)) for prefix, uri in namespaces]
+    for key, value in element.attrib.items():
+        if key.startswith('{'):
+            uri, name = key[1:].split('}', 1)
+            key = prefixes.get(uri, '') + ':' + name if prefixes.get(uri) else name
+        attributes.append('%s=%s' % (key, quoteattr(value)))
+    return '<%s>' % ' '.join([local_name(element.tag)] + attributes)
+
+
+def _subset_imzml(imzml_path, index, offsets, count, fingerprints):
+    # Stream the imzML again, keeping the header and the spectra of the selected pixels only
+    namespaces = []
+    stack = []
+    groups = {}
+    spectrum = written = 0
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    for event, element in iterparse(imzml_path, events=('start-ns', 'start', 'end')):
+        if event == 'start-ns':
+            namespaces.append(element)
+            continue
+        tag = local_name(element.tag)
+        if event == 'start':
+            stack.append(element)
+            if tag == 'run':
+                mzml = stack[-2]
+                yield _start_tag(mzml, namespaces) + '\n'
+                for child in mzml:
+                    if child is not element:
+                        yield tostring(child, encoding='unicode')
+                yield _start_tag(element) + '\n'
+            elif tag == 'spectrumList':
+                element.set('count', str(count))
+                yield _start_tag(element) + '\n'
+            continue
+        stack.pop()
+        element.tag = tag
+        if tag == 'referenceableParamGroup':
+            groups[element.get('id')] = cv_params(element)
+        elif tag == 'cvParam' and element.get('accession') in fingerprints:
+            element.set('value', fingerprints[element.get('accession')])
+        elif tag == 'spectrum':
+            if spectrum in offsets:
+                element.set('index', str(written))
+                _relocate_spectrum(element, groups, index, offsets[spectrum])
+                yield tostring(element, encoding='unicode')
+                written += 1
+            spectrum += 1
+            element.clear()
+            stack[-1].remove(element)
+        elif tag in ('spectrumList', 'run'):
+            yield '</%s>\n' % tag
+            if tag == 'run':
+                yield '</%s>\n' % local_name(stack[-1].tag)
+                break
+
+
+def _relocate_spectrum(spectrum, groups, index, offsets):
+    mz_offset, int_offset = offsets
+    for binary_data_array in spectrum.iter('binaryDataArray'):
+        params = binary_array_params(binary_data_array, groups)
+        kind = array_kind(params)
+        if not kind:
+            continue
+        offset, dtype = (mz_offset, index.mz_dtype) if kind == MZ_ARRAY else (int_offset, index.int_dtype)
+        for cv_param in binary_data_array.iter('cvParam'):
+            if cv_param.get('accession') == EXTERNAL_OFFSET:
+                cv_param.set('value', str(offset))
+            elif cv_param.get('accession') == EXTERNAL_ENCODED_LENGTH:
+                cv_param.set('value', str(int(params[EXTERNAL_ARRAY_LENGTH]) * dtype.itemsize))
+
+
+def extract_pixels(bucket_name, aws_path, imzml_name, ibd_name, roi, out_path, work_path,
+                   max_gap=config.EXTRACT_MERGE_GAP, max_range=config.EXTRACT_MAX_RANGE,
+                   max_concurrency=config.EXTRACT_MAX_WORKERS):
+    # Download the imzML only, then fetch the spectra of the pixels in roi from the .ibd in S3 with
+    # coalesced, concurrent range requests into a sparse local copy, and write them as a new imzML/ibd
+    # pair named <imzML name>_roi. Returns the path of the new imzML, or None if no pixel is in roi.
+    manifest = TransferManifest(work_path)
+    imzml_path = download_object(bucket_name, aws_path, imzml_name, work_path, manifest=manifest)
+    ibd_key = os.path.join(aws_path, ibd_name)
+    size, etag = head_object(bucket_name, ibd_key)
+    mirror = preallocate_part_file(work_path, ibd_name, size)
+    try:
+        reader = ImzMLReader(imzml_path, ibd_path=mirror)
+        pixels = select_pixels(reader.index, roi)
+        if not len(pixels):
+            logger.warning("No pixel of %s %s in region %s", bucket_name, imzml_name, roi)
+            return None
+        ranges = coalesce_ranges(pixel_ranges(reader.index, pixels), max_gap, max_range)
+        fetched = download_byte_ranges(bucket_name, ibd_key, ranges, mirror, etag, max_concurrency)
+        logger.info("Fetched %d of %d bytes of %s %s in %d requests for %d of %d pixels",
+                    fetched, size, bucket_name, ibd_key, len(ranges), len(pixels), len(reader.index))
+        file_name = os.path.splitext(imzml_name)[0] + '_roi'
+        target = write_subset(reader, pixels, out_path, file_name)
+    finally:
+        discard_part_file(work_path, ibd_name)
+    return target
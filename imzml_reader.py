@@ -0,0 +1,286 @@
+import json
+import logging
+import os
+from array import array
+from xml.etree.ElementTree import iterparse
+
+import numpy as np
+
+import config
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.idx.npz'
+INDEX_VERSION = 1
+
+MZ_ARRAY = 'MS:1000514'
+INTENSITY_ARRAY = 'MS:1000515'
+DTYPES = {'MS:1000521': '<f4', 'MS:1000523': '<f8', 'MS:1000519': '<i4', 'MS:1000522': '<i8'}
+CONTINUOUS = 'IMS:1000030'
+PROCESSED = 'IMS:1000031'
+POSITION_X = 'IMS:1000050'
+POSITION_Y = 'IMS:1000051'
+POSITION_Z = 'IMS:1000052'
+EXTERNAL_OFFSET = 'IMS:1000102'
+EXTERNAL_ARRAY_LENGTH = 'IMS:1000103'
+EXTERNAL_ENCODED_LENGTH = 'IMS:1000104'
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def cv_params(element):
+    return dict((child.get('accession'), child.get('value')) for child in element
+                if local_name(child.tag) == 'cvParam')
+
+
+def binary_array_params(binary_data_array, groups):
+    # cvParams of a binaryDataArray, including those of its referenceable param groups
+    params = {}
+    for child in binary_data_array:
+        if local_name(child.tag) == 'referenceableParamGroupRef':
+            params.update(groups.get(child.get('ref'), {}))
+    params.update(cv_params(binary_data_array))
+    return params
+
+
+def array_kind(params):
+    return MZ_ARRAY if MZ_ARRAY in params else INTENSITY_ARRAY if INTENSITY_ARRAY in params else None
+
+
+class SpectrumIndex(object):
+    # Compact, array backed index of the spectra of an imzML file: pixel coordinates and the offset
+    # (bytes) and length (elements) of the m/z and intensity arrays of every spectrum in the .ibd file.
+
+    def __init__(self, x, y, z, mz_offsets, mz_lengths, int_offsets, int_lengths, mz_dtype, int_dtype, mode,
+                 source_size=None, source_mtime=None):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.mz_offsets = mz_offsets
+        self.mz_lengths = mz_lengths
+        self.int_offsets = int_offsets
+        self.int_lengths = int_lengths
+        self.mz_dtype = np.dtype(mz_dtype)
+        self.int_dtype = np.dtype(int_dtype)
+        self.mode = mode
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+
+    def __len__(self):
+        return len(self.x)
+
+    @classmethod
+    def parse(cls, imzml_path):
+        # Single streaming pass over the XML; each spectrum element is dropped once indexed
+        groups = {}
+        mode = None
+        coordinates = [array('i'), array('i'), array('i')]
+        mz_offsets, mz_lengths = array('q'), array('q')
+        int_offsets, int_lengths = array('q'), array('q')
+        dtypes = {}
+        spectrum_list = None
+        for event, element in iterparse(imzml_path, events=('start', 'end')):
+            tag = local_name(element.tag)
+            if event == 'start':
+                if tag == 'spectrumList':
+                    spectrum_list = element
+                continue
+            if tag == 'referenceableParamGroup':
+                groups[element.get('id')] = cv_params(element)
+            elif tag == 'cvParam' and element.get('accession') in (CONTINUOUS, PROCESSED):
+                mode = 'continuous' if element.get('accession') == CONTINUOUS else 'processed'
+            elif tag == 'spectrum':
+                cls._index_spectrum(element, groups, coordinates, dtypes,
+                                    (mz_offsets, mz_lengths), (int_offsets, int_lengths))
+                element.clear()
+                if spectrum_list is not None:
+                    spectrum_list.remove(element)
+        stat = os.stat(imzml_path)
+        return cls(*[np.frombuffer(values, dtype=np.int32) for values in coordinates] +
+                   [np.frombuffer(values, dtype=np.int64) for values in (mz_offsets, mz_lengths,
+                                                                          int_offsets, int_lengths)],
+                   mz_dtype=dtypes.get(MZ_ARRAY, '<f8'), int_dtype=dtypes.get(INTENSITY_ARRAY, '<f4'),
+                   mode=mode or 'processed', source_size=stat.st_size, source_mtime=stat.st_mtime)
+
+    @staticmethod
+    def _index_spectrum(spectrum, groups, coordinates, dtypes, mz_arrays, int_arrays):
+        position = {}
+        arrays = {}
+        for element in spectrum.iter():
+            tag = local_name(element.tag)
+            if tag == 'scan':
+                position = cv_params(element)
+            elif tag == 'binaryDataArray':
+                params = binary_array_params(element, groups)
+                kind = array_kind(params)
+                if kind:
+                    arrays[kind] = (int(params[EXTERNAL_OFFSET]), int(params[EXTERNAL_ARRAY_LENGTH]))
+                    for accession, dtype in DTYPES.items():
+                        if accession in params:
+                            dtypes.setdefault(kind, dtype)
+        coordinates[0].append(int(position.get(POSITION_X, 0)))
+        coordinates[1].append(int(position.get(POSITION_Y, 0)))
+        coordinates[2].append(int(position.get(POSITION_Z, 1) or 1))
+        for kind, (offsets, lengths) in ((MZ_ARRAY, mz_arrays), (INTENSITY_ARRAY, int_arrays)):
+            offset, length = arrays.get(kind, (0, 0))
+            offsets.append(offset)
+            lengths.append(length)
+
+    def save(self, index_path):
+        meta = dict(version=INDEX_VERSION, mz_dtype=self.mz_dtype.str, int_dtype=self.int_dtype.str,
+                    mode=self.mode, source_size=self.source_size, source_mtime=self.source_mtime)
+        with open(index_path, 'wb') as index_file:
+            np.savez(index_file, x=self.x, y=self.y, z=self.z, mz_offsets=self.mz_offsets,
+                     mz_lengths=self.mz_lengths, int_offsets=self.int_offsets, int_lengths=self.int_lengths,
+                     meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, index_path):
+        with np.load(index_path) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('version') != INDEX_VERSION:
+                raise ValueError("Unsupported index version in %s" % index_path)
+            return cls(data['x'], data['y'], data['z'], data['mz_offsets'], data['mz_lengths'],
+                       data['int_offsets'], data['int_lengths'], meta['mz_dtype'], meta['int_dtype'],
+                       meta['mode'], meta['source_size'], meta['source_mtime'])
+
+    def matches(self, imzml_path):
+        stat = os.stat(imzml_path)
+        return self.source_size == stat.st_size and self.source_mtime == stat.st_mtime
+
+
+def load_index(imzml_path, index_path=None, rebuild=False):
+    # Index of imzml_path, read from <imzML>.idx.npz when it is up to date, otherwise parsed and saved
+    index_path = index_path or imzml_path + INDEX_SUFFIX
+    if not rebuild and os.path.exists(index_path):
+        try:
+            index = SpectrumIndex.load(index_path)
+            if index.matches(imzml_path):
+                return index
+        except (ValueError, KeyError, OSError) as exc:
+            logger.warning("Rebuilding unreadable index %s: %s", index_path, exc)
+    logger.info("Indexing %s", imzml_path)
+    index = SpectrumIndex.parse(imzml_path)
+    index.save(index_path)
+    logger.info("Indexed %d spectra (%s mode) to %s", len(index), index.mode, index_path)
+    return index
+
+
+class ImzMLReader(object):
+    # Reads spectra, ion images and TIC maps from the .ibd file through numpy.memmap. Spectra are
+    # returned as views of the mapped file; images are computed for all pixels at once in batches of
+    # IMZML_READ_BATCH_ELEMENTS elements, so memory does not grow with the size of the .ibd file.
+
+    def __init__(self, imzml_path, ibd_path=None, index_path=None, rebuild_index=False,
+                 batch_elements=config.IMZML_READ_BATCH_ELEMENTS):
+        self.imzml_path = imzml_path
+        self.ibd_path = ibd_path or os.path.splitext(imzml_path)[0] + '.ibd'
+        self.index = load_index(imzml_path, index_path, rebuild_index)
+        self.batch_elements = batch_elements
+        self._ibd = np.memmap(self.ibd_path, dtype=np.uint8, mode='r')
+        self._views = {}
+
+    @property
+    def shape(self):
+        return int(self.index.y.max(initial=0)), int(self.index.x.max(initial=0))
+
+    def spectrum(self, i):
+        return (self._array(self.index.mz_offsets[i], self.index.mz_lengths[i], self.index.mz_dtype),
+                self._array(self.index.int_offsets[i], self.index.int_lengths[i], self.index.int_dtype))
+
+    def _array(self, offset, length, dtype):
+        return self._ibd[offset:offset + length * dtype.itemsize].view(dtype)
+
+    def _typed(self, dtype, remainder):
+        # the whole file viewed as dtype, starting at byte remainder
+        key = (dtype.str, remainder)
+        if key not in self._views:
+            count = (len(self._ibd) - remainder) // dtype.itemsize
+            self._views[key] = self._ibd[remainder:remainder + count * dtype.itemsize].view(dtype)
+        return self._views[key]
+
+    def _grouped(self, offsets, dtype, pixels):
+        # (typed view, element index of each array) for the pixels grouped by offset alignment
+        remainders = offsets[pixels] % dtype.itemsize
+        for remainder in np.unique(remainders):
+            selected = pixels[remainders == remainder]
+            yield selected, self._typed(dtype, int(remainder)), (offsets[selected] - remainder) // dtype.itemsize
+
+    def _batches(self, lengths):
+        # pixel indices in batches of about batch_elements array elements
+        ends = np.cumsum(lengths)
+        start = 0
+        while start < len(lengths):
+            base = ends[start - 1] if start else 0
+            stop = max(int(np.searchsorted(ends, base + self.batch_elements, side='right')), start + 1)
+            yield np.arange(start, min(stop, len(lengths)))
+            start = stop
+
+    def _image(self, values):
+        image = np.zeros(self.shape, dtype=np.float64)
+        inside = (self.index.x > 0) & (self.index.y > 0)
+        np.add.at(image, (self.index.y[inside] - 1, self.index.x[inside] - 1), values[inside])
+        return image
+
+    def tic_values(self):
+        index = self.index
+        tic = np.zeros(len(index), dtype=np.float64)
+        for pixels in self._batches(index.int_lengths):
+            for selected, typed, starts in self._grouped(index.int_offsets, index.int_dtype, pixels):
+                tic[selected] = _ragged_sum(typed, starts, index.int_lengths[selected])
+        return tic
+
+    def tic_image(self):
+        return self._image(self.tic_values())
+
+    def ion_values(self, mz, tol=None, ppm=None):
+        # summed intensity of every pixel within mz +/- tol (or +/- ppm)
+        if tol is None:
+            tol = mz * (ppm if ppm is not None else 5) * 1e-6
+        index = self.index
+        pixels = np.arange(len(index))
+        low = np.zeros(len(index), dtype=np.int64)
+        high = np.zeros(len(index), dtype=np.int64)
+        for selected, typed, starts in self._grouped(index.mz_offsets, index.mz_dtype, pixels):
+            lengths = index.mz_lengths[selected]
+            low[selected] = _bisect(typed, starts, lengths, mz - tol, right=False)
+            high[selected] = _bisect(typed, starts, lengths, mz + tol, right=True)
+        values = np.zeros(len(index), dtype=np.float64)
+        window = np.maximum(high - low, 0)
+        for batch in self._batches(window):
+            for selected, typed, starts in self._grouped(index.int_offsets, index.int_dtype, batch):
+                values[selected] = _ragged_sum(typed, starts + low[selected], window[selected])
+        return values
+
+    def ion_image(self, mz, tol=None, ppm=None):
+        return self._image(self.ion_values(mz, tol, ppm))
+
+
+def _bisect(typed, starts, lengths, value, right=False):
+    # searchsorted in every sorted array typed[starts[i]:starts[i] + lengths[i]] at once
+    low = np.zeros(len(starts), dtype=np.int64)
+    high = lengths.astype(np.int64)
+    active = low < high
+    while active.any():
+        mid = (low[active] + high[active]) // 2
+        values = typed[starts[active] + mid]
+        go_right = values <= value if right else values < value
+        low[active] = np.where(go_right, mid + 1, low[active])
+        high[active] = np.where(go_right, high[active], mid)
+        active = low < high
+    return low
+
+
+def _ragged_sum(typed, starts, lengths):
+    # sum of typed[starts[i]:starts[i] + lengths[i]] for every i, with one gather
+    sums = np.zeros(len(starts), dtype=np.float64)
+    nonempty = lengths > 0
+    starts, lengths = starts[nonempty], lengths[nonempty]
+    if not len(starts):
+        return sums
+    positions = np.cumsum(lengths) - lengths
+    elements = np.arange(int(lengths.sum()), dtype=np.int64) + np.repeat(starts - positions, lengths)
+    sums[nonempty] = np.add.reduceat(typed[elements].astype(np.float64), positions)
+    return sums
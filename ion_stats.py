@@ -0,0 +1,103 @@
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+
+import numpy as np
+
+import config
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+def image_statistics(images, percentiles=config.ION_IMAGE_PERCENTILES):
+    # Statistics of the non zero pixels of each image: counts, sums and maxima over the whole batch at once
+    # through a mask of the positive pixels, the percentiles image by image so the only working copy is
+    # that of one image's signal. images is a list of images or their float64 stack (used as is).
+    # Returns a list with one dict per image; images without any signal get None intensities.
+    stack = images if isinstance(images, np.ndarray) else np.stack([np.asarray(img, dtype=np.float64)
+                                                                    for img in images])
+    pixels = stack.reshape(len(stack), -1)
+    positive = pixels > 0
+    nonzero = np.count_nonzero(positive, axis=1)
+    total = np.sum(pixels, axis=1, where=positive)
+    maximum = np.max(pixels, axis=1, where=positive, initial=0.0)
+    # the median is the 50th percentile, taken with the others so the pixels are only partitioned once
+    quantiles = sorted(set(percentiles) | {50})
+    stats = []
+    for i in range(len(stack)):
+        cut_offs = {}
+        if nonzero[i]:
+            cut_offs = dict(zip(quantiles, np.percentile(pixels[i][positive[i]], quantiles).tolist()))
+        row = OrderedDict([('mean', float(total[i] / nonzero[i]) if nonzero[i] else None),
+                           ('median', cut_offs.get(50)), ('max', float(maximum[i]) if nonzero[i] else None),
+                           ('nonzero', int(nonzero[i]))])
+        for percentile in percentiles:
+            row['p%g' % percentile] = cut_offs.get(percentile)
+        stats.append(row)
+    return stats
+
+
+def image_statistics_columns(stats):
+    # Annotation export columns for the statistics of one image
+    columns = [('meanIntensity', stats['mean']), ('medianIntensity', stats['median']),
+               ('maxIntensity', stats['max']), ('nonZeroPixels', stats['nonzero'])]
+    columns.extend((key + 'Intensity', value) for key, value in stats.items() if key.startswith('p'))
+    return columns
+
+
+def _principal_peak_image(ds, annotation):
+    # get image for this molecule's principle peak
+    with timed('metaspace.isotope_images'):
+        return ds.isotope_images(sf=annotation[0], adduct=annotation[1])[0]
+
+
+def _image_bytes(image):
+    # memory taken by one image in the float64 stack of image_statistics
+    return max(1, np.asarray(image).size) * np.dtype(np.float64).itemsize
+
+
+def _stack(images, shape):
+    # the images copied into one float64 array as they arrive, each released once copied
+    stack = None
+    for i, image in enumerate(images):
+        if stack is None:
+            stack = np.empty((shape,) + np.shape(image), dtype=np.float64)
+        stack[i] = image
+    return stack
+
+
+def _fetch(executor, ds, annotations, ahead):
+    # images in order, at most ahead of them fetched but not yet consumed (executor.map would fetch them all)
+    pending = deque()
+    for annotation in annotations:
+        pending.append(executor.submit(_principal_peak_image, ds, annotation))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_image_statistics(ds, annotations, batch_bytes=config.ION_IMAGE_BATCH_BYTES,
+                          max_workers=config.ION_IMAGE_MAX_WORKERS, percentiles=config.ION_IMAGE_PERCENTILES):
+    # Yields (annotation, statistics) in order. Images are fetched concurrently and copied into a float64
+    # stack of about batch_bytes (rows * cols * 8 bytes per image of the dataset), processed at once.
+    annotations = iter(annotations)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        first = next(annotations, None)
+        if first is None:
+            return
+        # the ion images of a dataset all have the same shape
+        first_image = _principal_peak_image(ds, first)
+        batch_size = max(1, batch_bytes // _image_bytes(first_image))
+        batch = [first] + list(islice(annotations, batch_size - 1))
+        images = chain([first_image], _fetch(executor, ds, batch[1:], max_workers))
+        del first_image
+        while batch:
+            stack = _stack(images, len(batch))
+            for annotation, stats in zip(batch, image_statistics(stack, percentiles)):
+                yield annotation, stats
+            del stack
+            batch = list(islice(annotations, batch_size))
+            images = _fetch(executor, ds, batch, max_workers)
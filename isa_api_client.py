@@ -4,13 +4,15 @@ import logging
 import time
 
 import errno
+import itertools
 from isatools.convert import isatab2json
 from isatools.isatab import load, dump
 import json
 from isatools.model import *
 from isatools.isajson import ISAJSONEncoder
 
-import config
+from isa_tab_writer import write_study_tables, PROTOCOLS
+from metrics import timed
 
 logger = logging.getLogger(__name__)
 
@@ -34,7 +36,8 @@ class IsaApiClient:
         except OSError as exception:
             if exception.errno != errno.EEXIST:
                 raise
-        inv = dump(inv_obj, std_path, i_file_name=self.inv_filename, skip_dump_tables=skip_dump_tables)
+        with timed('isatools.dump'):
+            inv = dump(inv_obj, std_path, i_file_name=self.inv_filename, skip_dump_tables=skip_dump_tables)
 
         return inv
 
@@ -48,7 +51,10 @@ class IsaApiClient:
         # investigation.submission_date = time.strftime("%d-%m-%Y")
         # investigation.public_release_date = time.strftime("%d-%m-%Y")
 
-        submittedby = mtspc_obj[0]['Submitted_By']
+        # any iterable of samples, read once
+        samples = iter(mtspc_obj)
+        first_sample = next(samples)
+        submittedby = first_sample['Submitted_By']
         ppal_inv = submittedby['Principal_Investigator']
         submitter = submittedby['Submitter']
 
@@ -87,32 +93,23 @@ class IsaApiClient:
 
         investigation.studies.append(study)
 
-        # CONNECT TO METASPACE SERVICES
-        database = config.DATABASE
-        fdr = config.FDR
-        from sm_annotation_utils import sm_annotation_utils
-        sm = sm_annotation_utils.SMInstance()  # connect to the main metaspace service
-        db = sm._moldb_client.getDatabase(database)  # connect to the molecular database service
-
         # assay file
         assay = Assay(filename="a_assay.txt")
 
-        for sample in mtspc_obj:
-            metaspace_options = sample['metaspace_options']
-            ds_name = metaspace_options['Dataset_Name']
-            ds = sm.dataset(name=ds_name)
-
-            assay.samples.append(sample)
-
-
         # extraction_protocol = Protocol(name='extraction', protocol_type=OntologyAnnotation(term="material extraction"))
         # study.protocols.append(extraction_protocol)
         # sequencing_protocol = Protocol(name='sequencing', protocol_type=OntologyAnnotation(term="material sequencing"))
         # study.protocols.append(sequencing_protocol)
+        # the protocols of the Protocol REF columns of s_study.txt and a_assay.txt
+        for name, protocol_type in PROTOCOLS:
+            study.protocols.append(Protocol(name=name, protocol_type=OntologyAnnotation(term=protocol_type)))
         study.assays.append(assay)
 
         if persist:
-            self._write_study_json(investigation, output_dir, skip_dump_tables=False)
+            # s_study.txt and a_assay.txt are streamed from the samples, isatools only writes i_Investigation.txt
+            with timed('isa_tab.tables'):
+                write_study_tables(itertools.chain([first_sample], samples), output_dir)
+            self._write_study_json(investigation, output_dir, skip_dump_tables=True)
 
         return investigation
 
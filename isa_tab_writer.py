@@ -0,0 +1,118 @@
+import csv
+import logging
+import os
+
+import config
+from datasets import get_dataset_info
+from scheduler import resolve_in_order
+
+logger = logging.getLogger(__name__)
+
+# Protocols referenced by the Protocol REF columns, declared in i_Investigation.txt by IsaApiClient.new_study:
+# (name, protocol type)
+SAMPLE_COLLECTION = 'Sample collection'
+PREPARATION = 'Preparation'
+MASS_SPECTROMETRY = 'Mass spectrometry'
+PROTOCOLS = [
+    (SAMPLE_COLLECTION, 'sample collection'),
+    (PREPARATION, 'sample preparation'),
+    (MASS_SPECTROMETRY, 'mass spectrometry'),
+]
+
+# (header, section of the METASPACE metadata, field) of the columns of s_study.txt and a_assay.txt;
+# a section of None is a fixed value, field then being the value itself
+STUDY_COLUMNS = [
+    ('Source Name', 'metaspace_options', 'Dataset_Name'),
+    ('Characteristics[Organism]', 'Sample_Information', 'Organism'),
+    ('Characteristics[Organism part]', 'Sample_Information', 'Organism_Part'),
+    ('Characteristics[Condition]', 'Sample_Information', 'Condition'),
+    ('Characteristics[Sample growth conditions]', 'Sample_Information', 'Sample_Growth_Conditions'),
+    ('Protocol REF', None, SAMPLE_COLLECTION),
+    ('Sample Name', 'metaspace_options', 'Dataset_Name'),
+]
+ASSAY_COLUMNS = [
+    ('Sample Name', 'metaspace_options', 'Dataset_Name'),
+    ('Protocol REF', None, PREPARATION),
+    ('Parameter Value[Sample stabilisation]', 'Sample_Preparation', 'Sample_Stabilisation'),
+    ('Parameter Value[Tissue modification]', 'Sample_Preparation', 'Tissue_Modification'),
+    ('Parameter Value[Matrix]', 'Sample_Preparation', 'MALDI_Matrix'),
+    ('Parameter Value[Matrix application]', 'Sample_Preparation', 'MALDI_Matrix_Application'),
+    ('Parameter Value[Solvent]', 'Sample_Preparation', 'Solvent'),
+    ('Protocol REF', None, MASS_SPECTROMETRY),
+    ('Parameter Value[Scan polarity]', 'MS_Analysis', 'Polarity'),
+    ('Parameter Value[Ion source]', 'MS_Analysis', 'Ionisation_Source'),
+    ('Parameter Value[Mass analyzer]', 'MS_Analysis', 'Analyzer'),
+    ('MS Assay Name', 'metaspace_options', 'Dataset_Name'),
+    ('Raw Spectral Data File', 's3dir', 'imzML'),
+    ('Raw Spectral Data File', 's3dir', 'ibd'),
+    ('Comment[METASPACE dataset id]', 'dataset', 'id'),
+]
+
+
+def _value(sample, ds_info, section, field):
+    if section is None:
+        return field
+    if section == 'dataset':
+        return (ds_info or {}).get(field, '')
+    value = (sample.get(section) or {}).get(field, '')
+    if section == 's3dir':
+        return os.path.basename(value)
+    return value if isinstance(value, str) else '' if value is None else str(value)
+
+
+class StudyTableWriter(object):
+    # Writes the rows of s_study.txt and a_assay.txt as the samples come, to .part files moved into place
+    # by close(), so nothing but the current row is kept in memory whatever the number of samples.
+
+    def __init__(self, output_dir, study_file='s_study.txt', assay_file='a_assay.txt'):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+        self.rows = 0
+        self._tables = []
+        for filename, columns in ((study_file, STUDY_COLUMNS), (assay_file, ASSAY_COLUMNS)):
+            path = os.path.join(output_dir, filename)
+            data_file = open(path + '.part', 'w', newline='')
+            writer = csv.writer(data_file, delimiter='\t', quoting=csv.QUOTE_ALL, lineterminator='\n')
+            writer.writerow([header for header, section, field in columns])
+            self._tables.append((path, data_file, writer, columns))
+
+    def write(self, sample, ds_info=None):
+        for path, data_file, writer, columns in self._tables:
+            writer.writerow([_value(sample, ds_info, section, field) for header, section, field in columns])
+        self.rows += 1
+
+    def close(self, commit=True):
+        for path, data_file, writer, columns in self._tables:
+            data_file.close()
+            if commit:
+                os.replace(path + '.part', path)
+            else:
+                os.remove(path + '.part')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(commit=exc_type is None)
+
+
+def _dataset_info(sample):
+    # samples written by get_study_json carry their dataset id, older ones are looked up by name
+    if sample.get('ds_id'):
+        return dict(id=sample['ds_id'])
+    try:
+        return get_dataset_info(name=sample['metaspace_options']['Dataset_Name'])
+    except Exception:
+        logger.warning("No METASPACE dataset for sample %s", sample['metaspace_options']['Dataset_Name'])
+        return None
+
+
+def write_study_tables(samples, output_dir, max_workers=config.ISA_TAB_MAX_WORKERS):
+    # Stream s_study.txt and a_assay.txt for an iterable of samples (input JSON objects), resolving the
+    # METASPACE datasets of those without a ds_id concurrently (through the metadata cache); returns the
+    # number of samples
+    with StudyTableWriter(output_dir) as writer:
+        for sample, ds_info in resolve_in_order(samples, _dataset_info, max_workers):
+            writer.write(sample, ds_info)
+    logger.info("Wrote %d samples to s_study.txt and a_assay.txt in %s", writer.rows, output_dir)
+    return writer.rows
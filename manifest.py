@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = '.mmit_manifest.jsonl'
+MANIFEST_PATTERN = '.mmit_manifest*.jsonl'
+
+PARTIAL = 'partial'
+COMPLETE = 'complete'
+
+
+class TransferManifest(object):
+    # Record of the files downloaded into an output folder: S3 key, size, ETag, completed byte ranges
+    # and state. Updates are appended as JSON lines so they are cheap and survive an interrupted run;
+    # the file is compacted to one line per file when it is loaded again.
+
+    def __init__(self, output_dir, name=MANIFEST_FILE):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, name)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as data_file:
+            for line in data_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line of an interrupted run
+                    continue
+                self._apply(record)
+        self._compact()
+        logger.info("Loaded transfer manifest %s with %d file(s)", self.path, len(self._entries))
+
+    def _apply(self, record):
+        name = record['file']
+        if record['event'] == 'start':
+            self._entries[name] = dict(bucket=record['bucket'], key=record['key'], size=record['size'],
+                                       etag=record['etag'], part_size=record.get('part_size'),
+                                       state=record.get('state', PARTIAL), parts=list(record.get('parts', [])))
+        # parts are [offset, md5, sha256] of the byte ranges downloaded
+        elif name in self._entries:
+            if record['event'] == 'part':
+                self._entries[name]['parts'].append([record['offset'], record.get('md5'), record.get('sha256')])
+            elif record['event'] == 'complete':
+                self._entries[name]['state'] = COMPLETE
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as data_file:
+            for name, entry in self._entries.items():
+                data_file.write(json.dumps(dict(entry, event='start', file=name)) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def _append(self, record):
+        self._apply(record)
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as data_file:
+            data_file.write(json.dumps(record) + '\n')
+
+    def _name(self, path, filename):
+        return os.path.relpath(os.path.join(path, filename), self.output_dir)
+
+    def entries(self):
+        with self._lock:
+            return dict((name, dict(entry)) for name, entry in self._entries.items())
+
+    def is_complete(self, path, filename, size, etag):
+        with self._lock:
+            entry = self._entries.get(self._name(path, filename))
+        target = os.path.join(path, filename)
+        return bool(entry) and entry['state'] == COMPLETE and entry['size'] == size and entry['etag'] == etag \
+            and os.path.exists(target) and os.path.getsize(target) == size
+
+    def start(self, path, filename, bucket, key, size, etag, part_size=None):
+        # Returns {offset: (md5, sha256)} of the byte ranges already downloaded when an interrupted download
+        # of the same object version, split the same way (part_size None for a single stream), can be
+        # resumed. Otherwise records a new download and returns None.
+        name = self._name(path, filename)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry['state'] == PARTIAL and entry['size'] == size and entry['etag'] == etag \
+                    and entry['part_size'] == part_size:
+                return dict((offset, (md5, sha256)) for offset, md5, sha256 in entry['parts'])
+            self._append(dict(event='start', file=name, bucket=bucket, key=key, size=size, etag=etag,
+                              part_size=part_size))
+        return None
+
+    def part_done(self, path, filename, offset, digests=(None, None)):
+        with self._lock:
+            self._append(dict(event='part', file=self._name(path, filename), offset=offset,
+                              md5=digests[0], sha256=digests[1]))
+
+    def reset(self, path, filename):
+        # forget the downloaded parts, e.g. after a checksum mismatch
+        name = self._name(path, filename)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry:
+                self._append(dict(event='start', file=name, bucket=entry['bucket'], key=entry['key'],
+                                  size=entry['size'], etag=entry['etag'], part_size=entry['part_size']))
+
+    def complete(self, path, filename):
+        with self._lock:
+            self._append(dict(event='complete', file=self._name(path, filename)))
+
+
+def manifest_name(shard=None):
+    # nodes sharing an output folder keep one manifest per shard
+    return MANIFEST_FILE if shard is None else '.mmit_manifest.%s.jsonl' % shard.suffix
@@ -0,0 +1,224 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Process wide counts, latency histograms and byte counters per operation (e.g. s3.get_object,
+# metaspace.dataset, disk.write). Summarised in the log and, with a metrics file, written in the
+# Prometheus textfile format when the process exits.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Operation(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds, size=0, error=False):
+        self.count += 1
+        self.errors += 1 if error else 0
+        self.bytes += size
+        self.seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile(self, point):
+        # upper bound of the histogram bucket holding the point-th percentile
+        rank = self.count * point / 100.0
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        return OrderedDict([('operation', self.name), ('count', self.count), ('errors', self.errors),
+                            ('bytes', self.bytes), ('seconds', round(self.seconds, 3)),
+                            ('p50_le', self.percentile(50)), ('p99_le', self.percentile(99))])
+
+
+class Timer(object):
+    # Returned by timed(); bytes handled by the operation are added with add()
+
+    def __init__(self):
+        self.bytes = 0
+
+    def add(self, size):
+        self.bytes += size
+
+
+_operations = OrderedDict()
+_lock = threading.Lock()
+
+
+def observe(name, seconds, size=0, error=False):
+    with _lock:
+        operation = _operations.get(name)
+        if operation is None:
+            operation = _operations[name] = Operation(name)
+        operation.observe(seconds, size, error)
+    logger.debug("%s %.6fs %d bytes", name, seconds, size,
+                 extra=dict(operation=name, seconds=seconds, bytes=size, error=error))
+
+
+@contextmanager
+def timed(name, size=0):
+    timer = Timer()
+    timer.add(size)
+    start = time.perf_counter()
+    error = True
+    try:
+        yield timer
+        error = False
+    finally:
+        observe(name, time.perf_counter() - start, timer.bytes, error)
+
+
+def timed_iter(items, name, size=len):
+    # Pass items through, recording under name the time spent waiting for each one and its size
+    iterator = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe(name, time.perf_counter() - start, size(item) if size else 0)
+        yield item
+
+
+def operations():
+    with _lock:
+        return list(_operations.values())
+
+
+def reset():
+    with _lock:
+        _operations.clear()
+
+
+def log_summary():
+    for operation in operations():
+        summary = operation.summary()
+        logger.info("%s: %d calls, %d errors, %d bytes, %.3fs, p50 <= %ss, p99 <= %ss",
+                    *summary.values(), extra=summary)
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus_text(prefix='mmit'):
+    lines = []
+    metrics = [('operations_total', 'counter', 'Calls per operation.', 'count'),
+               ('operation_errors_total', 'counter', 'Failed calls per operation.', 'errors'),
+               ('operation_bytes_total', 'counter', 'Bytes handled per operation.', 'bytes')]
+    current = operations()
+    for name, kind, description, attribute in metrics:
+        lines.append('# HELP %s_%s %s' % (prefix, name, description))
+        lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+        for operation in current:
+            lines.append('%s_%s{operation="%s"} %d' % (prefix, name, _label(operation.name),
+                                                       getattr(operation, attribute)))
+    name = prefix + '_operation_duration_seconds'
+    lines.append('# HELP %s Duration of the calls per operation.' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for operation in current:
+        label = _label(operation.name)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), operation.buckets):
+            cumulative += count
+            lines.append('%s_bucket{operation="%s",le="%s"} %d' % (name, label, bound, cumulative))
+        lines.append('%s_sum{operation="%s"} %f' % (name, label, operation.seconds))
+        lines.append('%s_count{operation="%s"} %d' % (name, label, operation.count))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    # written next to path and moved into place, as the node exporter textfile collector expects
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.part', 'w') as data_file:
+        data_file.write(prometheus_text())
+    os.replace(path + '.part', path)
+    logger.info("Metrics written to %s", path)
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per log line, with the fields passed as extra= (operation, seconds, bytes, ...)
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        line = OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) +
+                             '.%03dZ' % record.msecs),
+                            ('level', record.levelname), ('logger', record.name),
+                            ('message', record.getMessage())])
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                line[key] = value
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+def use_json_logs():
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(JsonFormatter())
+
+
+def _write_at_exit(metrics_file):
+    log_summary()
+    if metrics_file:
+        try:
+            write_prometheus(metrics_file)
+        except (IOError, OSError) as exc:
+            logger.warning("Could not write metrics to %s: %s", metrics_file, exc)
+
+
+def configure(metrics_file=config.METRICS_FILE, json_logs=False):
+    # Log the summary, and write metrics_file if given, when the process exits
+    if json_logs:
+        use_json_logs()
+    atexit.register(_write_at_exit, metrics_file)
+
+
+def start_profile(path):
+    # Profile the rest of the run with cProfile; the stats are saved to path (pstats) and the slowest
+    # functions by cumulative time to path.txt when the process exits
+    import cProfile
+
+    profile = cProfile.Profile()
+
+    def save():
+        profile.disable()
+        import pstats
+
+        profile.dump_stats(path)
+        with open(path + '.txt', 'w') as data_file:
+            pstats.Stats(profile, stream=data_file).sort_stats('cumulative').print_stats(config.PROFILE_TOP)
+        logger.info("Profile written to %s and %s.txt", path, path)
+
+    atexit.register(save)
+    profile.enable()
+    return profile
@@ -1,19 +1,26 @@
 import sys
-import boto3
-import requests
 import config
 import logging
 import getopt
 import os
 import json
-from aws_client import aws_download_file, AwsCredentials
-from isa_api_client import IsaApiClient
-from sm_annotation_utils.sm_annotation_utils import SMInstance
-import csv
+import glob
+import fnmatch
+from aws_client import head_object, is_not_found, AwsCredentials
+from clients import get_sm, get_moldb
+from moldb_lookup import MoleculeLookup
+from datasets import get_dataset_info, get_optical_image_path
+from s3_index import build_index, file_kinds
+import cache
+import metrics
+from scheduler import TransferScheduler, resolve_in_order
+from manifest import TransferManifest, COMPLETE, MANIFEST_PATTERN, manifest_name
+from sharding import Shard, ClaimStore, select, write_shard_study_json, merge_study_json
+from study_json import StudyJson, StudyJsonWriter, study_json_file
 from collections import OrderedDict
 
 msg_format = '%(asctime)s %(levelname)s %(message)s'
-date_format= '%Y-%d-%m %H:%M:%S'
+date_format= '%Y-%m-%d %H:%M:%S'
 logging.basicConfig(format=msg_format, datefmt=date_format, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -26,7 +33,19 @@ def main(argv):
                     'imzML', 'ibd', 'annotations', 'images',
                     'new-study', 'title=', 'description=',
                     'study-ids=',
-                    'list-files'
+                    'list-files',
+                    'part-size=', 'concurrency=',
+                    'workers=', 'bucket-workers=', 'max-bandwidth=',
+                    'verify-only',
+                    'no-cache', 'refresh',
+                    'partitioned',
+                    'pipeline', 'stage-workers=',
+                    'shard=', 'claim', 'merge-shards',
+                    'extract', 'roi=', 'tiles',
+                    'metrics-file=', 'json-logs', 'profile=',
+                    'store=', 'store-max-size=', 'store-report',
+                    'upload=', 'bucket=', 'prefix=',
+                    'jsonl'
                     ]
     options_help = """ [options]
     
@@ -35,18 +54,57 @@ General Options:
    -v   --version       Display version information.
    -t   --testmode      Read the input JSON file provided with option -i and print its content.
    -s   --study-ids     Get Study JSON information. Input is a (comma separated) list of METASPACE identifiers.
-   -i   --inputfile     Provide the JSON input file.
+   -i   --inputfile     Provide the JSON input file: a JSON array or JSON Lines (one sample per line).
+        --jsonl         Write the study JSON (-s, --pipeline, --merge-shards) as JSON Lines, <title>.jsonl.
    -o   --outputdir     Set the output folder. Will be created if not found. 'output' will be used as default.
    -p   --use-path      Save files keeping same folder structure as in AWS  
         --imzML         Download *.imzml study associated files.
         --ibd           Download *.ibd study associated files.
-        --annotations   Download JSON study file.
+        --annotations   Export the annotations of all datasets to annotations.tsv and annotations.jsonl.
+        --partitioned   Write the annotations of each dataset to its own annotations/dataset=<name> folder.
         --images        Download raw optical images.
+        --tiles         With --images, build Deep Zoom tile pyramids and thumbnails of new or changed images.
    -a   --download-all  Download all associated files for a set of METASPACE Id's. Same as --imzML --idb --images --annotations.
    -n   --new-study     Create ISA-Tab new Study with provided title.
         --title         Study title.
         --description   Study description.
    -l   --list-files    List all files in AWS for a list of METASPACE identifiers.
+        --pipeline      Get Study JSON information, download all files and create the ISA-Tab study for the
+                        identifiers given with -s in a single pass. Needs --title and --description.
+        --stage-workers Workers of the pipeline stages, e.g. metadata=8,listing=8,download=4.
+        --no-cache      Do not use the local cache of METASPACE metadata, AWS listings and molecule names.
+        --refresh       Fetch METASPACE metadata, AWS listings and molecule names again and update the local cache.
+        --shard         Only process shard i/N (0 <= i < N) of the datasets (-s) or files (-a, --imzML, --ibd),
+                        for several nodes sharing the output folder.
+        --claim         With --shard, claim files with lock files in the output folder and take over the
+                        unfinished files of other shards once done with this one, waiting at the end for
+                        files claimed by other nodes until they finish or their claims go stale.
+        --merge-shards  Combine the study JSON files written by the shards of -s --title into one.
+        --extract       Fetch only the spectra of the pixels in --roi from the .ibd files in AWS and save them
+                        as <imzML name>_roi.imzML/.ibd.
+        --roi           Region of pixels to extract, as x0:x1,y0:y1 (inclusive).
+        --verify-only   Check the files downloaded to the output folder against AWS without downloading anything.
+        --upload        Upload a file, or every file of a folder keeping its structure, to AWS. Files already
+                        in AWS with the same size and content are skipped.
+        --bucket        Bucket to upload to. The bucket of the AWS credentials file is used as default.
+        --prefix        Prefix of the keys of the uploaded files.
+
+Transfer Options:
+        --part-size     Size in MB of the byte ranges used to download or upload large files (--ibd, -a, --upload).
+        --concurrency   Number of byte ranges of the same file transferred at once (--ibd, -a, --upload).
+        --workers       Number of datasets/files transferred at once (--imzML, --ibd, -a, --upload).
+        --bucket-workers  Maximum number of files transferred at once from the same bucket.
+        --max-bandwidth Total bandwidth cap in MB/s.
+        --store         Keep downloaded files in this folder, shared by all output folders, and hard link (or
+                        reflink, or copy) files already there instead of downloading them again (--imzML, --ibd, -a).
+        --store-max-size  Size in GB of the store above which the least recently used files are removed.
+        --store-report  Print the size of the --store folder and the bytes it saved so far.
+
+Instrumentation Options:
+        --metrics-file  Write counts, latency histograms and bytes per operation to this file at exit,
+                        in the Prometheus textfile format.
+        --json-logs     Write the log as one JSON object per line.
+        --profile       Profile the run with cProfile and write the stats to this file (and a summary to <file>.txt).
 """
 
     input_file = ''
@@ -63,6 +121,33 @@ General Options:
     study_ids = list()
     download_all = False
     list_files = False
+    verify_only = False
+    use_cache = True
+    partitioned = False
+    run_pipeline = False
+    shard = None
+    use_claims = False
+    merge_shards = False
+    extract = False
+    tiles = False
+    metrics_file = config.METRICS_FILE
+    json_logs = False
+    profile_file = None
+    roi = None
+    stage_workers = {}
+    refresh_cache = False
+    part_size = config.MULTIPART_PART_SIZE
+    max_concurrency = config.MULTIPART_CONCURRENCY
+    workers = config.SCHEDULER_MAX_WORKERS
+    bucket_workers = config.SCHEDULER_BUCKET_WORKERS
+    max_bandwidth = config.SCHEDULER_MAX_BANDWIDTH
+    store_dir = config.STORE_DIR
+    store_max_bytes = config.STORE_MAX_BYTES
+    store_report = False
+    upload_source = None
+    upload_bucket = None
+    upload_prefix = ''
+    json_lines = False
 
     try:
         opts, args = getopt.getopt(argv, shortopts=short_options, longopts=long_options)
@@ -96,6 +181,14 @@ General Options:
             download_annotations = True
         if opt == '--images':
             download_images = True
+        if opt == '--tiles':
+            tiles = True
+        if opt == '--metrics-file':
+            metrics_file = arg
+        if opt == '--json-logs':
+            json_logs = True
+        if opt == '--profile':
+            profile_file = arg
         if opt in ('-n', '--new-study'):
             create_new_study = True
         if opt == '--title':
@@ -110,10 +203,96 @@ General Options:
             download_all = True
         if opt in ('-l', '--list-files'):
             list_files = True
+        if opt == '--shard':
+            shard = Shard.parse(arg)
+        if opt == '--claim':
+            use_claims = True
+        if opt == '--merge-shards':
+            merge_shards = True
+        if opt == '--extract':
+            extract = True
+        if opt == '--roi':
+            from imzml_extract import parse_roi
+            roi = parse_roi(arg)
+        if opt == '--pipeline':
+            run_pipeline = True
+        if opt == '--stage-workers':
+            for setting in arg.split(','):
+                stage, count = setting.split('=')
+                stage_workers[stage.strip()] = int(count)
+        if opt == '--partitioned':
+            partitioned = True
+        if opt == '--no-cache':
+            use_cache = False
+        if opt == '--refresh':
+            refresh_cache = True
+        if opt == '--verify-only':
+            verify_only = True
+        if opt == '--part-size':
+            part_size = int(arg) * 1024 * 1024
+        if opt == '--concurrency':
+            max_concurrency = int(arg)
+        if opt == '--workers':
+            workers = int(arg)
+        if opt == '--bucket-workers':
+            bucket_workers = int(arg)
+        if opt == '--max-bandwidth':
+            max_bandwidth = float(arg) * 1024 * 1024
+        if opt == '--store':
+            store_dir = arg
+        if opt == '--store-max-size':
+            store_max_bytes = int(float(arg) * 1024 * 1024 * 1024)
+        if opt == '--store-report':
+            store_report = True
+        if opt == '--upload':
+            upload_source = arg
+        if opt == '--bucket':
+            upload_bucket = arg
+        if opt == '--prefix':
+            upload_prefix = arg
+        if opt == '--jsonl':
+            json_lines = True
+
+    cache.configure(enabled=use_cache, refresh=refresh_cache)
+    metrics.configure(metrics_file, json_logs)
+    if profile_file:
+        metrics.start_profile(profile_file)
 
     if input_file:
         mtspc_obj = parse(input_file)
 
+    store = None
+    if store_dir:
+        from object_store import open_store
+        store = open_store(store_dir, store_max_bytes)
+
+    if store_report:
+        missing = list()
+        if not store:
+            missing.append("   --store")
+            print_need_additional_params(missing, options_help, exit_code=21)
+        print(json.dumps(store.report(), indent=2, sort_keys=True))
+        exit(0)
+
+    claims = ClaimStore(output_dir) if use_claims and shard else None
+
+    if merge_shards:
+        missing = list()
+        if not std_title:
+            missing.append("   --title")
+            print_need_additional_params(missing, options_help, exit_code=19)
+        merge_study_json(output_dir, std_title, study_ids or None, lines=json_lines)
+        exit(0)
+
+    if verify_only:
+        exit(0 if verify_manifest(output_dir) else 1)
+
+    if upload_source:
+        scheduler = upload_files(upload_source, upload_bucket or AwsCredentials().get_bucket, upload_prefix,
+                                 part_size=part_size, max_concurrency=max_concurrency,
+                                 scheduler=TransferScheduler(workers, bucket_workers, max_bandwidth))
+        exit(1 if scheduler.failures else 0)
+
     if list_files:
         missing = list()
         if not study_ids:
@@ -127,7 +306,37 @@ General Options:
         if not study_ids:
             missing.append("-s --study-ids")
             print_need_additional_params(missing, options_help, exit_code=10)
-        get_all_files(study_ids, ['.imzML', '.ibd', '.jpg', '.jpeg', '.png'], output_dir, use_path=use_path)
+        scheduler = get_all_files(study_ids, ['.imzML', '.ibd', '.jpg', '.jpeg', '.png'], output_dir,
+                                  use_path=use_path, part_size=part_size, max_concurrency=max_concurrency,
+                                  scheduler=TransferScheduler(workers, bucket_workers, max_bandwidth), shard=shard,
+                                  claims=claims, store=store)
+        exit(1 if scheduler.failures else 0)
+
+    if run_pipeline:
+        missing = list()
+        if not study_ids:
+            missing.append("-s --study-ids")
+        if not std_title:
+            missing.append("   --title")
+        if not std_description:
+            missing.append("   --description")
+        if missing:
+            print_need_additional_params(missing, options_help, exit_code=18)
+        from pipeline import StudyPipeline
+        StudyPipeline(study_ids, output_dir, std_title, std_description, use_path=use_path,
+                      stage_workers=stage_workers, part_size=part_size, max_concurrency=max_concurrency,
+                      store=store, json_lines=json_lines).run()
+        exit(0)
+
+    if extract:
+        missing = list()
+        if not input_file:
+            missing.append("-i --inputfile")
+        if not roi:
+            missing.append("   --roi")
+        if missing:
+            print_need_additional_params(missing, options_help, exit_code=20)
+        aws_extract_pixels(mtspc_obj, output_dir, roi, use_path=use_path)
         exit(0)
 
     if study_ids:
@@ -135,7 +344,7 @@ General Options:
         if not std_title:
             missing.append("   --title")
             print_need_additional_params(missing, options_help, exit_code=11)
-        get_study_json(study_ids, output_dir, std_title)
+        get_study_json(study_ids, output_dir, std_title, shard=shard, lines=json_lines)
 
     if test_mode:
         missing = list()
@@ -150,28 +359,33 @@ General Options:
         if not input_file:
             missing.append("-i --inputfile")
             print_need_additional_params(missing, options_help, exit_code=13)
-        aws_download_files(mtspc_obj, output_dir, 'imzML', data_type='utf-8', use_path=use_path)
+        aws_download_files(mtspc_obj, output_dir, 'imzML', use_path=use_path,
+                           scheduler=TransferScheduler(workers, bucket_workers, max_bandwidth),
+                           shard=shard, claims=claims, store=store)
 
     if download_ibd:
         missing = list()
         if not input_file:
             missing.append("-i --inputfile")
             print_need_additional_params(missing, options_help, exit_code=14)
-        aws_download_files(mtspc_obj, output_dir, 'ibd', data_type='binary', use_path=use_path)
+        aws_download_files(mtspc_obj, output_dir, 'ibd', use_path=use_path,
+                           part_size=part_size, max_concurrency=max_concurrency,
+                           scheduler=TransferScheduler(workers, bucket_workers, max_bandwidth),
+                           shard=shard, claims=claims, store=store)
 
     if download_annotations:
         missing = list()
         if not input_file:
             missing.append("-i --inputfile")
             print_need_additional_params(missing, options_help, exit_code=15)
-        aws_get_annotations(mtspc_obj, output_dir)
+        aws_get_annotations(mtspc_obj, output_dir, partitioned=partitioned)
 
     if download_images:
         missing = list()
         if not input_file:
             missing.append("-i --inputfile")
             print_need_additional_params(missing, options_help, exit_code=16)
-        aws_get_images(mtspc_obj, output_dir, use_path=use_path)
+        aws_get_images(mtspc_obj, output_dir, use_path=use_path, tiles=tiles)
 
     if create_new_study:
         missing = list()
@@ -183,6 +397,7 @@ General Options:
             missing.append("   --description")
         if missing:
             print_need_additional_params(missing, options_help, exit_code=17)
+        from isa_api_client import IsaApiClient
         iac = IsaApiClient()
         inv = iac.new_study(std_title, std_description, mtspc_obj, output_dir, persist=True)
         print(inv)
@@ -206,21 +421,41 @@ def print_mtspc_obj(mtspc_obj):
         print()
 
 
-def aws_download_files(mtspc_obj, output_dir, extension, data_type='binary', use_path=False):
-    for sample in mtspc_obj:
+def aws_download_files(mtspc_obj, output_dir, extension, use_path=False,
+                       part_size=config.MULTIPART_PART_SIZE, max_concurrency=config.MULTIPART_CONCURRENCY,
+                       scheduler=None, shard=None, claims=None, store=None):
+    scheduler = scheduler or TransferScheduler()
+    manifest = TransferManifest(output_dir, manifest_name(shard))
+    items = ((sample['metaspace_options']['Dataset_Name'] + '/' + sample['s3dir'][extension], sample)
+             for sample in mtspc_obj)
+    for claim_key, sample in select(items, lambda item: item[0], shard, steal=claims is not None):
         aws_bucket, aws_path, file_name = get_filename_parts(sample, extension)
-        logger.info("Getting file %s %s %s (%s)", aws_bucket, aws_path, file_name, data_type)
-        file = aws_download_file(aws_bucket, aws_path, file_name, data_type)
+        logger.info("Getting file %s %s %s", aws_bucket, aws_path, file_name)
+        path = os.path.join(output_dir, aws_path) if use_path else output_dir
+        scheduler.submit_download(file_name, aws_bucket, aws_path, file_name, path,
+                                  part_size=part_size, max_concurrency=max_concurrency, manifest=manifest,
+                                  claims=claims, claim_key=claim_key, store=store)
+    return scheduler.wait()
+
+
+def aws_extract_pixels(mtspc_obj, output_dir, roi, use_path=False):
+    from imzml_extract import extract_pixels
+
+    for sample in mtspc_obj:
+        aws_bucket, aws_path, imzml_name = get_filename_parts(sample, 'imzML')
+        ibd_name = get_filename_parts(sample, 'ibd')[2]
         path = os.path.join(output_dir, aws_path) if use_path else output_dir
-        if file:
-            save_file(file, path, file_name, data_type)
+        work_path = os.path.join(output_dir, config.EXTRACT_WORK_DIR, aws_path)
+        try:
+            extract_pixels(aws_bucket, aws_path, imzml_name, ibd_name, roi, path, work_path)
+        except Exception:
+            logger.exception("Failed to extract pixels of %s %s", aws_bucket, imzml_name)
 
 
 def parse(filename):
+    # the samples are read from the file one at a time, each time they are iterated over
     assert os.path.exists(filename), "Did not find json input file: %s" % filename
-    with open(filename, 'r', encoding='utf-8') as data_file:
-        json_data = json.load(data_file)
-    return json_data
+    return StudyJson(filename)
 
 
 def get_filename_parts(sample_data, key):
@@ -232,190 +467,245 @@ def get_filename_parts(sample_data, key):
     return bucket_name, aws_path, file_name
 
 
-def save_file(content, path, filename, data_type='text'):
-    if not os.path.exists(path):
-        os.makedirs(path)
-    mode = 'w'
-    if data_type == 'binary':
-        mode = 'wb'
-    logger.info("Saving file %s %s (%s)", path, filename, data_type)
-    with open(os.path.join(path, filename), mode) as data_file:
-        data_file.write(content)
-
-
-def aws_get_annotations(mtspc_obj, output_dir, database=config.DATABASE, fdr=config.FDR):
+def aws_get_annotations(mtspc_obj, output_dir, database=config.DATABASE, fdr=config.FDR, partitioned=False):
+    from ion_stats import iter_image_statistics, image_statistics_columns
+    from annotation_export import AnnotationWriter, PartitionedAnnotationWriter
 
     filename = 'annotations'
     # CONNECT TO METASPACE SERVICES
-    from sm_annotation_utils import sm_annotation_utils
-    sm = SMInstance()  # connect to the main metaspace service
-    db = sm._moldb_client.getDatabase(database)  # connect to the molecular database service
-
-    for sample in mtspc_obj:
-        metaspace_options = sample['metaspace_options']
-        ds_name = metaspace_options['Dataset_Name']
-        ds = sm.dataset(name=ds_name)
-        # print('Dataset name: ', ds_name)
-        # print('Dataset id: ', ds.id)
-        # print('Dataset config: ', ds.config)
-        # print('Dataset DBs: ', ds.databases)
-        # print('Dataset adducts: ', ds.adducts)
-        # print('Dataset metadata: ', ds.metadata.json)
-        # print('Dataset polarity: ', ds.polarity)
-        # print('Dataset results: ', ds.results())
-
-        print()
-
-        for an in ds.annotations(fdr=fdr, database=database):
-            # print(an)
-
-            nms = db.names(an[0])
-            # print(nms)
-
-            ids = db.ids(an[0])
-            # print(ids)
-
-            img = ds.isotope_images(sf=an[0], adduct=an[1])[0]  # get image for this molecule's principle peak
-            mii = img[img > 0].mean()  # mean image intensity
-
-            institution = sample['Submitted_By']['Institution']
-            dataset_name = ds_name
-            formula = an[0]
-            adduct = ds.adducts[0]
-            mz = ''
-            msm = str(mii)
-            fdr = ''
-            rho_spatial = ''
-            rho_spectral = ''
-            rho_chaos = ''
-            molecule_names = nms
-
-            annotations = OrderedDict([
-                ('institution', institution),
-                ('datasetName', dataset_name),
-                ('formula', formula),
-                ('adduct', adduct),
-                ('mz', mz),
-                ('msm', msm),
-                ('fdr', fdr),
-                ('rhoSpatial', rho_spatial),
-                ('rhoSpectral', rho_spectral),
-                ('rhoChaos', rho_chaos),
-                ('moleculeNames', molecule_names)])
-
-            # JSON file
-            json_obj = json.dumps(annotations)
-            save_file(json_obj, output_dir, filename + '.json', data_type='text')
-
-            # Tab separated file
-            with open(os.path.join(output_dir, filename + '.tsv'), "w") as f:
-                writer = csv.writer(f, delimiter='\t')
-                writer.writerow(annotations.keys())
-                writer.writerow(annotations.values())
-            f.close()
-
-            return
+    sm = get_sm()
+    molecules = MoleculeLookup(database, persist=cache.is_enabled(), refresh=cache.is_refresh())
 
-
-aws_cred = AwsCredentials()
-
-
-def aws_get_images(mtspc_obj, output_dir, use_path=False):
-    sm = SMInstance()
-
-    for sample in mtspc_obj:
+    writer_class = PartitionedAnnotationWriter if partitioned else AnnotationWriter
+    try:
+        with writer_class(output_dir, filename) as writer:
+            for sample in mtspc_obj:
+                metaspace_options = sample['metaspace_options']
+                ds_name = metaspace_options['Dataset_Name']
+                with metrics.timed('metaspace.dataset'):
+                    ds = sm.dataset(name=ds_name)
+                # print('Dataset name: ', ds_name)
+                # print('Dataset id: ', ds.id)
+                # print('Dataset config: ', ds.config)
+                # print('Dataset DBs: ', ds.databases)
+                # print('Dataset adducts: ', ds.adducts)
+                # print('Dataset metadata: ', ds.metadata.json)
+                # print('Dataset polarity: ', ds.polarity)
+                # print('Dataset results: ', ds.results())
+
+                print()
+
+                with metrics.timed('metaspace.annotations'):
+                    ds_annotations = ds.annotations(fdr=fdr, database=database)
+                ds_molecules = molecules.resolve(an[0] for an in ds_annotations)
+
+                for an, img_stats in iter_image_statistics(ds, ds_annotations):
+                    # print(an)
+
+                    nms, ids = ds_molecules[an[0]]
+                    # print(nms)
+                    # print(ids)
+
+                    institution = sample['Submitted_By']['Institution']
+                    dataset_name = ds_name
+                    formula = an[0]
+                    adduct = ds.adducts[0]
+                    mz = ''
+                    msm = str(img_stats['mean'])  # mean image intensity
+                    an_fdr = ''
+                    rho_spatial = ''
+                    rho_spectral = ''
+                    rho_chaos = ''
+                    molecule_names = nms
+
+                    annotations = OrderedDict([
+                        ('institution', institution),
+                        ('datasetName', dataset_name),
+                        ('formula', formula),
+                        ('adduct', adduct),
+                        ('mz', mz),
+                        ('msm', msm),
+                        ('fdr', an_fdr),
+                        ('rhoSpatial', rho_spatial),
+                        ('rhoSpectral', rho_spectral),
+                        ('rhoChaos', rho_chaos),
+                        ('moleculeNames', molecule_names)])
+                    annotations.update(image_statistics_columns(img_stats))
+
+                    writer.write(annotations)
+    finally:
+        molecules.save()
+        molecules.log_stats()
+
+
+def aws_get_images(mtspc_obj, output_dir, use_path=False, max_workers=config.IMAGE_MAX_WORKERS, tiles=False):
+    import requests
+    from http_cache import HttpCache
+
+    http_cache = HttpCache(enabled=cache.is_enabled(), refresh=cache.is_refresh())
+
+    def get_image(sample):
         metaspace_options = sample['metaspace_options']
         ds_name = metaspace_options['Dataset_Name']
-        ds = sm.dataset(name=ds_name)
-        opt_im = ds._gqclient.getRawOpticalImage(ds.id)['rawOpticalImage']
+        ds_info = get_dataset_info(name=ds_name)
 
-        path = opt_im['url']
-        img_url = ds._baseurl + path
+        path = get_optical_image_path(ds_info) or ''
+        img_url = ds_info['baseurl'] + path
         img_folder = os.path.dirname(path)
         img_name = os.path.basename(path)
         if img_name and not img_name == 'null':
             logger.info("Getting file %s", img_url)
-            img_data = requests.get(img_url).content
-            if img_data:
-                out_path = output_dir + img_folder if use_path else output_dir
-                save_file(content=img_data,
-                          path=out_path,
-                          filename=img_name + '.jpg', data_type='binary')
+            out_path = output_dir + img_folder if use_path else output_dir
+            try:
+                return http_cache.fetch(img_url, out_path, img_name + '.jpg')
+            except (requests.RequestException, IOError):
+                logger.warning("Failed to download %s", img_url)
+
+    try:
+        images = [image for sample, image in resolve_in_order(mtspc_obj, get_image, max_workers)]
+    finally:
+        http_cache.log_stats()
+    if tiles:
+        from image_tiles import build_pyramids
+        build_pyramids(images)
+    return images
 
 
 def get_aws_session(database):
     # CONNECT TO METASPACE SERVICES
-    from sm_annotation_utils import sm_annotation_utils
-    sm = SMInstance()  # connect to the main metaspace service
-    db = sm._moldb_client.getDatabase(database)  # connect to the molecular database service
+    sm = get_sm()
+    get_moldb(database)
 
     return sm
 
 
-def get_study_json(ds_ids, output_dir, std_title):
-
-    session = boto3.Session(aws_cred.get_access_key, aws_cred.get_secret_access_key)
-    s3 = session.resource('s3')
-    sm = SMInstance()
-    db = sm._moldb_client.getDatabase(config.DATABASE)
-    std_json = []
-    for ii, ds_id in enumerate(ds_ids):
+def iter_study_json(ds_ids, index):
+    for ds_id in ds_ids:
         logger.info("Getting JSON information for %s", ds_id)
-        ds = sm.dataset(id=ds_id)
-        me = json.loads(ds.metadata.json)
-        path = ds.s3dir[6:]  # strip s3a://
-        bucket_name, ds_name = path.split('/', 1)
-        bucket = s3.Bucket(bucket_name)
+        ds_info = get_dataset_info(ds_id=ds_id)
+        me = json.loads(ds_info['metadata'])
+        me['ds_id'] = ds_id
         me['s3dir'] = {}
-        for obj in bucket.objects.filter(Prefix=path.split('/')[1]):
-            if obj.key.endswith('.imzML'):
-                me['s3dir']['imzML'] = path + "/" + obj.key.split('/')[-1]
-            if obj.key.endswith('.ibd'):
-                me['s3dir']['ibd'] = path + "/" + obj.key.split('/')[-1]
-        std_json.append(me)
-
-    save_file(json.dumps(std_json), output_dir, std_title + '.json', data_type='text')
-    return std_json
-
-
-def get_all_files(ds_ids, file_types, output_dir, use_path=False):
-
-    session = boto3.Session(aws_cred.get_access_key, aws_cred.get_secret_access_key)
-    s3 = session.resource('s3')
-    sm = SMInstance()
-    for ii, ds_id in enumerate(ds_ids):
-        logger.info("Getting all files for %s", ds_id)
-        ds = sm.dataset(id=ds_id)
-        aws_path = ds.s3dir[6:]  # strip s3a://
-        bucket_name, ds_name = aws_path.split('/', 1)
-        aws_bucket = s3.Bucket(bucket_name)
-        pref_filter = ds_name
-        for obj in aws_bucket.objects.filter(Prefix=pref_filter):
-            for suffix in file_types:
-                if obj.key.endswith(suffix):
-                    file_name = obj.key.split('/')[-1]
-                    file = aws_download_file(bucket_name, ds_name, file_name)
-                    if file:
-                        out_path = os.path.join(output_dir, aws_path) if use_path else output_dir
-                        save_file(file, out_path, file_name, data_type='binary')
+        for kind in ('imzML', 'ibd'):
+            for obj in index.files(ds_id, [kind]):
+                me['s3dir'][kind] = index.datasets[ds_id]['bucket'] + "/" + obj['Key']
+        yield ds_id, me
+
+
+def get_study_json(ds_ids, output_dir, std_title, shard=None, lines=False):
+    # Returns the number of datasets written; without a shard they are written to <std_title>.json
+    # (.jsonl with lines) as they come
+    shard_ids = list(select(ds_ids, lambda ds_id: ds_id, shard))
+    index = build_index(shard_ids)
+    if shard:
+        # combined into std_title.json by --merge-shards
+        std_json = OrderedDict(iter_study_json(shard_ids, index))
+        write_shard_study_json(output_dir, std_title, shard, ds_ids, std_json)
+        return len(std_json)
+    with StudyJsonWriter(study_json_file(output_dir, std_title, lines), lines) as writer:
+        for ds_id, me in iter_study_json(shard_ids, index):
+            writer.write(me)
+    return writer.count
+
+
+def get_all_files(ds_ids, file_types, output_dir, use_path=False,
+                  part_size=config.MULTIPART_PART_SIZE, max_concurrency=config.MULTIPART_CONCURRENCY,
+                  scheduler=None, shard=None, claims=None, store=None):
+
+    scheduler = scheduler or TransferScheduler()
+    manifest = TransferManifest(output_dir, manifest_name(shard))
+    # listed again, the files are downloaded by Size and ETag
+    index = build_index(ds_ids, refresh=True)
+    # datasets whose files could not be listed are reported and fail the run like failed transfers
+    for ds_id, error in index.failures.items():
+        scheduler.fail(ds_id, error)
+    kinds = file_kinds(file_types)
+    items = [(ds_id, obj) for ds_id in ds_ids for obj in index.files(ds_id, kinds)]
+    for ds_id, obj in select(items, lambda item: item[0] + '/' + item[1]['Key'], shard, steal=claims is not None):
+        logger.info("Getting file %s for %s", obj['Key'], ds_id)
+        bucket_name = index.datasets[ds_id]['bucket']
+        aws_path = index.datasets[ds_id]['path']
+        out_path = os.path.join(output_dir, aws_path) if use_path else output_dir
+        file_name = obj['Key'].split('/')[-1]
+        scheduler.submit_download(ds_id, bucket_name, os.path.dirname(obj['Key']), file_name, out_path,
+                                  size=obj['Size'], etag=obj['ETag'],
+                                  part_size=part_size, max_concurrency=max_concurrency, manifest=manifest,
+                                  claims=claims, claim_key=ds_id + '/' + obj['Key'], store=store)
+    return scheduler.wait()
+
+
+def local_files(source, exclude=config.UPLOAD_EXCLUDE):
+    # (path, size) of the file source or of the files under the folder source, without those matching exclude
+    def excluded(name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in exclude)
+
+    if not os.path.isdir(source):
+        return [(source, os.path.getsize(source))]
+    files = []
+    for directory, dir_names, file_names in os.walk(source):
+        dir_names[:] = [name for name in dir_names if not excluded(name)]
+        for name in file_names:
+            if not excluded(name):
+                path = os.path.join(directory, name)
+                files.append((path, os.path.getsize(path)))
+    return files
+
+
+def upload_files(source, bucket_name, prefix='', part_size=config.MULTIPART_PART_SIZE,
+                 max_concurrency=config.MULTIPART_CONCURRENCY, scheduler=None):
+    scheduler = scheduler or TransferScheduler()
+    base = source if os.path.isdir(source) else os.path.dirname(source)
+    # largest first, so that the small files fill the workers while the multipart uploads finish
+    for path, size in sorted(local_files(source), key=lambda item: -item[1]):
+        relative = os.path.relpath(path, base).replace(os.sep, '/')
+        key = prefix.strip('/') + '/' + relative if prefix.strip('/') else relative
+        scheduler.submit_upload(relative, path, bucket_name, key, part_size=part_size,
+                                max_concurrency=max_concurrency)
+    return scheduler.wait()
+
+
+def verify_manifest(output_dir):
+    # Compare the transfer manifests of output_dir with the local files and the objects in S3
+    entries = {}
+    for path in sorted(glob.glob(os.path.join(glob.escape(output_dir), MANIFEST_PATTERN))):
+        entries.update(TransferManifest(output_dir, os.path.basename(path)).entries())
+    if not entries:
+        logger.warning("No transfer manifest found in %s", output_dir)
+    problems = 0
+    for name, entry in sorted(entries.items()):
+        target = os.path.join(output_dir, name)
+        try:
+            size, etag = head_object(entry['bucket'], entry['key'])
+        except Exception as exc:
+            # credential, permission or throttling errors say nothing about the object
+            if not is_not_found(exc):
+                raise
+            size, etag = None, None
+        if size is None:
+            status = 'MISSING IN S3'
+        elif (size, etag) != (entry['size'], entry['etag']):
+            status = 'CHANGED IN S3'
+        elif entry['state'] != COMPLETE:
+            status = 'INCOMPLETE'
+        elif not os.path.exists(target) or os.path.getsize(target) != entry['size']:
+            status = 'LOCAL MISMATCH'
+        else:
+            status = 'OK'
+        if status != 'OK':
+            problems += 1
+        print(status, entry['bucket'], entry['key'], target)
+    logger.info("Verified %d file(s), %d problem(s)", len(entries), problems)
+    return problems == 0
 
 
 def list_all_files(ds_ids, file_types):
 
-    session = boto3.Session(aws_cred.get_access_key, aws_cred.get_secret_access_key)
-    s3 = session.resource('s3')
-    sm = SMInstance()
+    index = build_index(ds_ids)
+    kinds = file_kinds(file_types)
     for ii, ds_id in enumerate(ds_ids):
         logger.info("Getting all files for %s", ds_id)
-        ds = sm.dataset(id=ds_id)
-        aws_path = ds.s3dir[6:]  # strip s3a://
-        bucket_name, ds_name = aws_path.split('/', 1)
-        aws_bucket = s3.Bucket(bucket_name)
-        pref_filter = ds_name
-        for obj in aws_bucket.objects.filter(Prefix=pref_filter):
-            for suffix in file_types:
-                if obj.key.endswith(suffix):
-                    print(bucket_name, obj.key)
+        for obj in index.files(ds_id, kinds):
+            print(index.datasets[ds_id]['bucket'], obj['Key'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from clients import get_moldb
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+class MoleculeLookup(object):
+    # Molecule names and ids of the sum formulas found in annotations. Formulas are deduplicated,
+    # the missing ones are looked up concurrently (the moldb service only resolves one formula per call)
+    # and kept in a bounded LRU that is saved per molecular database version for the next runs.
+    # The saved lookups are not used once older than ttl seconds, nor with refresh (then saved again).
+
+    def __init__(self, database=config.DATABASE, max_entries=config.MOLDB_CACHE_MAX_ENTRIES,
+                 max_workers=config.MOLDB_MAX_WORKERS, path=None, persist=True, refresh=False, ttl=config.CACHE_TTL):
+        self.database = database
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+        self.path = path or os.path.join(config.CACHE_DIR, 'moldb-%s.json' % database)
+        self.persist = persist
+        self.ttl = ttl
+        self.requested = 0
+        self.fetched = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if persist and not refresh:
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        if time.time() - os.path.getmtime(self.path) > self.ttl:
+            logger.info("Ignoring molecule lookup cache %s, older than %d seconds", self.path, self.ttl)
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as data_file:
+                saved = json.load(data_file)
+        except ValueError:
+            logger.warning("Ignoring unreadable molecule lookup cache %s", self.path)
+            return
+        for formula, names, ids in saved.get('entries', []):
+            self._entries[formula] = (names, ids)
+        logger.info("Loaded %d formulas for %s from %s", len(self._entries), self.database, self.path)
+
+    def save(self):
+        if not self.persist:
+            return
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            saved = dict(database=self.database,
+                         entries=[[formula, names, ids] for formula, (names, ids) in self._entries.items()])
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as data_file:
+            json.dump(saved, data_file)
+        os.replace(tmp_path, self.path)
+
+    def _store(self, formula, value):
+        with self._lock:
+            self._entries[formula] = value
+            self._entries.move_to_end(formula)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _fetch(self, formula):
+        db = get_moldb(self.database)
+        with timed('moldb.lookup'):
+            value = (db.names(formula), db.ids(formula))
+        self._store(formula, value)
+        return value
+
+    def resolve(self, formulas):
+        # Returns {formula: (names, ids)} for all the given formulas
+        formulas = list(formulas)
+        unique = list(OrderedDict.fromkeys(formulas))
+        resolved = {}
+        with self._lock:
+            self.requested += len(formulas)
+            for formula in unique:
+                if formula in self._entries:
+                    self._entries.move_to_end(formula)
+                    resolved[formula] = self._entries[formula]
+            missing = [formula for formula in unique if formula not in resolved]
+            self.fetched += len(missing)
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                resolved.update(zip(missing, executor.map(self._fetch, missing)))
+        return resolved
+
+    def log_stats(self):
+        # every formula lookup is two moldb calls, names and ids
+        logger.info("Molecule lookups for %s: %d formulas requested, %d fetched, %d moldb calls avoided",
+                    self.database, self.requested, self.fetched, 2 * (self.requested - self.fetched))
@@ -0,0 +1,219 @@
+import atexit
+import errno
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import config
+from checksum import CHECKSUM_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+USED_SUFFIX = '.used'
+STATS_FILE = 'stats.json'
+FICLONE = 0x40049409  # Linux ioctl cloning a file on copy-on-write file systems (btrfs, xfs)
+
+
+def _hardlink(source, target):
+    os.link(source, target)
+
+
+def _reflink(source, target):
+    import fcntl
+
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+
+
+def _copy(source, target):
+    shutil.copyfile(source, target)
+
+
+LINK_MODES = {'hardlink': _hardlink, 'reflink': _reflink, 'copy': _copy}
+
+
+def place(source, target, modes=config.STORE_LINK_MODES):
+    # link or copy source to target through a temporary name, trying modes in order; returns the mode used
+    directory = os.path.dirname(target)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    temporary = target + '.link'
+    error = None
+    for mode in modes:
+        try:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            LINK_MODES[mode](source, temporary)
+            os.replace(temporary, target)
+            return mode
+        except (OSError, IOError) as exc:
+            error = exc
+            if os.path.exists(temporary):
+                os.remove(temporary)
+    raise error
+
+
+class ObjectStore(object):
+    # Store of downloaded S3 objects shared by every output folder, keyed by ETag and size:
+    # <path>/objects/<ab>/<etag>-<size>. Files found in the store are hard linked (or reflinked, or
+    # copied, in the order of modes) into the output folder instead of being downloaded again.
+    # Above max_bytes the least recently used objects are removed; files linked into output folders
+    # stay where they are.
+
+    def __init__(self, path=config.STORE_DIR, max_bytes=config.STORE_MAX_BYTES, modes=config.STORE_LINK_MODES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.modes = modes
+        self.files_deduplicated = 0
+        self.bytes_deduplicated = 0
+        self.files_added = 0
+        self.bytes_added = 0
+        self.modes_used = {}
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _object_path(self, etag, size):
+        key = etag.strip('"')
+        return os.path.join(self.path, 'objects', key[:2], '%s-%d' % (key, size))
+
+    def _objects(self):
+        # (last use, path, size) of every object
+        objects = []
+        for directory, _, files in os.walk(os.path.join(self.path, 'objects')):
+            for name in files:
+                if name.endswith(USED_SUFFIX) or name.endswith(CHECKSUM_SUFFIX) or name.endswith('.part'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    used = os.path.getmtime(path + USED_SUFFIX) if os.path.exists(path + USED_SUFFIX) else 0
+                    objects.append((used, path, os.path.getsize(path)))
+                except OSError:
+                    pass  # removed by another process
+        return objects
+
+    def _place(self, source, target):
+        return place(source, target, self.modes)
+
+    @staticmethod
+    def _touch(path):
+        with open(path + USED_SUFFIX, 'a'):
+            pass
+        os.utime(path + USED_SUFFIX)
+
+    def link_into(self, etag, size, out_path, file_name):
+        # Put the stored object with etag and size at out_path/file_name; returns the mode used,
+        # or None when it is not in the store
+        if not etag:
+            return None
+        source = self._object_path(etag, size)
+        try:
+            if os.path.getsize(source) != size:
+                return None
+            mode = self._place(source, os.path.join(out_path, file_name))
+            if os.path.exists(source + CHECKSUM_SUFFIX):
+                shutil.copyfile(source + CHECKSUM_SUFFIX, os.path.join(out_path, file_name + CHECKSUM_SUFFIX))
+            self._touch(source)
+        except (OSError, IOError) as exc:
+            if getattr(exc, 'errno', None) != errno.ENOENT:
+                logger.warning("Could not use stored object %s: %s", source, exc)
+            return None
+        with self._lock:
+            self.files_deduplicated += 1
+            self.bytes_deduplicated += size
+            self.modes_used[mode] = self.modes_used.get(mode, 0) + 1
+        logger.info("Linked %s from the object store (%s)", os.path.join(out_path, file_name), mode)
+        return mode
+
+    def add(self, file_path, etag, size):
+        # Keep a downloaded file in the store, then evict the least recently used objects if needed
+        if not etag:
+            return
+        target = self._object_path(etag, size)
+        if os.path.exists(target):
+            return
+        try:
+            self._place(file_path, target)
+            if os.path.exists(file_path + CHECKSUM_SUFFIX):
+                shutil.copyfile(file_path + CHECKSUM_SUFFIX, target + CHECKSUM_SUFFIX)
+            self._touch(target)
+        except (OSError, IOError) as exc:
+            logger.warning("Could not add %s to the object store: %s", file_path, exc)
+            return
+        with self._lock:
+            self.files_added += 1
+            self.bytes_added += size
+            if self._size is None:
+                self._size = sum(object_size for used, path, object_size in self._objects())
+            else:
+                self._size += size
+            over = self._size > self.max_bytes
+        if over:
+            self.collect_garbage()
+
+    def collect_garbage(self):
+        # remove the least recently used objects until the store is back under 90% of max_bytes
+        objects = sorted(self._objects())
+        size = sum(object_size for used, path, object_size in objects)
+        target = self.max_bytes * 0.9
+        removed = freed = 0
+        for used, path, object_size in objects:
+            if size <= target:
+                break
+            for name in (path, path + USED_SUFFIX, path + CHECKSUM_SUFFIX):
+                if os.path.exists(name):
+                    os.remove(name)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass  # other objects left in the folder
+            size -= object_size
+            freed += object_size
+            removed += 1
+        with self._lock:
+            self._size = size
+        if removed:
+            logger.info("Removed %d object(s), %d bytes from the object store %s", removed, freed, self.path)
+        return removed
+
+    def _load_stats(self):
+        try:
+            with open(os.path.join(self.path, STATS_FILE)) as data_file:
+                return json.load(data_file)
+        except (IOError, ValueError):
+            return {}
+
+    def close(self):
+        # add this run's counters to the totals of the store and log them
+        if not (self.files_deduplicated or self.files_added):
+            return
+        stats = self._load_stats()
+        for key in ('files_deduplicated', 'bytes_deduplicated', 'files_added', 'bytes_added'):
+            stats[key] = stats.get(key, 0) + getattr(self, key)
+        stats['updated'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        stats_file = os.path.join(self.path, STATS_FILE)
+        with open(stats_file + '.part', 'w') as data_file:
+            json.dump(stats, data_file, indent=2, sort_keys=True)
+        os.replace(stats_file + '.part', stats_file)
+        logger.info("Object store %s: %d file(s), %d bytes deduplicated (%s), %d file(s), %d bytes added",
+                    self.path, self.files_deduplicated, self.bytes_deduplicated,
+                    ', '.join('%s %d' % item for item in sorted(self.modes_used.items())) or 'none',
+                    self.files_added, self.bytes_added)
+
+    def report(self):
+        objects = self._objects()
+        report = dict(path=self.path, objects=len(objects),
+                      bytes=sum(object_size for used, path, object_size in objects), max_bytes=self.max_bytes)
+        report.update(self._load_stats())
+        return report
+
+
+def open_store(path, max_bytes=config.STORE_MAX_BYTES):
+    # ObjectStore at path whose counters are saved and logged when the process exits
+    store = ObjectStore(path, max_bytes)
+    atexit.register(store.close)
+    return store
@@ -0,0 +1,207 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from aws_client import download_object
+from datasets import get_dataset_info, get_s3_location
+from manifest import TransferManifest
+from scheduler import AdaptiveLimit, call_with_retry
+from s3_index import list_dataset_files, entry_files, file_kinds
+from study_json import StudyJsonWriter, study_json_file
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+    # A pipeline stage: its workers take items from a bounded queue. busy is the time spent by the
+    # workers doing the stage's work, not waiting for items or for room in the next queue.
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue = None
+        self.items = 0
+        self.failures = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.started = None
+        self.finished = None
+
+    async def put(self, item):
+        await self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def depth(self):
+        return '%s %d/%d' % (self.name, self.queue.qsize(), self.queue_size)
+
+    def report(self):
+        wall = self.finished - self.started if self.started is not None else 0
+        logger.info("Stage %s: %d items, %d failed, %d workers, busy %.1fs, wall %.1fs, max queue depth %d/%d",
+                    self.name, self.items, self.failures, self.workers, self.busy, wall, self.max_depth,
+                    self.queue_size)
+
+
+class StudyPipeline(object):
+    # study ids -> METASPACE metadata -> S3 listing -> download, with bounded queues between the stages so
+    # the metadata of the next dataset is fetched while the files of the previous ones are listed and
+    # downloaded. The ISA-Tab study is written as soon as every dataset is listed, while the downloads go
+    # on, and the study JSON (as written by get_study_json) at the end.
+
+    def __init__(self, ds_ids, output_dir, std_title, std_description,
+                 file_types=('.imzML', '.ibd', '.jpg', '.jpeg', '.png'), use_path=False, stage_workers=None,
+                 queue_size=config.PIPELINE_QUEUE_SIZE, part_size=config.MULTIPART_PART_SIZE,
+                 max_concurrency=config.MULTIPART_CONCURRENCY, create_study=True, store=None, json_lines=False):
+        workers = dict(config.PIPELINE_STAGE_WORKERS, **(stage_workers or {}))
+        self.ds_ids = list(ds_ids)
+        self.output_dir = output_dir
+        self.std_title = std_title
+        self.std_description = std_description
+        self.kinds = file_kinds(file_types)
+        self.use_path = use_path
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.create_study = create_study
+        self.store = store
+        self.json_lines = json_lines
+        self.stages = OrderedDict((name, Stage(name, workers[name], queue_size))
+                                  for name in ('metadata', 'listing', 'download'))
+        self.samples = [None] * len(self.ds_ids)
+        self.study = None
+        self.bytes_transferred = 0
+        self._bytes_lock = threading.Lock()
+        self._manifest = TransferManifest(output_dir)
+        self._download_limit = AdaptiveLimit(workers['download'])
+        self._targets = set()
+        self._executor = None
+
+    def run(self):
+        start = time.monotonic()
+        asyncio.run(self._run())
+        elapsed = time.monotonic() - start
+        for stage in self.stages.values():
+            stage.report()
+        logger.info("Pipeline finished in %.1fs, %d bytes downloaded (%.2f MB/s)", elapsed, self.bytes_transferred,
+                    self.bytes_transferred / elapsed / (1024 * 1024) if elapsed else 0)
+        return self
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=sum(stage.workers for stage in self.stages.values()) + 1)
+        handlers = dict(metadata=self._metadata, listing=self._listing, download=self._download)
+        for stage in self.stages.values():
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+        tasks = [loop.create_task(self._worker(stage, handlers[stage.name]))
+                 for stage in self.stages.values() for _ in range(stage.workers)]
+        tasks.append(loop.create_task(self._monitor()))
+        listing_done = asyncio.Event()
+        isa_tab = loop.create_task(self._write_isa_tab(listing_done))
+        try:
+            for position, ds_id in enumerate(self.ds_ids):
+                await self.stages['metadata'].put((ds_id, position))
+            # every stage only hands items to the next one before marking its own items as done
+            await self.stages['metadata'].queue.join()
+            await self.stages['listing'].queue.join()
+            # every sample has its s3dir now, the Raw Spectral Data File columns need it
+            listing_done.set()
+            await self.stages['download'].queue.join()
+            await isa_tab
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._executor.shutdown()
+        self._write_study_json()
+
+    async def _worker(self, stage, handler):
+        while True:
+            item = await stage.queue.get()
+            if stage.started is None:
+                stage.started = time.monotonic()
+            try:
+                await handler(stage, item)
+                stage.items += 1
+            except Exception as exc:
+                stage.failures += 1
+                logger.warning("Stage %s failed for %s: %s", stage.name, item[0], exc)
+            finally:
+                stage.finished = time.monotonic()
+                stage.queue.task_done()
+
+    async def _call(self, stage, fn, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                  functools.partial(fn, *args, **kwargs))
+        finally:
+            stage.busy += time.monotonic() - start
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(config.PIPELINE_REPORT_INTERVAL)
+            logger.info("Pipeline queues: %s", ', '.join(stage.depth() for stage in self.stages.values()))
+
+    async def _metadata(self, stage, item):
+        ds_id, position = item
+        ds_info = await self._call(stage, get_dataset_info, ds_id=ds_id)
+        sample = json.loads(ds_info['metadata'])
+        sample['ds_id'] = ds_id
+        sample['s3dir'] = {}
+        self.samples[position] = sample
+        await self.stages['listing'].put((ds_id, position, ds_info))
+
+    async def _listing(self, stage, item):
+        ds_id, position, ds_info = item
+        entry = await self._call(stage, list_dataset_files, get_s3_location(ds_info), refresh=True)
+        s3dir = dict((kind, entry['bucket'] + '/' + obj['Key'])
+                     for kind in ('imzML', 'ibd') for obj in entry_files(entry, [kind]))
+        self.samples[position]['s3dir'] = s3dir
+        out_path = os.path.join(self.output_dir, entry['path']) if self.use_path else self.output_dir
+        for obj in entry_files(entry, self.kinds):
+            await self.stages['download'].put((ds_id, entry['bucket'], obj, out_path))
+
+    async def _download(self, stage, item):
+        ds_id, bucket_name, obj, out_path = item
+        file_name = obj['Key'].split('/')[-1]
+        # files of the same name from different datasets would otherwise be written to the same .part file
+        if (out_path, file_name) in self._targets:
+            return
+        self._targets.add((out_path, file_name))
+        # retried with backoff, and fewer downloads at once, while S3 throttles requests
+        await self._call(stage, call_with_retry, download_object,
+                         (bucket_name, os.path.dirname(obj['Key']), file_name, out_path),
+                         dict(size=obj['Size'], etag=obj['ETag'], part_size=self.part_size,
+                              max_concurrency=self.max_concurrency, callback=self._count_bytes,
+                              manifest=self._manifest, store=self.store),
+                         self._download_limit)
+
+    def _count_bytes(self, amount):
+        with self._bytes_lock:
+            self.bytes_transferred += amount
+
+    async def _write_isa_tab(self, listing_done):
+        await listing_done.wait()
+        samples = [sample for sample in self.samples if sample is not None]
+        if not self.create_study or not samples:
+            return
+        from isa_api_client import IsaApiClient
+
+        start = time.monotonic()
+        self.study = await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(IsaApiClient().new_study, self.std_title, self.std_description,
+                                              samples, self.output_dir, persist=True))
+        logger.info("ISA-Tab study written in %.1fs", time.monotonic() - start)
+
+    def _write_study_json(self):
+        with StudyJsonWriter(study_json_file(self.output_dir, self.std_title, self.json_lines),
+                             self.json_lines) as writer:
+            for sample in self.samples:
+                if sample is not None:
+                    writer.write(sample)
@@ -0,0 +1,88 @@
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from datasets import get_dataset_info, get_s3_location, list_dataset_objects
+
+logger = logging.getLogger(__name__)
+
+FILE_KINDS = {'imzML': ('.imzml',), 'ibd': ('.ibd',), 'images': ('.jpg', '.jpeg', '.png')}
+KIND_BY_EXTENSION = dict((extension, kind) for kind, extensions in FILE_KINDS.items() for extension in extensions)
+
+
+def file_kinds(file_types):
+    # kinds of file ('imzML', 'ibd', 'images') selected by a list of suffixes such as ['.imzML', '.png']
+    return set(KIND_BY_EXTENSION[suffix.lower()] for suffix in file_types if suffix.lower() in KIND_BY_EXTENSION)
+
+
+class S3Index(object):
+    # In memory index of the files of a set of METASPACE datasets, built with one exact-prefix paginated
+    # listing per dataset directory, run concurrently. Each entry holds the bucket, the dataset path
+    # and the imzML, ibd and images objects (Key, Size, ETag) found under it. With refresh the listings
+    # are not taken from the metadata cache (see datasets.list_dataset_objects).
+
+    def __init__(self, max_workers=config.LISTING_MAX_WORKERS, refresh=False):
+        self.max_workers = max_workers
+        self.refresh = refresh
+        self.datasets = {}
+        self.failures = {}
+
+    def build(self, ds_ids):
+        ds_ids = list(ds_ids)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            locations = dict(zip(ds_ids, executor.map(self._location, ds_ids)))
+            by_bucket = defaultdict(list)
+            for ds_id, location in locations.items():
+                if location:
+                    by_bucket[location[1]].append(ds_id)
+            for bucket_name, bucket_ds_ids in by_bucket.items():
+                logger.info("Listing %d dataset(s) in bucket %s", len(bucket_ds_ids), bucket_name)
+            listed = [ds_id for bucket_ds_ids in by_bucket.values() for ds_id in bucket_ds_ids]
+            for ds_id, entry in zip(listed, executor.map(lambda ds_id: self._list(ds_id, locations[ds_id]),
+                                                         listed)):
+                if entry:
+                    self.datasets[ds_id] = entry
+        return self
+
+    def _location(self, ds_id):
+        try:
+            return get_s3_location(get_dataset_info(ds_id=ds_id))
+        except Exception as exc:
+            logger.warning("Failed to get METASPACE information for %s: %s", ds_id, exc)
+            self.failures[ds_id] = str(exc)
+        return None
+
+    def _list(self, ds_id, location):
+        try:
+            return list_dataset_files(location, self.refresh)
+        except Exception as exc:
+            logger.warning("Failed to list files for %s: %s", ds_id, exc)
+            self.failures[ds_id] = str(exc)
+        return None
+
+    def files(self, ds_id, kinds):
+        entry = self.datasets.get(ds_id)
+        if not entry:
+            return []
+        return entry_files(entry, kinds)
+
+
+def list_dataset_files(location, refresh=False):
+    # index entry for one dataset, location as returned by datasets.get_s3_location
+    aws_path, bucket_name, ds_name = location
+    entry = dict(bucket=bucket_name, path=aws_path, imzML=[], ibd=[], images=[])
+    for obj in list_dataset_objects(bucket_name, ds_name.rstrip('/') + '/', refresh):
+        kind = KIND_BY_EXTENSION.get(os.path.splitext(obj['Key'])[1].lower())
+        if kind:
+            entry[kind].append(obj)
+    return entry
+
+
+def entry_files(entry, kinds):
+    return [obj for kind in FILE_KINDS if kind in kinds for obj in entry[kind]]
+
+
+def build_index(ds_ids, max_workers=config.LISTING_MAX_WORKERS, refresh=False):
+    return S3Index(max_workers, refresh).build(ds_ids)
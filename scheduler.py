@@ -0,0 +1,266 @@
+import logging
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from aws_client import download_object, upload_object
+
+logger = logging.getLogger(__name__)
+
+THROTTLE_ERROR_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                        'ServiceUnavailable', '503')
+
+
+def is_throttle_error(exc):
+    # botocore ClientError carries the parsed S3 response
+    response = getattr(exc, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in THROTTLE_ERROR_CODES or status == 503
+
+
+class BandwidthLimiter(object):
+    # Token bucket shared by all transfers, refilled at bytes_per_second with one second of burst
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self._tokens = self.rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveLimit(object):
+    # Semaphore whose size is halved when S3 throttles us and grows back by one
+    # after a full round of successful requests
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self._active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self._active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+            elif self.limit < self.maximum:
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+def resolve_in_order(items, resolve, max_workers, window=None):
+    # (item, resolve(item)) in the order of items, with up to window lookups running at once and
+    # without reading items further ahead than that
+    window = window or max_workers * 4
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(resolve, item)))
+            if len(pending) >= window:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def call_with_retry(fn, args, kwargs, limit, bucket_limit=None, max_attempts=config.SCHEDULER_MAX_ATTEMPTS):
+    # Call fn within limit (an AdaptiveLimit) and bucket_limit, retrying with exponential backoff and
+    # a lower limit while S3 throttles requests
+    for attempt in range(1, max_attempts + 1):
+        throttled = False
+        limit.acquire()
+        if bucket_limit:
+            bucket_limit.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as exc:
+            if not is_throttle_error(exc) or attempt == max_attempts:
+                raise
+            throttled = True
+        finally:
+            if bucket_limit:
+                bucket_limit.release()
+            limit.release(throttled)
+        delay = min(config.SCHEDULER_BACKOFF_MAX, config.SCHEDULER_BACKOFF_BASE * 2 ** (attempt - 1))
+        delay *= random.uniform(0.5, 1.0)
+        logger.warning("S3 is throttling requests, concurrency lowered to %d, retrying in %.1fs (attempt %d/%d)",
+                       limit.limit, delay, attempt, max_attempts)
+        time.sleep(delay)
+
+
+class TransferScheduler(object):
+    # Runs listing and download tasks for many datasets on a bounded worker pool.
+    # Tasks may submit further tasks; wait() returns once all of them are finished.
+    # A failing task is logged against its dataset and does not stop the others.
+    # Downloads skipped because another node holds their claim are tried again at the end, every
+    # claims.interval seconds for up to claim_wait seconds, so that stale claims are taken over; those
+    # still claimed after that are reported as unfinished.
+
+    def __init__(self, max_workers=config.SCHEDULER_MAX_WORKERS, bucket_workers=config.SCHEDULER_BUCKET_WORKERS,
+                 max_bandwidth=config.SCHEDULER_MAX_BANDWIDTH, max_attempts=config.SCHEDULER_MAX_ATTEMPTS,
+                 claim_wait=config.SHARD_CLAIM_MAX_WAIT):
+        self.max_attempts = max_attempts
+        self.claim_wait = claim_wait
+        self.bucket_workers = bucket_workers
+        self.limiter = BandwidthLimiter(max_bandwidth) if max_bandwidth else None
+        self.bytes_transferred = 0
+        self.files_transferred = 0
+        self.files_skipped = 0
+        self.failures = defaultdict(list)
+        self.unfinished = []
+        self._busy = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._limit = AdaptiveLimit(max_workers)
+        self._bucket_limits = {}
+        self._targets = set()
+        self._pending = 0
+        self._start = None
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    def submit(self, dataset, fn, *args, bucket=None, **kwargs):
+        with self._lock:
+            if self._start is None:
+                self._start = time.monotonic()
+            self._pending += 1
+        self._executor.submit(self._run, dataset, bucket, fn, args, kwargs)
+
+    def submit_download(self, dataset, bucket_name, aws_path, file_name, out_path, **kwargs):
+        # kwargs are passed to download_object, except claims/claim_key: with a sharding.ClaimStore the
+        # file is only downloaded if claim_key can be claimed.
+        target = (out_path, file_name)
+        with self._lock:
+            if target in self._targets:
+                return
+            self._targets.add(target)
+        self.submit(dataset, self._download, dataset, bucket_name, aws_path, file_name, out_path,
+                    bucket=bucket_name, **kwargs)
+
+    def submit_upload(self, dataset, path, bucket_name, key, **kwargs):
+        # kwargs are passed to upload_object
+        self.submit(dataset, self._upload, path, bucket_name, key, bucket=bucket_name, **kwargs)
+
+    def wait(self):
+        waited = 0
+        while True:
+            with self._done:
+                while self._pending:
+                    self._done.wait()
+                busy, self._busy = self._busy, []
+            if not busy:
+                break
+            if waited >= self.claim_wait:
+                self.unfinished = [kwargs['claim_key'] for dataset, args, kwargs in busy]
+                break
+            interval = busy[0][2]['claims'].interval
+            logger.info("%d file(s) claimed by other nodes, checking again in %.0fs", len(busy), interval)
+            time.sleep(interval)
+            waited += interval
+            for dataset, args, kwargs in busy:
+                self.submit(dataset, self._download, dataset, *args, bucket=args[0], **kwargs)
+        self._executor.shutdown()
+        self.report()
+        return self
+
+    def report(self):
+        elapsed = time.monotonic() - self._start if self._start is not None else 0
+        rate = self.bytes_transferred / elapsed / (1024 * 1024) if elapsed else 0
+        logger.info("Transferred %d files, %d bytes in %.1fs (%.2f MB/s)",
+                    self.files_transferred, self.bytes_transferred, elapsed, rate)
+        if self.files_skipped:
+            logger.info("Skipped %d files already up to date", self.files_skipped)
+        for dataset, errors in self.failures.items():
+            logger.warning("Dataset %s had %d failure(s): %s", dataset, len(errors), '; '.join(errors))
+        if self.unfinished:
+            logger.warning("%d file(s) still claimed by other nodes were left unfinished: %s",
+                           len(self.unfinished), ', '.join(self.unfinished))
+
+    def fail(self, dataset, error):
+        # counted in failures, as failed transfers are, e.g. datasets that could not be listed
+        with self._lock:
+            self.failures[dataset].append(error)
+
+    def count_bytes(self, amount):
+        if self.limiter:
+            self.limiter.consume(amount)
+        with self._lock:
+            self.bytes_transferred += amount
+
+    def _download(self, dataset, bucket_name, aws_path, file_name, out_path, claims=None, claim_key=None,
+                  **kwargs):
+        if claims and not claims.claim(claim_key):
+            if not claims.is_done(claim_key):
+                with self._lock:
+                    self._busy.append((dataset, (bucket_name, aws_path, file_name, out_path),
+                                       dict(kwargs, claims=claims, claim_key=claim_key)))
+            return None
+        try:
+            target = download_object(bucket_name, aws_path, file_name, out_path, callback=self.count_bytes,
+                                     **kwargs)
+            if claims:
+                claims.done(claim_key)
+        finally:
+            if claims:
+                claims.release(claim_key)
+        with self._lock:
+            self.files_transferred += 1
+        return target
+
+    def _upload(self, path, bucket_name, key, **kwargs):
+        sent = upload_object(path, bucket_name, key, callback=self.count_bytes, **kwargs)
+        with self._lock:
+            if sent is None:
+                self.files_skipped += 1
+            else:
+                self.files_transferred += 1
+        return sent
+
+    def _bucket_limit(self, bucket):
+        with self._lock:
+            if bucket not in self._bucket_limits:
+                self._bucket_limits[bucket] = threading.BoundedSemaphore(self.bucket_workers)
+            return self._bucket_limits[bucket]
+
+    def _run(self, dataset, bucket, fn, args, kwargs):
+        try:
+            self._call_with_retry(bucket, fn, args, kwargs)
+        except Exception as exc:
+            logger.warning("Transfer failed for %s: %s", dataset, exc)
+            self.fail(dataset, str(exc))
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if not self._pending:
+                    self._done.notify_all()
+
+    def _call_with_retry(self, bucket, fn, args, kwargs):
+        bucket_limit = self._bucket_limit(bucket) if bucket else None
+        return call_with_retry(fn, args, kwargs, self._limit, bucket_limit, self.max_attempts)
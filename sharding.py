@@ -0,0 +1,191 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+import config
+from study_json import StudyJsonWriter, study_json_file
+
+logger = logging.getLogger(__name__)
+
+CLAIM_DIR = '.mmit_claims'
+
+
+def stable_hash(value):
+    # same value on every node and run, unlike hash()
+    return int(hashlib.sha1(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class Shard(object):
+    # Shard <index> of <count>, index from 0 to count - 1. Work items are assigned by a stable hash of
+    # their key, e.g. dataset id or dataset id and file key.
+
+    def __init__(self, index, count):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError("Invalid shard %d/%d, expected i/N with 0 <= i < N" % (index, count))
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, value):
+        index, count = value.split('/')
+        return cls(int(index), int(count))
+
+    def owns(self, *parts):
+        return stable_hash('/'.join(parts)) % self.count == self.index
+
+    @property
+    def suffix(self):
+        return 'shard-%d-of-%d' % (self.index, self.count)
+
+    def __str__(self):
+        return '%d/%d' % (self.index, self.count)
+
+
+def select(items, key, shard=None, steal=False):
+    # Items owned by the shard, in order. With steal they are followed by the items of the other shards,
+    # last first, so an idle node works from the opposite end to their owners.
+    # Without a shard items is returned as is, so a generator is still consumed lazily.
+    if shard is None:
+        return items
+    items = list(items)
+    own, others = [], []
+    for item in items:
+        (own if shard.owns(key(item)) else others).append(item)
+    logger.info("Shard %s owns %d of %d items", shard, len(own), len(items))
+    return own + (others[::-1] if steal else [])
+
+
+class ClaimStore(object):
+    # Lock files in <output_dir>/.mmit_claims shared by the nodes working on the same study. A node claims
+    # an item by creating its lock file, refreshes it while working on the item and leaves a .done marker
+    # once finished. Claims not refreshed for stale_after seconds are taken over by other nodes.
+
+    def __init__(self, output_dir, stale_after=config.SHARD_CLAIM_STALE_SECONDS):
+        self.path = os.path.join(output_dir, CLAIM_DIR)
+        self.stale_after = stale_after
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self._active = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, item):
+        return os.path.join(self.path, hashlib.sha1(item.encode('utf-8')).hexdigest())
+
+    def is_done(self, item):
+        return os.path.exists(self._file(item) + '.done')
+
+    def _create(self, lock_file):
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as data_file:
+            data_file.write(self.owner)
+        return True
+
+    def _take_over(self, lock_file):
+        try:
+            if time.time() - os.path.getmtime(lock_file) < self.stale_after:
+                return False
+            # only one node can rename the stale lock away
+            stale_file = '%s.stale-%s' % (lock_file, re.sub(r'[^A-Za-z0-9]+', '_', self.owner))
+            os.rename(lock_file, stale_file)
+            os.remove(stale_file)
+        except OSError:
+            return False
+        return self._create(lock_file)
+
+    def claim(self, item):
+        if self.is_done(item):
+            return False
+        lock_file = self._file(item) + '.lock'
+        if not self._create(lock_file):
+            if not self._take_over(lock_file):
+                return False
+            logger.info("Took over stale claim on %s", item)
+        if self.is_done(item):
+            os.remove(lock_file)
+            return False
+        with self._lock:
+            self._active.add(lock_file)
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name='claim-heartbeat', daemon=True)
+                self._heartbeat.start()
+        return True
+
+    def done(self, item):
+        open(self._file(item) + '.done', 'w').close()
+
+    def release(self, item):
+        lock_file = self._file(item) + '.lock'
+        with self._lock:
+            self._active.discard(lock_file)
+        if os.path.exists(lock_file):
+            os.remove(lock_file)
+
+    @property
+    def interval(self):
+        # claims are refreshed, and busy ones checked again, this often
+        return self.stale_after / 3.0
+
+    def _beat(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active)
+            for lock_file in active:
+                try:
+                    os.utime(lock_file)
+                except OSError:
+                    pass
+
+
+def shard_study_file(output_dir, std_title, shard):
+    return os.path.join(output_dir, '%s.%s.json' % (std_title, shard.suffix))
+
+
+def write_shard_study_json(output_dir, std_title, shard, ds_ids, datasets):
+    # datasets: {ds_id: study JSON entry} for the datasets of this shard; ds_ids: all the ids of the study
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    with open(shard_study_file(output_dir, std_title, shard), 'w') as data_file:
+        json.dump(dict(shard=shard.index, count=shard.count, ds_ids=list(ds_ids), datasets=datasets), data_file)
+
+
+def merge_study_json(output_dir, std_title, ds_ids=None, lines=False):
+    # Combine the per shard study JSON files into <std_title>.json (.jsonl with lines), in the order of ds_ids
+    # (by default the order the study ids were given to the shards)
+    datasets = {}
+    shards = set()
+    count = None
+    order = ds_ids
+    pattern = os.path.join(glob.escape(output_dir), glob.escape(std_title) + '.shard-*-of-*.json')
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r', encoding='utf-8') as data_file:
+            part = json.load(data_file)
+        shards.add(part['shard'])
+        count = part['count']
+        order = order or part['ds_ids']
+        datasets.update(part['datasets'])
+    if count is None:
+        raise IOError("No shard files found for %s in %s" % (std_title, output_dir))
+    missing_shards = sorted(set(range(count)) - shards)
+    if missing_shards:
+        logger.warning("Missing results of shard(s) %s of %d", ', '.join(map(str, missing_shards)), count)
+    missing = [ds_id for ds_id in order if ds_id not in datasets]
+    if missing:
+        logger.warning("No study JSON information for %d dataset(s): %s", len(missing), ', '.join(missing))
+    std_json = [datasets[ds_id] for ds_id in order if ds_id in datasets]
+    with StudyJsonWriter(study_json_file(output_dir, std_title, lines), lines) as writer:
+        for sample in std_json:
+            writer.write(sample)
+    logger.info("Merged %d dataset(s) from %d shard file(s) into %s", len(std_json), len(shards), writer.path)
+    return std_json
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import re
+
+import config
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+LINES_SUFFIX = '.jsonl'
+
+
+class JsonArrayReader(object):
+    # Values of the top level array of a JSON text file, decoded one at a time: only the value being
+    # decoded and the rest of the last chunk read are held in memory.
+
+    def __init__(self, data_file, chunk_size=config.JSON_READ_CHUNK_SIZE):
+        self.data_file = data_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _read(self, size):
+        # False at the end of the file
+        chunk = self.data_file.read(size)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        self.eof = not chunk
+        return not self.eof
+
+    def peek(self):
+        # next character that is not whitespace, '' at the end of the file
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read(self.chunk_size):
+                return ''
+
+    def _expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %s instead of %r in %s" %
+                             (', '.join(chars), char or 'end of file', getattr(self.data_file, 'name', 'JSON input')))
+        self.position += 1
+        return char
+
+    def _value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a number may go on in the next chunk
+                if self.eof or not NUMBER_TAIL.match(self.buffer, end):
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # read at least as much again as the value decoded so far, so large values take few attempts
+            self._read(max(self.chunk_size, len(self.buffer) - self.position))
+
+    def __iter__(self):
+        self._expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+
+def iter_json_lines(data_file):
+    for line in data_file:
+        if line.strip():
+            yield json.loads(line)
+
+
+class StudyJson(object):
+    # Samples of a study JSON file (-i), read from the file again on every iteration: a JSON array as
+    # written by get_study_json, or JSON Lines with one sample per line.
+
+    def __init__(self, path, chunk_size=config.JSON_READ_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as data_file:
+            reader = JsonArrayReader(data_file, self.chunk_size)
+            if reader.peek() == '[':
+                for sample in reader:
+                    yield sample
+                return
+            data_file.seek(0)
+            for sample in iter_json_lines(data_file):
+                yield sample
+
+
+def study_json_file(output_dir, std_title, lines=False):
+    return os.path.join(output_dir, std_title + (LINES_SUFFIX if lines else '.json'))
+
+
+class StudyJsonWriter(object):
+    # Writes samples to <path>.part as they come, as a JSON array or, with lines, one JSON object per line,
+    # and moves it to path once closed.
+
+    def __init__(self, path, lines=False):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lines = lines
+        self.count = 0
+        self._file = open(path + '.part', 'w', encoding='utf-8')
+        if not lines:
+            self._file.write('[')
+
+    def write(self, sample):
+        if self.lines:
+            self._file.write(json.dumps(sample) + '\n')
+        else:
+            self._file.write((', ' if self.count else '') + json.dumps(sample))
+        self.count += 1
+
+    def close(self):
+        if not self.lines:
+            self._file.write(']')
+        self._file.close()
+        os.replace(self.path + '.part', self.path)
+        logger.info("Wrote %d sample(s) to %s", self.count, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
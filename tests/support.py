@@ -0,0 +1,170 @@
+import hashlib
+import shutil
+import tempfile
+import unittest
+import uuid
+
+import clients
+from benchmarks.standins import install, MB
+
+BUCKET = 'test-bucket'
+
+
+def content(obj):
+    # bytes of a stand-in S3 object
+    return b''.join(obj.chunks(0, obj.size - 1, MB))
+
+
+def read(path):
+    with open(path, 'rb') as data_file:
+        return data_file.read()
+
+
+class BytesObject(object):
+    # stand-in S3 object with the given content
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+    def chunks(self, start, end, chunk_size):
+        for position in range(start, end + 1, chunk_size):
+            yield self.data[position:min(position + chunk_size, end + 1)]
+
+
+IMZML_HEADER = \
+    '<?xml version="1.0" encoding="ISO-8859-1"?>\n' \
+    '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1">' \
+    '<fileDescription><fileContent><cvParam cvRef="IMS" accession="%s" name="%s"/>' \
+    '<cvParam cvRef="IMS" accession="IMS:1000080" name="universally unique identifier" value="{%s}"/>' \
+    '</fileContent></fileDescription>' \
+    '<referenceableParamGroupList count="2">' \
+    '<referenceableParamGroup id="mzArray"><cvParam cvRef="MS" accession="MS:1000514" name="m/z array"/>' \
+    '<cvParam cvRef="MS" accession="MS:1000523" name="64-bit float"/></referenceableParamGroup>' \
+    '<referenceableParamGroup id="intensities"><cvParam cvRef="MS" accession="MS:1000515" name="intensity array"/>' \
+    '<cvParam cvRef="MS" accession="MS:1000521" name="32-bit float"/></referenceableParamGroup>' \
+    '</referenceableParamGroupList><run id="run"><spectrumList count="%d">'
+IMZML_SPECTRUM = \
+    '<spectrum id="spectrum=%d" index="%d"><scanList count="1"><scan>' \
+    '<cvParam cvRef="IMS" accession="IMS:1000050" name="position x" value="%d"/>' \
+    '<cvParam cvRef="IMS" accession="IMS:1000051" name="position y" value="%d"/></scan></scanList>' \
+    '<binaryDataArrayList count="2">' \
+    '<binaryDataArray encodedLength="0"><referenceableParamGroupRef ref="mzArray"/>' \
+    '<cvParam cvRef="IMS" accession="IMS:1000102" name="external offset" value="%d"/>' \
+    '<cvParam cvRef="IMS" accession="IMS:1000103" name="external array length" value="%d"/>' \
+    '<cvParam cvRef="IMS" accession="IMS:1000104" name="external encoded length" value="%d"/>' \
+    '<binary/></binaryDataArray>' \
+    '<binaryDataArray encodedLength="0"><referenceableParamGroupRef ref="intensities"/>' \
+    '<cvParam cvRef="IMS" accession="IMS:1000102" name="external offset" value="%d"/>' \
+    '<cvParam cvRef="IMS" accession="IMS:1000103" name="external array length" value="%d"/>' \
+    '<cvParam cvRef="IMS" accession="IMS:1000104" name="external encoded length" value="%d"/>' \
+    '<binary/></binaryDataArray></binaryDataArrayList></spectrum>'
+IMZML_FOOTER = '</spectrumList></run></mzML>\n'
+
+
+def write_imzml(path, width, height, seed=0, continuous=False):
+    # Write <path>.imzML and <path>.ibd with random spectra for width x height pixels (processed mode
+    # with up to 40 peaks per pixel, or continuous with 50 shared m/z values); returns the spectra as
+    # {(x, y): (m/z array, intensity array)}
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+    file_uuid = uuid.UUID(int=rng.randint(2 ** 31))
+    shared_mz = np.sort(rng.uniform(100, 1000, 50)).astype('<f8')
+    spectra = {}
+    entries = []
+    with open(path + '.ibd', 'wb') as ibd_file:
+        ibd_file.write(file_uuid.bytes)
+        position = len(file_uuid.bytes)
+        if continuous:
+            ibd_file.write(shared_mz.tobytes())
+            shared_offset = position
+            position += shared_mz.nbytes
+        for y in range(1, height + 1):
+            for x in range(1, width + 1):
+                if continuous:
+                    mz, mz_offset = shared_mz, shared_offset
+                else:
+                    mz = np.sort(rng.uniform(100, 1000, rng.randint(0, 40))).astype('<f8')
+                    ibd_file.write(mz.tobytes())
+                    mz_offset = position
+                    position += mz.nbytes
+                intensities = rng.uniform(0, 100, len(mz)).astype('<f4')
+                ibd_file.write(intensities.tobytes())
+                entries.append((x, y, mz_offset, len(mz), position))
+                position += intensities.nbytes
+                spectra[(x, y)] = (mz, intensities)
+    mode = ('IMS:1000030', 'continuous') if continuous else ('IMS:1000031', 'processed')
+    with open(path + '.imzML', 'w', encoding='ISO-8859-1') as imzml_file:
+        imzml_file.write(IMZML_HEADER % (mode + (str(file_uuid).upper(), len(entries))))
+        for i, (x, y, mz_offset, length, int_offset) in enumerate(entries):
+            imzml_file.write(IMZML_SPECTRUM % (i, i, x, y, mz_offset, length, length * 8, int_offset, length,
+                                               length * 4))
+        imzml_file.write(IMZML_FOOTER)
+    return spectra
+
+
+class FakeResponse(object):
+    # the parts of a requests.Response used by http_cache
+
+    def __init__(self, status_code, body=b'', etag=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {'ETag': etag} if etag else {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError(self.status_code)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+class FakeSession(object):
+    # HTTP session serving body at every URL, answering with 304 when If-None-Match is its ETag;
+    # status_code other than 200 is returned for every request
+
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        etag = '"%s"' % hashlib.md5(self.body).hexdigest()
+        if self.status_code != 200:
+            return FakeResponse(self.status_code)
+        if (headers or {}).get('If-None-Match') == etag:
+            return FakeResponse(304)
+        return FakeResponse(200, self.body, etag)
+
+
+class StandinTestCase(unittest.TestCase):
+    # Runs each test in its own temporary folder against fresh S3 and METASPACE stand-ins
+    # (benchmarks/standins.py) serving the study of make_study.
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        self.s3, self.sm = install(self.make_study())
+        self.addCleanup(clients.reset)
+
+    def make_study(self):
+        return None
+
+    def put(self, key, size, seed=1):
+        self.s3.put(BUCKET, key, size, seed)
+        return self.s3.objects[(BUCKET, key)]
+
+    def put_file(self, key, path):
+        with open(path, 'rb') as data_file:
+            self.s3.objects[(BUCKET, key)] = BytesObject(data_file.read())
+        return self.s3.objects[(BUCKET, key)]
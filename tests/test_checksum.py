@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+
+from aws_client import download_object
+from checksum import ChecksumError, CHECKSUM_SUFFIX, etag_part_count, etag_part_sizes, multipart_etag
+from manifest import TransferManifest
+from tests.support import StandinTestCase, BUCKET, MB, content, read
+
+SIZE = 10 * MB + 7
+
+
+class EtagTest(StandinTestCase):
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        self.obj = self.put('ds/sample.ibd', SIZE)
+
+    def download(self, **kwargs):
+        kwargs.setdefault('threshold', MB)
+        return download_object(BUCKET, 'ds', 'sample.ibd', self.tmp_dir, **kwargs)
+
+    def sidecar(self):
+        with open(os.path.join(self.tmp_dir, 'sample.ibd' + CHECKSUM_SUFFIX)) as data_file:
+            return json.load(data_file)
+
+    def set_multipart_etag(self, part_size):
+        # as if the object had been uploaded in parts of part_size
+        data = content(self.obj)
+        self.obj.etag = '"%s"' % multipart_etag([hashlib.md5(data[start:start + part_size]).digest()
+                                                for start in range(0, len(data), part_size)])
+
+    def test_part_sizes_of_multipart_etag(self):
+        self.assertIsNone(etag_part_count('"%s"' % ('0' * 32)))
+        self.assertEqual(etag_part_count('"%s-3"' % ('0' * 32)), 3)
+        self.assertIn(5 * MB, etag_part_sizes(SIZE, 3))
+        self.assertEqual(etag_part_sizes(SIZE, None), [])
+
+    def test_single_stream_md5_etag(self):
+        target = self.download(max_concurrency=1)
+        self.assertEqual(read(target), content(self.obj))
+        sidecar = self.sidecar()
+        self.assertTrue(sidecar['verified'])
+        self.assertEqual(sidecar['sha256'], hashlib.sha256(content(self.obj)).hexdigest())
+
+    def test_ranged_md5_etag(self):
+        self.download(part_size=3 * MB, max_concurrency=4)
+        self.assertTrue(self.sidecar()['verified'])
+
+    def test_multipart_etag_of_the_same_part_size(self):
+        self.set_multipart_etag(5 * MB)
+        self.download(part_size=5 * MB, max_concurrency=4)
+        self.assertTrue(self.sidecar()['verified'])
+
+    def test_multipart_etag_of_another_part_size(self):
+        self.set_multipart_etag(5 * MB)
+        self.download(part_size=MB, max_concurrency=4)
+        sidecar = self.sidecar()
+        self.assertTrue(sidecar['verified'])
+        # the requested part size is kept for the ranged GETs
+        self.assertEqual((sidecar['part_size'], sidecar['parts']), (MB, 11))
+
+    def test_multipart_etag_single_stream(self):
+        self.set_multipart_etag(5 * MB)
+        self.download(max_concurrency=1)
+        self.assertTrue(self.sidecar()['verified'])
+
+    def test_mismatch_removes_the_file(self):
+        self.obj.etag = '"%s"' % ('0' * 32)
+        manifest = TransferManifest(self.tmp_dir)
+        self.assertRaises(ChecksumError, self.download, part_size=3 * MB, max_concurrency=4, manifest=manifest)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'sample.ibd')))
+        self.assertEqual(TransferManifest(self.tmp_dir).entries()['sample.ibd']['parts'], [])
@@ -0,0 +1,62 @@
+import os
+from unittest import mock
+
+import cache
+import mmit
+from benchmarks.standins import SyntheticStudy
+from s3_index import build_index
+from tests.support import StandinTestCase, MB, content, read
+
+
+class ListingCacheTest(StandinTestCase):
+
+    def make_study(self):
+        self.study = SyntheticStudy(datasets=2, imzml_size=MB, ibd_size=MB, images=0)
+        return self.study
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        cache._cache = cache.MetadataCache(os.path.join(self.tmp_dir, 'cache.sqlite'))
+        self.addCleanup(cache.configure, enabled=False)
+
+    def change(self, key):
+        size = self.s3.objects[(SyntheticStudy.BUCKET, key)].size
+        self.s3.put(SyntheticStudy.BUCKET, key, size, seed=99)
+        return self.s3.objects[(SyntheticStudy.BUCKET, key)]
+
+    def test_listings_are_cached(self):
+        build_index(self.study.ds_ids)
+        hits = cache.get_cache().hits
+        build_index(self.study.ds_ids)
+        self.assertEqual(cache.get_cache().hits, hits + 4)
+
+    def test_downloads_see_objects_changed_after_they_were_listed(self):
+        key = self.study.objects[1][0]
+        out_dir = os.path.join(self.tmp_dir, 'out')
+        mmit.get_all_files(self.study.ds_ids, ['.ibd'], out_dir)
+        build_index(self.study.ds_ids)
+        obj = self.change(key)
+        scheduler = mmit.get_all_files(self.study.ds_ids, ['.ibd'], out_dir)
+        self.assertFalse(scheduler.failures)
+        self.assertEqual(read(os.path.join(out_dir, os.path.basename(key))), content(obj))
+        # and the cache has the new listing
+        entry = build_index(self.study.ds_ids).datasets[self.study.ds_ids[0]]
+        self.assertEqual(entry['ibd'][0]['ETag'], obj.etag)
+
+    def test_datasets_that_cannot_be_listed_are_failures(self):
+        import s3_index
+
+        get_dataset_info = s3_index.get_dataset_info
+        missing = self.study.ds_ids[1]
+
+        def failing_get_dataset_info(ds_id=None, name=None):
+            if ds_id == missing:
+                raise RuntimeError('not found')
+            return get_dataset_info(ds_id=ds_id, name=name)
+
+        out_dir = os.path.join(self.tmp_dir, 'out')
+        with mock.patch.object(s3_index, 'get_dataset_info', failing_get_dataset_info):
+            scheduler = mmit.get_all_files(self.study.ds_ids, ['.ibd'], out_dir)
+        self.assertEqual(dict(scheduler.failures), {missing: ['not found']})
+        self.assertEqual(read(os.path.join(out_dir, os.path.basename(self.study.objects[1][0]))),
+                         content(self.s3.objects[(SyntheticStudy.BUCKET, self.study.objects[1][0])]))
@@ -0,0 +1,84 @@
+import os
+
+import clients
+from http_cache import HttpCache
+from tests.support import StandinTestCase, FakeSession, read
+
+URL = 'https://metaspace2020.eu/fs/optical_images/ds'
+BODY = b'optical image ' * 10000
+
+
+class HttpCacheTest(StandinTestCase):
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        self.session = FakeSession(BODY)
+        clients._clients['http'] = self.session
+        self.cache_dir = os.path.join(self.tmp_dir, 'http_cache')
+        self.out_path = os.path.join(self.tmp_dir, 'out')
+
+    def fetch(self, cache, out_dir='out', url=URL):
+        return cache.fetch(url, os.path.join(self.tmp_dir, out_dir), 'optical.jpg')
+
+    def test_cached_copy_is_revalidated(self):
+        cache = HttpCache(self.cache_dir, chunk_size=4096)
+        self.fetch(cache)
+        self.assertNotIn('If-None-Match', self.session.requests[0])
+        target = self.fetch(cache, 'other')
+        self.assertIn('If-None-Match', self.session.requests[1])
+        self.assertEqual(read(target), BODY)
+        self.assertEqual((cache.hits, cache.misses, cache.bytes_downloaded, cache.bytes_saved),
+                         (1, 1, len(BODY), len(BODY)))
+
+    def test_targets_are_linked_to_the_cached_copy(self):
+        cache = HttpCache(self.cache_dir)
+        target = self.fetch(cache)
+        cached = os.path.join(self.cache_dir, cache._entry(URL)[0])
+        self.assertTrue(os.path.samefile(target, cached))
+        os.utime(target, (1000000000, 1000000000))
+        self.assertTrue(os.path.samefile(self.fetch(cache), cached))
+        self.assertEqual(os.path.getmtime(target), 1000000000)
+        # a copy made after the file was cached is left as it is too
+        cache = HttpCache(self.cache_dir, modes=('copy',))
+        target = self.fetch(cache, 'copied')
+        self.assertFalse(os.path.samefile(target, cached))
+        mtime = os.path.getmtime(target)
+        self.fetch(cache, 'copied')
+        self.assertEqual((os.path.getmtime(target), read(target)), (mtime, BODY))
+
+    def test_least_recently_used_copies_are_removed(self):
+        cache = HttpCache(self.cache_dir, max_bytes=int(len(BODY) * 3.5))
+        targets = [self.fetch(cache, 'out%d' % i, URL + str(i)) for i in range(3)]
+        # revalidated last, the first copy is kept
+        os.utime(cache._entry(URL + '0')[1], (2000000000, 2000000000))
+        self.fetch(cache, 'out3', URL + '3')
+        self.assertEqual(sorted(key for used, key, size in cache._entries()),
+                         sorted(cache._entry(URL + str(i))[0] for i in (0, 2, 3)))
+        # the linked targets are kept
+        self.assertEqual([read(target) for target in targets], [BODY] * 3)
+
+    def test_changed_file_is_downloaded_again(self):
+        cache = HttpCache(self.cache_dir)
+        self.fetch(cache)
+        self.session.body = b'new optical image'
+        self.assertEqual(read(self.fetch(cache)), b'new optical image')
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_refresh_sends_no_validators(self):
+        self.fetch(HttpCache(self.cache_dir))
+        cache = HttpCache(self.cache_dir, refresh=True)
+        self.fetch(cache)
+        self.assertNotIn('If-None-Match', self.session.requests[1])
+        self.assertEqual(cache.misses, 1)
+
+    def test_disabled_cache_keeps_no_copy(self):
+        cache = HttpCache(self.cache_dir, enabled=False)
+        self.assertEqual(read(self.fetch(cache)), BODY)
+        self.fetch(cache)
+        self.assertEqual(cache.misses, 2)
+        self.assertFalse(os.path.exists(self.cache_dir) and os.listdir(self.cache_dir))
+
+    def test_http_errors_are_raised(self):
+        self.session.status_code = 404
+        self.assertRaises(IOError, self.fetch, HttpCache(self.cache_dir))
+        self.assertFalse(os.path.exists(os.path.join(self.out_path, 'optical.jpg')))
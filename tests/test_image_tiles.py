@@ -0,0 +1,68 @@
+import io
+import os
+import unittest
+
+import clients
+from http_cache import HttpCache
+from tests.support import StandinTestCase, FakeSession, read
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+URL = 'https://metaspace2020.eu/fs/optical_images/ds'
+
+
+def jpeg(color):
+    data = io.BytesIO()
+    Image.new('RGB', (300, 200), color).save(data, 'JPEG')
+    return data.getvalue()
+
+
+@unittest.skipIf(Image is None, 'needs pillow')
+class TileFreshnessTest(StandinTestCase):
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        self.session = FakeSession(jpeg('red'))
+        clients._clients['http'] = self.session
+        self.cache = HttpCache(os.path.join(self.tmp_dir, 'http_cache'))
+        self.out_path = os.path.join(self.tmp_dir, 'out')
+
+    def fetch(self):
+        return self.cache.fetch(URL, self.out_path, 'optical.jpg')
+
+    def build(self, image_path):
+        from image_tiles import build_pyramid
+
+        return build_pyramid(image_path, tile_size=64, thumbnail_size=32)
+
+    def test_pyramid_is_built_once(self):
+        from image_tiles import pyramid_paths
+
+        image_path = self.fetch()
+        self.assertTrue(self.build(image_path))
+        dzi_file, tiles_dir, thumbnail_file = pyramid_paths(image_path)
+        self.assertTrue(os.path.exists(dzi_file) and os.path.exists(thumbnail_file))
+        self.assertTrue(os.path.exists(os.path.join(tiles_dir, '0', '0_0.jpg')))
+        self.assertFalse(self.build(image_path))
+
+    def test_not_modified_image_keeps_its_pyramid(self):
+        image_path = self.fetch()
+        # an old mtime, so a rewrite would show even within the file system's time resolution
+        os.utime(image_path, (1000000000, 1000000000))
+        self.build(image_path)
+        self.assertEqual(self.fetch(), image_path)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(os.path.getmtime(image_path), 1000000000)
+        self.assertFalse(self.build(image_path))
+
+    def test_changed_image_gets_a_new_pyramid(self):
+        image_path = self.fetch()
+        os.utime(image_path, (1000000000, 1000000000))
+        self.build(image_path)
+        self.session.body = jpeg('blue')
+        self.fetch()
+        self.assertEqual(read(image_path), self.session.body)
+        self.assertTrue(self.build(image_path))
@@ -0,0 +1,94 @@
+import os
+import re
+import unittest
+
+from tests.support import StandinTestCase, BUCKET, read, write_imzml
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@unittest.skipIf(np is None, 'needs numpy')
+class RangesTest(unittest.TestCase):
+
+    def test_parse_roi(self):
+        from imzml_extract import parse_roi
+
+        self.assertEqual(parse_roi('2:4,1:3'), (2, 4, 1, 3))
+        self.assertEqual(parse_roi('5,6'), (5, 5, 6, 6))
+        self.assertRaises(ValueError, parse_roi, '1:2')
+
+    def test_coalesce_ranges(self):
+        from imzml_extract import coalesce_ranges
+
+        ranges = [(100, 199), (0, 49), (40, 59), (250, 299), (1000, 1099)]
+        self.assertEqual(coalesce_ranges(ranges, max_gap=0, max_size=10000),
+                         [(0, 59), (100, 199), (250, 299), (1000, 1099)])
+        self.assertEqual(coalesce_ranges(ranges, max_gap=50, max_size=10000), [(0, 299), (1000, 1099)])
+        self.assertEqual(coalesce_ranges(ranges, max_gap=50, max_size=200), [(0, 199), (250, 299), (1000, 1099)])
+
+
+@unittest.skipIf(np is None, 'needs numpy')
+class ExtractPixelsTest(StandinTestCase):
+    continuous = False
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        source = os.path.join(self.tmp_dir, 'source')
+        self.spectra = write_imzml(source, 12, 10, seed=5, continuous=self.continuous)
+        self.put_file('ds/sample.imzML', source + '.imzML')
+        self.ibd = self.put_file('ds/sample.ibd', source + '.ibd')
+        self.out_path = os.path.join(self.tmp_dir, 'out')
+        self.ibd_ranges = []
+        get_object = self.s3.get_object
+
+        def recording_get_object(**kwargs):
+            response = get_object(**kwargs)
+            if kwargs['Key'] == 'ds/sample.ibd':
+                self.ibd_ranges.append(response['ContentLength'])
+            return response
+
+        self.s3.get_object = recording_get_object
+
+    def extract(self, roi, **kwargs):
+        from imzml_extract import extract_pixels
+
+        return extract_pixels(BUCKET, 'ds', 'sample.imzML', 'sample.ibd', roi, self.out_path,
+                              os.path.join(self.tmp_dir, 'work'), **kwargs)
+
+    def test_region_is_extracted(self):
+        from imzml_reader import ImzMLReader
+
+        target = self.extract((3, 5, 2, 4), max_gap=0)
+        self.assertEqual(os.path.basename(target), 'sample_roi.imzML')
+        # only the spectra of the region: one range per pixel row, plus the shared m/z array when continuous
+        self.assertLess(sum(self.ibd_ranges), self.ibd.size / 4)
+        self.assertEqual(len(self.ibd_ranges), 4 if self.continuous else 3)
+        reader = ImzMLReader(target)
+        pixels = sorted(zip(reader.index.x.tolist(), reader.index.y.tolist()))
+        self.assertEqual(pixels, [(x, y) for x in range(3, 6) for y in range(2, 5)])
+        for i in range(len(reader.index)):
+            mz, intensities = reader.spectrum(i)
+            expected_mz, expected_intensities = self.spectra[(int(reader.index.x[i]), int(reader.index.y[i]))]
+            np.testing.assert_array_equal(mz, expected_mz)
+            np.testing.assert_array_equal(intensities, expected_intensities)
+
+    def test_new_files_have_their_own_uuid(self):
+        import uuid
+
+        target = self.extract((1, 2, 1, 2))
+        ibd_uuid = uuid.UUID(bytes=read(os.path.splitext(target)[0] + '.ibd')[:16])
+        with open(target, encoding='utf-8') as imzml_file:
+            imzml = imzml_file.read()
+        self.assertIn('{%s}' % str(ibd_uuid).upper(), imzml)
+        self.assertNotIn(self.ibd.data[:16].hex(), re.sub('[{}-]', '', imzml).lower())
+
+    def test_region_without_pixels(self):
+        self.assertIsNone(self.extract((50, 60, 50, 60)))
+        self.assertFalse(os.path.exists(os.path.join(self.out_path, 'sample_roi.imzML')))
+
+
+class ContinuousExtractPixelsTest(ExtractPixelsTest):
+    continuous = True
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests.support import write_imzml
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@unittest.skipIf(np is None, 'needs numpy')
+class ImzMLReaderTest(unittest.TestCase):
+    continuous = False
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        self.path = os.path.join(self.tmp_dir, 'sample')
+        self.spectra = write_imzml(self.path, 7, 5, seed=3, continuous=self.continuous)
+
+    def reader(self, **kwargs):
+        from imzml_reader import ImzMLReader
+
+        return ImzMLReader(self.path + '.imzML', **kwargs)
+
+    def expected_image(self, values):
+        image = np.zeros((5, 7))
+        for (x, y), (mz, intensities) in self.spectra.items():
+            image[y - 1, x - 1] = values(mz, intensities)
+        return image
+
+    def test_spectra(self):
+        reader = self.reader()
+        self.assertEqual(reader.shape, (5, 7))
+        self.assertEqual(reader.index.mode, 'continuous' if self.continuous else 'processed')
+        for i in range(len(reader.index)):
+            mz, intensities = reader.spectrum(i)
+            expected_mz, expected_intensities = self.spectra[(int(reader.index.x[i]), int(reader.index.y[i]))]
+            np.testing.assert_array_equal(mz, expected_mz)
+            np.testing.assert_array_equal(intensities, expected_intensities)
+
+    def test_tic_image(self):
+        expected = self.expected_image(lambda mz, intensities: intensities.astype(np.float64).sum())
+        for batch_elements in (1, 10, 1024 * 1024):
+            np.testing.assert_allclose(self.reader(batch_elements=batch_elements).tic_image(), expected)
+
+    def test_ion_image(self):
+        mz = self.spectra[(3, 2)][0][len(self.spectra[(3, 2)][0]) // 2]
+        for tol in (0.01, 5.0, 100.0):
+            expected = self.expected_image(
+                lambda mzs, intensities: intensities[(mzs >= mz - tol) & (mzs <= mz + tol)].astype(np.float64).sum())
+            for batch_elements in (1, 7, 1024 * 1024):
+                image = self.reader(batch_elements=batch_elements).ion_image(mz, tol=tol)
+                np.testing.assert_allclose(image, expected, err_msg='tol %g' % tol)
+
+    def test_index_is_saved_and_rebuilt_when_the_imzml_changes(self):
+        from imzml_reader import INDEX_SUFFIX, load_index
+
+        index_path = self.path + '.imzML' + INDEX_SUFFIX
+        self.reader()
+        self.assertTrue(os.path.exists(index_path))
+        np.testing.assert_array_equal(load_index(self.path + '.imzML').x, self.reader().index.x)
+        self.spectra = write_imzml(self.path, 4, 3, seed=4, continuous=self.continuous)
+        self.assertEqual(self.reader().shape, (3, 4))
+
+    def test_unreadable_index_is_rebuilt(self):
+        from imzml_reader import INDEX_SUFFIX
+
+        self.reader()
+        with open(self.path + '.imzML' + INDEX_SUFFIX, 'wb') as index_file:
+            index_file.write(b'not an index')
+        self.assertEqual(self.reader().shape, (5, 7))
+
+
+class ContinuousImzMLReaderTest(ImzMLReaderTest):
+    continuous = True
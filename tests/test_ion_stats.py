@@ -0,0 +1,73 @@
+import unittest
+from unittest import mock
+
+from benchmarks.standins import FakeSMInstance, FakeDataset
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@unittest.skipIf(np is None, 'needs numpy')
+class IonStatsTest(unittest.TestCase):
+
+    def dataset(self, annotations, image_shape=(20, 30)):
+        return FakeDataset(FakeSMInstance(), 'ds', 'dataset', {}, annotations=annotations, image_shape=image_shape)
+
+    def test_statistics_of_the_nonzero_pixels(self):
+        from ion_stats import image_statistics
+
+        rng = np.random.RandomState(0)
+        images = [rng.exponential(1.0, (20, 30)) for _ in range(3)]
+        for image in images:
+            image[image < 0.5] = 0
+        for image, stats in zip(images, image_statistics(images, percentiles=(10, 90, 99))):
+            signal = image[image > 0]
+            self.assertEqual(stats['nonzero'], len(signal))
+            self.assertAlmostEqual(stats['mean'], signal.mean())
+            self.assertAlmostEqual(stats['median'], np.median(signal))
+            self.assertAlmostEqual(stats['max'], signal.max())
+            for percentile in (10, 90, 99):
+                self.assertAlmostEqual(stats['p%g' % percentile], np.percentile(signal, percentile))
+            self.assertNotIn('p50', stats)
+
+    def test_empty_image(self):
+        from ion_stats import image_statistics
+
+        stats = image_statistics([np.zeros((4, 4)), np.ones((4, 4))])
+        self.assertEqual((stats[0]['mean'], stats[0]['median'], stats[0]['nonzero']), (None, None, 0))
+        self.assertEqual((stats[1]['median'], stats[1]['nonzero']), (1.0, 16))
+
+    def test_annotations_stay_in_order(self):
+        from ion_stats import iter_image_statistics
+
+        ds = self.dataset(25)
+        annotations = ds.annotations()
+        results = list(iter_image_statistics(ds, annotations, batch_bytes=20 * 30 * 8 * 4, max_workers=3))
+        self.assertEqual([annotation for annotation, stats in results], annotations)
+
+    def test_batches_are_capped_by_bytes(self):
+        import ion_stats
+
+        batches = []
+        image_statistics = ion_stats.image_statistics
+
+        def recording_image_statistics(images, percentiles):
+            batches.append(len(images))
+            return image_statistics(images, percentiles)
+
+        with mock.patch.object(ion_stats, 'image_statistics', recording_image_statistics):
+            list(ion_stats.iter_image_statistics(self.dataset(25), self.dataset(25).annotations(),
+                                                 batch_bytes=20 * 30 * 8 * 4))
+            self.assertEqual(batches, [4] * 6 + [1])
+            del batches[:]
+            # images larger than batch_bytes are still processed one at a time
+            list(ion_stats.iter_image_statistics(self.dataset(3, (100, 100)), self.dataset(3).annotations(),
+                                                 batch_bytes=1000))
+            self.assertEqual(batches, [1, 1, 1])
+
+    def test_no_annotations(self):
+        from ion_stats import iter_image_statistics
+
+        self.assertEqual(list(iter_image_statistics(self.dataset(0), [])), [])
@@ -0,0 +1,70 @@
+import contextlib
+import io
+import os
+
+import mmit
+from aws_client import download_object
+from file_utils import part_file_name
+from benchmarks.standins import FakeS3Error
+from manifest import TransferManifest, COMPLETE
+from tests.support import StandinTestCase, BUCKET, MB, content, read
+
+
+class TransferManifestTest(StandinTestCase):
+
+    def download(self, **kwargs):
+        return download_object(BUCKET, 'ds', 'sample.imzML', self.tmp_dir, manifest=TransferManifest(self.tmp_dir),
+                               max_concurrency=1, **kwargs)
+
+    def test_unchanged_file_is_skipped(self):
+        obj = self.put('ds/sample.imzML', 3 * MB + 5)
+        target = self.download()
+        served = self.s3.bytes_served
+        self.assertEqual(self.download(), target)
+        self.assertEqual(self.s3.bytes_served, served)
+        self.assertEqual(read(target), content(obj))
+
+    def test_changed_object_is_downloaded_again(self):
+        self.put('ds/sample.imzML', 3 * MB + 5, seed=1)
+        self.download()
+        obj = self.put('ds/sample.imzML', 3 * MB + 5, seed=2)
+        target = self.download()
+        self.assertEqual(read(target), content(obj))
+        self.assertEqual(TransferManifest(self.tmp_dir).entries()['sample.imzML']['etag'], obj.etag)
+
+    def test_deleted_file_is_downloaded_again(self):
+        obj = self.put('ds/sample.imzML', MB)
+        os.remove(self.download())
+        self.assertEqual(read(self.download()), content(obj))
+
+    def test_interrupted_download_resumes(self):
+        obj = self.put('ds/sample.imzML', 3 * MB + 5)
+        data = content(obj)
+        TransferManifest(self.tmp_dir).start(self.tmp_dir, 'sample.imzML', BUCKET, 'ds/sample.imzML', obj.size,
+                                             obj.etag)
+        with open(part_file_name(self.tmp_dir, 'sample.imzML'), 'wb') as part_file:
+            part_file.write(data[:MB + 3])
+        target = self.download()
+        self.assertEqual(self.s3.bytes_served, obj.size - MB - 3)
+        self.assertEqual(read(target), data)
+        self.assertEqual(TransferManifest(self.tmp_dir).entries()['sample.imzML']['state'], COMPLETE)
+
+    def test_verify_reports_missing_objects(self):
+        self.put('ds/sample.imzML', MB)
+        self.download()
+        del self.s3.objects[(BUCKET, 'ds/sample.imzML')]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertFalse(mmit.verify_manifest(self.tmp_dir))
+        self.assertIn('MISSING IN S3', output.getvalue())
+
+    def test_verify_raises_other_errors(self):
+        self.put('ds/sample.imzML', MB)
+        self.download()
+
+        def head_object(**kwargs):
+            raise FakeS3Error('AccessDenied', 'Access Denied')
+
+        self.s3.head_object = head_object
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertRaises(FakeS3Error, mmit.verify_manifest, self.tmp_dir)
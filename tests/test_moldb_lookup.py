@@ -0,0 +1,50 @@
+import os
+
+from moldb_lookup import MoleculeLookup
+from tests.support import StandinTestCase
+
+
+class MoleculeLookupTest(StandinTestCase):
+
+    def lookup(self, **kwargs):
+        return MoleculeLookup('HMDB-v4', path=os.path.join(self.tmp_dir, 'moldb.json'), **kwargs)
+
+    def saved_lookup(self):
+        molecules = self.lookup()
+        molecules.resolve(['C6H12O6', 'C5H5N5', 'C6H12O6'])
+        molecules.save()
+        return molecules
+
+    def test_formulas_are_looked_up_once(self):
+        molecules = self.saved_lookup()
+        self.assertEqual((molecules.requested, molecules.fetched), (3, 2))
+        resolved = molecules.resolve(['C6H12O6'])
+        self.assertEqual(resolved['C6H12O6'][0], ['molecule of C6H12O6'])
+        self.assertEqual(molecules.fetched, 2)
+
+    def test_saved_lookups_are_used_by_the_next_run(self):
+        self.saved_lookup()
+        molecules = self.lookup()
+        molecules.resolve(['C6H12O6', 'C5H5N5'])
+        self.assertEqual(molecules.fetched, 0)
+
+    def test_refresh_looks_up_again(self):
+        self.saved_lookup()
+        molecules = self.lookup(refresh=True)
+        molecules.resolve(['C6H12O6'])
+        self.assertEqual(molecules.fetched, 1)
+        molecules.save()
+        self.assertEqual(len(self.lookup().resolve(['C6H12O6'])), 1)
+
+    def test_expired_lookups_are_not_used(self):
+        self.saved_lookup()
+        os.utime(os.path.join(self.tmp_dir, 'moldb.json'), (1000000000, 1000000000))
+        molecules = self.lookup()
+        molecules.resolve(['C6H12O6'])
+        self.assertEqual(molecules.fetched, 1)
+
+    def test_nothing_is_saved_without_persist(self):
+        molecules = self.lookup(persist=False)
+        molecules.resolve(['C6H12O6'])
+        molecules.save()
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'moldb.json')))
@@ -0,0 +1,67 @@
+import os
+
+from aws_client import download_object
+from checksum import CHECKSUM_SUFFIX
+from manifest import TransferManifest
+from object_store import ObjectStore
+from tests.support import StandinTestCase, BUCKET, MB, content, read
+
+
+class ObjectStoreTest(StandinTestCase):
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        self.store = ObjectStore(os.path.join(self.tmp_dir, 'store'), max_bytes=10 * MB,
+                                 modes=('hardlink', 'copy'))
+
+    def download(self, key, out_dir, **kwargs):
+        aws_path, file_name = key.rsplit('/', 1)
+        return download_object(BUCKET, aws_path, file_name, os.path.join(self.tmp_dir, out_dir), store=self.store,
+                               max_concurrency=1, **kwargs)
+
+    def test_stored_object_is_linked_into_another_folder(self):
+        obj = self.put('ds/sample.ibd', 2 * MB)
+        first = self.download('ds/sample.ibd', 'study1')
+        served = self.s3.bytes_served
+        manifest = TransferManifest(os.path.join(self.tmp_dir, 'study2'))
+        second = self.download('ds/sample.ibd', 'study2', manifest=manifest)
+        self.assertEqual(self.s3.bytes_served, served)
+        self.assertEqual(read(second), content(obj))
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertTrue(os.path.exists(second + CHECKSUM_SUFFIX))
+        self.assertEqual((self.store.files_added, self.store.files_deduplicated), (1, 1))
+        self.assertEqual(self.store.modes_used, {'hardlink': 1})
+
+    def test_changed_object_is_not_taken_from_the_store(self):
+        self.put('ds/sample.ibd', 2 * MB, seed=1)
+        self.download('ds/sample.ibd', 'study1')
+        obj = self.put('ds/sample.ibd', 2 * MB, seed=2)
+        self.assertEqual(read(self.download('ds/sample.ibd', 'study2')), content(obj))
+        self.assertEqual(self.store.files_deduplicated, 0)
+
+    def test_least_recently_used_objects_are_removed(self):
+        for i in range(4):
+            self.put('ds/file%d.ibd' % i, 3 * MB, seed=i)
+        self.download('ds/file0.ibd', 'study1')
+        for i in range(1, 3):
+            self.download('ds/file%d.ibd' % i, 'study1')
+            # file0 used last
+            self.assertTrue(self.store.link_into(self.s3.objects[(BUCKET, 'ds/file0.ibd')].etag, 3 * MB,
+                                                 os.path.join(self.tmp_dir, 'study2'), 'file0.ibd'))
+        self.download('ds/file3.ibd', 'study1')
+        report = self.store.report()
+        self.assertLessEqual(report['bytes'], 10 * MB)
+        stored = [self.store.link_into(self.s3.objects[(BUCKET, 'ds/file%d.ibd' % i)].etag, 3 * MB,
+                                       os.path.join(self.tmp_dir, 'study3'), 'file%d.ibd' % i) is not None
+                  for i in range(4)]
+        self.assertEqual(stored, [True, False, True, True])
+        # files linked into output folders stay
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, 'study1', 'file1.ibd')))
+
+    def test_totals_are_kept_across_runs(self):
+        self.put('ds/sample.ibd', MB)
+        self.download('ds/sample.ibd', 'study1')
+        self.store.close()
+        store = ObjectStore(self.store.path, max_bytes=10 * MB)
+        self.assertEqual(store.report()['files_added'], 1)
+        self.assertEqual(store.report()['objects'], 1)
@@ -0,0 +1,104 @@
+import csv
+import json
+import os
+import sys
+import types
+from unittest import mock
+
+import config
+from benchmarks.standins import SyntheticStudy, FakeS3Error
+from pipeline import StudyPipeline
+from isa_tab_writer import write_study_tables
+from study_json import study_json_file
+from tests.support import StandinTestCase, MB, content, read
+
+
+class FakeIsaApiClient(object):
+    # writes s_study.txt and a_assay.txt as IsaApiClient.new_study does, without isatools
+
+    def new_study(self, std_title, std_description, samples, output_dir, persist=False):
+        write_study_tables(samples, output_dir)
+
+
+class StudyPipelineTest(StandinTestCase):
+
+    def make_study(self):
+        # every dataset has an optical_0.jpg
+        self.study = SyntheticStudy(datasets=3, imzml_size=MB, ibd_size=2 * MB, images=1, image_size=MB)
+        return self.study
+
+    def run_pipeline(self, use_path=False, create_study=False):
+        return StudyPipeline(self.study.ds_ids, self.tmp_dir, 'Study', 'Description', use_path=use_path,
+                             part_size=MB, create_study=create_study).run()
+
+    def objects(self, file_name):
+        return [self.s3.objects[(SyntheticStudy.BUCKET, key)] for key, size, seed in self.study.objects
+                if key.endswith('/' + file_name)]
+
+    def test_files_of_the_same_name_are_downloaded_once(self):
+        pipeline = self.run_pipeline()
+        self.assertEqual([stage.failures for stage in pipeline.stages.values()], [0, 0, 0])
+        self.assertEqual(pipeline.stages['download'].items, len(self.study.objects))
+        files = sorted(os.listdir(self.tmp_dir))
+        self.assertFalse([name for name in files if name.endswith('.part')])
+        self.assertEqual(len([name for name in files if name.endswith('.ibd')]), 3)
+        self.assertIn(read(os.path.join(self.tmp_dir, 'optical_0.jpg')),
+                      [content(obj) for obj in self.objects('optical_0.jpg')])
+        self.assertEqual(pipeline.bytes_transferred, self.study.total_bytes() - 2 * MB)
+
+    def test_files_of_the_same_name_in_their_dataset_folders(self):
+        pipeline = self.run_pipeline(use_path=True)
+        self.assertEqual(pipeline.bytes_transferred, self.study.total_bytes())
+        for dataset, obj in zip(self.study.datasets, self.objects('optical_0.jpg')):
+            path = os.path.join(self.tmp_dir, SyntheticStudy.BUCKET, dataset['id'], 'optical_0.jpg')
+            self.assertEqual(read(path), content(obj))
+
+    def test_throttled_downloads_are_retried(self):
+        get_object = self.s3.get_object
+        throttled = []
+
+        def throttling_get_object(**kwargs):
+            if len(throttled) < 2:
+                throttled.append(kwargs['Key'])
+                raise FakeS3Error('SlowDown', 'Please reduce your request rate')
+            return get_object(**kwargs)
+
+        self.s3.get_object = throttling_get_object
+        with mock.patch.object(config, 'SCHEDULER_BACKOFF_BASE', 0.0):
+            pipeline = self.run_pipeline()
+        self.assertEqual(len(throttled), 2)
+        self.assertEqual(pipeline.stages['download'].failures, 0)
+        self.assertEqual(pipeline.bytes_transferred, self.study.total_bytes() - 2 * MB)
+
+    def test_study_json_lists_every_sample(self):
+        self.run_pipeline()
+        with open(study_json_file(self.tmp_dir, 'Study')) as data_file:
+            samples = json.load(data_file)
+        self.assertEqual([sample['metaspace_options']['Dataset_Name'] for sample in samples],
+                         [dataset['name'] for dataset in self.study.datasets])
+        self.assertTrue(all(sample['s3dir'] for sample in samples))
+
+    def test_assay_lists_the_raw_files_of_every_sample(self):
+        # slow listings, so the metadata of every sample is in long before its files are listed
+        self.s3.latency = 0.05
+        with mock.patch.dict(sys.modules, isa_api_client=types.SimpleNamespace(IsaApiClient=FakeIsaApiClient)):
+            self.run_pipeline(create_study=True)
+        with open(os.path.join(self.tmp_dir, 'a_assay.txt'), newline='') as data_file:
+            rows = list(csv.reader(data_file, delimiter='\t'))
+        columns = [i for i, header in enumerate(rows[0]) if header == 'Raw Spectral Data File']
+        self.assertEqual([[row[i] for i in columns] for row in rows[1:]],
+                         [[dataset['name'] + '.imzML', dataset['name'] + '.ibd'] for dataset in self.study.datasets])
+
+    def test_study_tables_take_the_dataset_ids_of_the_samples(self):
+        write_study_tables(self.study.samples(), self.tmp_dir)
+        self.assertEqual(len(self.sm.latencies.samples), 0)
+        with open(os.path.join(self.tmp_dir, 'a_assay.txt'), newline='') as data_file:
+            rows = list(csv.reader(data_file, delimiter='\t'))
+        self.assertEqual([row[-1] for row in rows[1:]], self.study.ds_ids)
+        # samples without one are looked up by name
+        samples = list(self.study.samples())
+        del samples[1]['ds_id']
+        write_study_tables(samples, self.tmp_dir)
+        self.assertEqual(len(self.sm.latencies.samples), 1)
+        with open(os.path.join(self.tmp_dir, 'a_assay.txt'), newline='') as data_file:
+            self.assertEqual([row[-1] for row in csv.reader(data_file, delimiter='\t')][1:], self.study.ds_ids)
@@ -0,0 +1,79 @@
+import os
+
+from aws_client import download_object, part_ranges
+from benchmarks.standins import FakeS3Error
+from file_utils import part_file_name
+from manifest import TransferManifest
+from tests.support import StandinTestCase, BUCKET, MB, content, read
+
+
+class RangedDownloadTest(StandinTestCase):
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        self.obj = self.put('ds/sample.ibd', 10 * MB + 7)
+        self.ranges = []
+        self.failing = set()
+        get_object = self.s3.get_object
+
+        def ranged_get_object(**kwargs):
+            start = int(kwargs['Range'][len('bytes='):].split('-')[0])
+            if start in self.failing:
+                raise FakeS3Error('InternalError', 'range %d' % start)
+            self.ranges.append(start)
+            return get_object(**kwargs)
+
+        self.s3.get_object = ranged_get_object
+
+    def download(self, manifest=None):
+        return download_object(BUCKET, 'ds', 'sample.ibd', self.tmp_dir, part_size=MB, threshold=MB,
+                               max_concurrency=4, manifest=manifest)
+
+    def test_parts_are_assembled(self):
+        target = self.download()
+        self.assertEqual(read(target), content(self.obj))
+        self.assertEqual(sorted(self.ranges), [start for start, end in part_ranges(self.obj.size, MB)])
+
+    def test_interrupted_download_resumes_missing_parts(self):
+        self.failing = {3 * MB, 7 * MB}
+        self.assertRaises(FakeS3Error, self.download, TransferManifest(self.tmp_dir))
+        self.assertTrue(os.path.exists(part_file_name(self.tmp_dir, 'sample.ibd')))
+        done = set(offset for offset, md5, sha256 in TransferManifest(self.tmp_dir).entries()['sample.ibd']['parts'])
+        self.assertTrue(done)
+        self.assertFalse(done & self.failing)
+
+        self.failing = set()
+        self.ranges = []
+        target = self.download(TransferManifest(self.tmp_dir))
+        all_parts = set(start for start, end in part_ranges(self.obj.size, MB))
+        self.assertEqual(set(self.ranges), all_parts - done)
+        self.assertEqual(read(target), content(self.obj))
+
+    def restart_with_a_lost_part_file(self, lose):
+        # a first run fails part way, the .part file is lost, a second run fails on the parts the first one
+        # had downloaded, then a third run must not take them from the manifest
+        self.failing = {3 * MB, 7 * MB}
+        self.assertRaises(FakeS3Error, self.download, TransferManifest(self.tmp_dir))
+        done = set(offset for offset, md5, sha256 in TransferManifest(self.tmp_dir).entries()['sample.ibd']['parts'])
+        lose(part_file_name(self.tmp_dir, 'sample.ibd'))
+        self.failing = done
+        self.assertRaises(FakeS3Error, self.download, TransferManifest(self.tmp_dir))
+        self.failing = set()
+        target = self.download(TransferManifest(self.tmp_dir))
+        self.assertEqual(read(target), content(self.obj))
+
+    def test_missing_part_file_is_not_resumed(self):
+        self.restart_with_a_lost_part_file(os.remove)
+
+    def test_truncated_part_file_is_not_resumed(self):
+        def truncate(path):
+            with open(path, 'r+b') as part_file:
+                part_file.truncate(2 * MB)
+
+        self.restart_with_a_lost_part_file(truncate)
+
+    def test_failed_download_without_manifest_leaves_no_part_file(self):
+        self.failing = {5 * MB}
+        self.assertRaises(FakeS3Error, self.download)
+        self.assertFalse(os.path.exists(part_file_name(self.tmp_dir, 'sample.ibd')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'sample.ibd')))
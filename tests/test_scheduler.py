@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+import config
+from benchmarks.standins import FakeS3Error
+from scheduler import AdaptiveLimit, TransferScheduler, call_with_retry, is_throttle_error, resolve_in_order
+from sharding import ClaimStore
+from tests.support import StandinTestCase, BUCKET, MB, content, read
+
+
+class ResolveInOrderTest(unittest.TestCase):
+
+    def test_results_keep_the_order_of_the_items(self):
+        def resolve(item):
+            time.sleep((10 - item) * 0.001)
+            return item * item
+
+        self.assertEqual(list(resolve_in_order(range(10), resolve, 4)), [(item, item * item) for item in range(10)])
+
+    def test_items_are_read_a_window_ahead(self):
+        read_items = []
+
+        def items():
+            for item in range(100):
+                read_items.append(item)
+                yield item
+
+        results = resolve_in_order(items(), lambda item: item, max_workers=2, window=5)
+        self.assertEqual(next(results), (0, 0))
+        self.assertEqual(len(read_items), 5)
+        self.assertEqual(len(list(results)), 99)
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(config, 'SCHEDULER_BACKOFF_BASE', 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_adaptive_limit_halves_and_grows_back(self):
+        limit = AdaptiveLimit(8)
+        limit.acquire()
+        limit.release(throttled=True)
+        self.assertEqual(limit.limit, 4)
+        for _ in range(4):
+            limit.acquire()
+            limit.release()
+        self.assertEqual(limit.limit, 5)
+
+    def test_throttled_calls_are_retried(self):
+        calls = []
+
+        def flaky(value):
+            calls.append(value)
+            if len(calls) < 3:
+                raise FakeS3Error('SlowDown', 'Please reduce your request rate')
+            return value
+
+        limit = AdaptiveLimit(4)
+        self.assertEqual(call_with_retry(flaky, ('done',), {}, limit, max_attempts=5), 'done')
+        self.assertEqual(len(calls), 3)
+        self.assertLess(limit.limit, 4)
+
+    def test_other_errors_are_not_retried(self):
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise FakeS3Error('AccessDenied', 'Access Denied')
+
+        self.assertFalse(is_throttle_error(FakeS3Error('AccessDenied', 'Access Denied')))
+        self.assertRaises(FakeS3Error, call_with_retry, failing, (), {}, AdaptiveLimit(4))
+        self.assertEqual(len(calls), 1)
+
+    def test_retries_are_limited(self):
+        def throttled():
+            raise FakeS3Error('SlowDown', 'Please reduce your request rate')
+
+        self.assertRaises(FakeS3Error, call_with_retry, throttled, (), {}, AdaptiveLimit(4), max_attempts=3)
+
+
+class TransferSchedulerTest(StandinTestCase):
+
+    def test_downloads_of_many_datasets(self):
+        objects = dict(('ds%d/sample.ibd' % i, self.put('ds%d/sample.ibd' % i, MB + i, seed=i)) for i in range(6))
+        scheduler = TransferScheduler(max_workers=3)
+        for key in objects:
+            scheduler.submit_download(key.split('/')[0], BUCKET, os.path.dirname(key), 'sample.ibd',
+                                      os.path.join(self.tmp_dir, os.path.dirname(key)))
+        scheduler.wait()
+        self.assertEqual(scheduler.files_transferred, 6)
+        self.assertEqual(scheduler.bytes_transferred, sum(obj.size for obj in objects.values()))
+        for key, obj in objects.items():
+            self.assertEqual(read(os.path.join(self.tmp_dir, key)), content(obj))
+
+    def test_same_target_is_downloaded_once(self):
+        self.put('ds1/optical.jpg', MB, seed=1)
+        self.put('ds2/optical.jpg', MB, seed=2)
+        scheduler = TransferScheduler(max_workers=2)
+        for ds in ('ds1', 'ds2'):
+            scheduler.submit_download(ds, BUCKET, ds, 'optical.jpg', self.tmp_dir)
+        scheduler.wait()
+        self.assertEqual(scheduler.files_transferred, 1)
+        self.assertFalse(scheduler.failures)
+
+    def test_failures_are_kept_per_dataset(self):
+        self.put('ds1/sample.ibd', MB)
+        scheduler = TransferScheduler(max_workers=2)
+        scheduler.submit_download('ds1', BUCKET, 'ds1', 'sample.ibd', self.tmp_dir)
+        scheduler.submit_download('ds2', BUCKET, 'ds2', 'missing.ibd', self.tmp_dir)
+        scheduler.wait()
+        self.assertEqual(scheduler.files_transferred, 1)
+        self.assertEqual(list(scheduler.failures), ['ds2'])
+
+    def download_claimed(self, claims, **kwargs):
+        obj = self.put('ds1/sample.ibd', MB)
+        scheduler = TransferScheduler(max_workers=2, **kwargs)
+        scheduler.submit_download('ds1', BUCKET, 'ds1', 'sample.ibd', self.tmp_dir, claims=claims,
+                                  claim_key='ds1/sample.ibd')
+        return scheduler.wait(), obj
+
+    def test_stale_claims_of_other_nodes_are_taken_over_at_the_end(self):
+        claims = ClaimStore(self.tmp_dir, stale_after=0.3)
+        # held by a node that stopped without releasing it
+        with open(claims._file('ds1/sample.ibd') + '.lock', 'w') as lock_file:
+            lock_file.write('other:1')
+        scheduler, obj = self.download_claimed(claims)
+        self.assertEqual((scheduler.files_transferred, scheduler.unfinished), (1, []))
+        self.assertEqual(read(os.path.join(self.tmp_dir, 'sample.ibd')), content(obj))
+        self.assertTrue(claims.is_done('ds1/sample.ibd'))
+
+    def test_claims_held_by_live_nodes_are_left_unfinished(self):
+        other = ClaimStore(self.tmp_dir, stale_after=0.3)
+        self.assertTrue(other.claim('ds1/sample.ibd'))
+        self.addCleanup(other.release, 'ds1/sample.ibd')
+        scheduler, obj = self.download_claimed(ClaimStore(self.tmp_dir, stale_after=0.3), claim_wait=0.5)
+        self.assertEqual((scheduler.files_transferred, scheduler.unfinished), (0, ['ds1/sample.ibd']))
+        self.assertFalse(scheduler.failures)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'sample.ibd')))
+
+    def test_tasks_submitting_tasks(self):
+        done = []
+        lock = threading.Lock()
+        scheduler = TransferScheduler(max_workers=2)
+
+        def task(depth):
+            if depth < 3:
+                for _ in range(2):
+                    scheduler.submit('ds', task, depth + 1)
+            with lock:
+                done.append(depth)
+
+        scheduler.submit('ds', task, 0)
+        scheduler.wait()
+        self.assertEqual(len(done), 15)
@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sharding import ClaimStore, Shard, merge_study_json, select, write_shard_study_json
+from study_json import study_json_file
+
+DS_IDS = ['2020-01-01_00h00m%06ds' % i for i in range(50)]
+
+
+class ShardTest(unittest.TestCase):
+
+    def test_every_item_has_one_owner(self):
+        shards = [Shard(index, 4) for index in range(4)]
+        for ds_id in DS_IDS:
+            self.assertEqual(sum(shard.owns(ds_id) for shard in shards), 1)
+        self.assertEqual(sorted(item for shard in shards for item in select(DS_IDS, str, shard)), sorted(DS_IDS))
+
+    def test_parse(self):
+        shard = Shard.parse('2/5')
+        self.assertEqual((shard.index, shard.count, str(shard)), (2, 5, '2/5'))
+        for value in ('5/5', '-1/5', '0/0'):
+            self.assertRaises(ValueError, Shard.parse, value)
+
+    def test_steal_appends_the_other_items_last_first(self):
+        shard = Shard(0, 3)
+        own = select(DS_IDS, str, shard)
+        others = [ds_id for ds_id in DS_IDS if ds_id not in own]
+        self.assertEqual(select(DS_IDS, str, shard, steal=True), own + others[::-1])
+
+    def test_no_shard_keeps_the_items(self):
+        items = iter(DS_IDS)
+        self.assertIs(select(items, str), items)
+
+
+class ClaimStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+
+    def test_an_item_is_claimed_once(self):
+        node1, node2 = ClaimStore(self.tmp_dir), ClaimStore(self.tmp_dir)
+        self.assertTrue(node1.claim('ds/file'))
+        self.assertFalse(node2.claim('ds/file'))
+        node1.release('ds/file')
+        self.assertTrue(node2.claim('ds/file'))
+
+    def test_done_items_are_not_claimed(self):
+        claims = ClaimStore(self.tmp_dir)
+        self.assertTrue(claims.claim('ds/file'))
+        claims.done('ds/file')
+        claims.release('ds/file')
+        self.assertTrue(claims.is_done('ds/file'))
+        self.assertFalse(ClaimStore(self.tmp_dir).claim('ds/file'))
+
+    def test_stale_claims_are_taken_over(self):
+        self.assertTrue(ClaimStore(self.tmp_dir).claim('ds/file'))
+        lock_file = ClaimStore(self.tmp_dir)._file('ds/file') + '.lock'
+        os.utime(lock_file, (1000000000, 1000000000))
+        self.assertTrue(ClaimStore(self.tmp_dir, stale_after=60).claim('ds/file'))
+
+
+class MergeStudyJsonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+
+    def write_shards(self, count):
+        for index in range(count):
+            shard = Shard(index, count)
+            write_shard_study_json(self.tmp_dir, 'Study', shard, DS_IDS,
+                                   dict((ds_id, {'id': ds_id}) for ds_id in select(DS_IDS, str, shard)))
+
+    def test_merge_keeps_the_order_of_the_study(self):
+        self.write_shards(3)
+        merged = merge_study_json(self.tmp_dir, 'Study')
+        self.assertEqual([sample['id'] for sample in merged], DS_IDS)
+        with open(study_json_file(self.tmp_dir, 'Study')) as data_file:
+            self.assertEqual(json.load(data_file), merged)
+
+    def test_merge_to_json_lines(self):
+        self.write_shards(2)
+        merge_study_json(self.tmp_dir, 'Study', lines=True)
+        with open(study_json_file(self.tmp_dir, 'Study', lines=True)) as data_file:
+            self.assertEqual([json.loads(line)['id'] for line in data_file], DS_IDS)
+
+    def test_merge_without_shard_files(self):
+        self.assertRaises(IOError, merge_study_json, self.tmp_dir, 'Study')
@@ -0,0 +1,78 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from study_json import JsonArrayReader, StudyJson, StudyJsonWriter, iter_json_lines, study_json_file
+
+SAMPLES = [{'name': 'sample 1', 's3dir': {'imzML': 'bucket/ds/a.imzML'}}, 12345.678e-3, -17, 'text, with ] and ,',
+           [1, [2, 3], {}], {'nested': {'deep': [True, False, None]}}, 1e300, 'é€', 0]
+
+
+class JsonArrayReaderTest(unittest.TestCase):
+
+    def read(self, text, chunk_size):
+        return list(JsonArrayReader(io.StringIO(text), chunk_size))
+
+    def test_values_across_chunk_boundaries(self):
+        spaced = ' \n[ %s ]\n ' % ' ,\n'.join(json.dumps(sample) for sample in SAMPLES)
+        for text in (json.dumps(SAMPLES), json.dumps(SAMPLES, indent=4), spaced):
+            for chunk_size in (1, 2, 3, 5, 7, 64, 1024 * 1024):
+                self.assertEqual(self.read(text, chunk_size), SAMPLES, (text, chunk_size))
+
+    def test_numbers_split_by_a_chunk(self):
+        # a number cut after its sign, point or exponent must not be decoded before the rest is read
+        for number in ('123456', '-1.5', '2.5e-10', '1E+300', '-0.000125'):
+            text = '[%s, %s]' % (number, number)
+            for chunk_size in range(1, len(text) + 1):
+                self.assertEqual(self.read(text, chunk_size), [float(number)] * 2, (number, chunk_size))
+
+    def test_empty_array(self):
+        for text in ('[]', ' [ ] ', '[\n]'):
+            self.assertEqual(self.read(text, 1), [])
+
+    def test_invalid_input(self):
+        for text in ('', '{"a": 1}', '[1, 2', '[1 2]', '[1,, 2]', '["open]'):
+            with self.assertRaises(ValueError, msg=text):
+                self.read(text, 2)
+
+
+class StudyJsonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+
+    def write(self, lines):
+        path = study_json_file(self.tmp_dir, 'Study', lines)
+        with StudyJsonWriter(path, lines) as writer:
+            for sample in SAMPLES:
+                writer.write(sample)
+        return path
+
+    def test_array_round_trip(self):
+        path = self.write(False)
+        with open(path) as data_file:
+            self.assertEqual(json.load(data_file), SAMPLES)
+        self.assertEqual(list(StudyJson(path, chunk_size=3)), SAMPLES)
+
+    def test_lines_round_trip(self):
+        path = self.write(True)
+        self.assertTrue(path.endswith('.jsonl'))
+        with open(path) as data_file:
+            self.assertEqual(list(iter_json_lines(data_file)), SAMPLES)
+        self.assertEqual(list(StudyJson(path)), SAMPLES)
+
+    def test_study_json_can_be_read_again(self):
+        study = StudyJson(self.write(False))
+        self.assertEqual(list(study), list(study))
+
+    def test_failed_write_leaves_no_file(self):
+        path = study_json_file(self.tmp_dir, 'Study')
+        with self.assertRaises(RuntimeError):
+            with StudyJsonWriter(path) as writer:
+                writer.write(SAMPLES[0])
+                raise RuntimeError('interrupted')
+        self.assertFalse(os.path.exists(path))
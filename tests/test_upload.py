@@ -0,0 +1,73 @@
+import hashlib
+import os
+
+from aws_client import upload_object
+from benchmarks.standins import FakeS3Error
+from checksum import multipart_etag
+from tests.support import StandinTestCase, BUCKET, MB
+
+
+class UploadTest(StandinTestCase):
+
+    def write(self, size, seed=1):
+        path = os.path.join(self.tmp_dir, 'sample.ibd')
+        self.data = hashlib.sha256(b'%d' % seed).digest() * (size // 32) + b'x' * (size % 32)
+        with open(path, 'wb') as data_file:
+            data_file.write(self.data)
+        return path
+
+    def upload(self, path, **kwargs):
+        return upload_object(path, BUCKET, 'study/sample.ibd', part_size=MB, threshold=MB, max_concurrency=3,
+                             **kwargs)
+
+    def uploaded(self):
+        return self.s3.objects[(BUCKET, 'study/sample.ibd')]
+
+    def test_small_file_is_put(self):
+        path = self.write(MB // 2)
+        self.assertEqual(self.upload(path), MB // 2)
+        self.assertEqual(self.uploaded().etag, '"%s"' % hashlib.md5(self.data).hexdigest())
+
+    def test_multipart_upload(self):
+        path = self.write(5 * MB + 3)
+        self.assertEqual(self.upload(path), 5 * MB + 3)
+        parts = [hashlib.md5(self.data[start:start + MB]).digest() for start in range(0, len(self.data), MB)]
+        self.assertEqual(self.uploaded().etag, '"%s"' % multipart_etag(parts))
+        self.assertEqual(self.uploaded().size, 5 * MB + 3)
+
+    def test_uploaded_file_is_skipped(self):
+        for size in (MB // 2, 5 * MB + 3):
+            path = self.write(size)
+            self.upload(path)
+            received = self.s3.bytes_received
+            self.assertIsNone(self.upload(path))
+            self.assertEqual(self.s3.bytes_received, received)
+
+    def test_changed_file_is_uploaded_again(self):
+        self.upload(self.write(5 * MB + 3, seed=1))
+        path = self.write(5 * MB + 3, seed=2)
+        self.assertEqual(self.upload(path), 5 * MB + 3)
+        self.assertIsNone(self.upload(path))
+
+    def test_interrupted_upload_resumes(self):
+        path = self.write(5 * MB + 3)
+        upload_part = self.s3.upload_part
+        sent_parts = []
+
+        def failing_upload_part(**kwargs):
+            if kwargs['PartNumber'] == 4:
+                raise FakeS3Error('InternalError', 'part 4')
+            sent_parts.append(kwargs['PartNumber'])
+            return upload_part(**kwargs)
+
+        self.s3.upload_part = failing_upload_part
+        self.assertRaises(FakeS3Error, self.upload, path)
+        self.assertEqual(len(self.s3.uploads), 1)
+        first_parts = set(sent_parts)
+        self.assertNotIn(4, first_parts)
+
+        self.s3.upload_part = upload_part
+        self.assertEqual(self.upload(path), sum(len(self.data[(number - 1) * MB:number * MB])
+                                                for number in range(1, 7) if number not in first_parts))
+        self.assertFalse(self.s3.uploads)
+        self.assertIsNone(self.upload(path))